@@ -5,5 +5,12 @@ params = {
     'version':__version__,
     'cdm':'5.3.1'
 }
-from . import cdm
 
+import importlib
+
+#subpackages are imported when first used,
+#so short commands (e.g. `carrot --version`) don't import everything
+def __getattr__(name):
+    if name in ['cdm','tools','io','cli','analyses']:
+        return importlib.import_module(f'.{name}',__name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
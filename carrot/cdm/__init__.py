@@ -1,5 +1,9 @@
 from .model import CommonDataModel
 from .operations import OperationTools
+from .snapshot import SharedTables, save_snapshot, load_snapshot
+from .sql import SqlBackend
+from .polars import PolarsBackend
+from .rules_sql import RulesSqlBackend
 
 from .objects import get_cdm_class, get_cdm_decorator
 
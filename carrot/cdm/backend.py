@@ -0,0 +1,93 @@
+import numpy as np
+from carrot.tools.logger import Logger
+from .objects.common import FormatterLevel, FormattingError
+
+#the pandas dtypes the DataFormatter makes
+_pandas_dtypes = {
+    'Integer':'Int64',
+    'Float':'Float64'
+}
+
+
+class Backend(Logger):
+    """
+    Executes the rules of DestinationTable objects (see DestinationTable.set_backend) instead of pandas,
+    giving the same dataframe as DestinationTable.get_df would:
+    * the source fields are mapped, with operations and term mappings applied
+    * rows without the required fields are dropped (finalise)
+    * the primary key is numbered
+    * the mapped fields are formatted (format), and rows without the required fields dropped again
+    """
+    name = None
+
+    def __init__(self,format_level=FormatterLevel.ON):
+        self.format_level = FormatterLevel(format_level)
+        if self.format_level is FormatterLevel.CHECK:
+            raise NotImplementedError(f"the {self.name} backend cannot check the formatting, use format_level 0 or 1")
+
+    def collect(self,objects):
+        """
+        Run the objects of a destination table together, if the backend can, before get_df is called for each
+        """
+        pass
+
+    def get_df(self,obj,start_index=1,**kwargs):
+        raise NotImplementedError(f"get_df is not implemented for {type(self).__name__}")
+
+    def get_required(self,obj):
+        #the required fields, in the order rows without them are dropped by finalise
+        return [field for field in obj.fields[1:] if field in obj.required_fields]
+
+    def get_formatted(self,obj):
+        #the mapped fields that are formatted, i.e. not the primary key or person_id
+        if self.format_level is not FormatterLevel.ON:
+            return []
+        return [field for field in obj.fields
+                if field in obj.get_rules() and field != 'person_id' and not obj[field].pk]
+
+    def is_numbered(self,obj):
+        #if the primary key is numbered 0..N (then offset by the start index)
+        pk = obj.fields[0]
+        return pk != 'person_id' and pk not in obj.get_rules()
+
+    def set_meta(self,obj,counts,name):
+        """
+        Record (and log) the rows left after requiring each field, counts are the number of rows
+        then the rows left after each field e.g. {'__rows':100,'person_id':100,'gender_concept_id':60}
+        """
+        counts = dict(counts)
+        nbefore = counts.pop('__rows')
+        for field,nafter in counts.items():
+            nafter = int(nafter or 0)
+            if name == 'after_formatting':
+                obj._meta['required_fields'].setdefault(field,{})[name] = nafter
+            else:
+                obj._meta['required_fields'][field] = {'before':nbefore,'after':nafter}
+            ndiff = nbefore - nafter
+            if ndiff > 0:
+                log = obj.logger.warning if nafter > 0 else obj.logger.error
+                log(f"Requiring non-null values in {field} removed {ndiff} rows, leaving {nafter} rows.")
+            if nafter == 0 and nbefore > 0 and name == 'after_formatting':
+                raise FormattingError(f"When formatting the required column {field}, using the formatter function "
+                                      f"{obj[field].dtype}, all produced values are  NaN/null values.")
+            nbefore = nafter
+
+    def to_cdm(self,obj,df,start_index=1):
+        """
+        Give the result the same columns and dtypes as made by pandas
+        """
+        rules = obj.get_rules()
+        pk = obj.fields[0]
+        numbered = self.is_numbered(obj)
+        if numbered:
+            df[pk] = df[pk].astype('int64') + start_index
+        formatted = self.get_formatted(obj)
+        for field in obj.fields:
+            if field == pk and numbered:
+                continue
+            elif field not in rules:
+                #as with pandas, fields that are not mapped are left empty
+                df[field] = np.nan
+            elif field in formatted and obj[field].dtype in _pandas_dtypes:
+                df[field] = df[field].astype(_pandas_dtypes[obj[field].dtype])
+        return df[obj.fields]
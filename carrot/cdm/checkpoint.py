@@ -0,0 +1,73 @@
+import os
+import itertools
+import pickle
+from carrot.tools.logger import Logger
+
+CHECKPOINT_VERSION = 1
+
+
+class CannotResume(Exception):
+    pass
+
+
+def _write_atomic(fname,data):
+    #write to a temporary file first, so a crash never leaves a half written checkpoint
+    tmp = f'{fname}.tmp'
+    with open(tmp,'wb') as f:
+        pickle.dump(data,f,protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp,fname)
+
+
+class Checkpoint(Logger):
+    """
+    The state of a chunked run, saved after each chunk of each destination table is written,
+    so an interrupted run can be resumed from the last chunk that completed.
+
+    The person_id masker only changes while the person table is processed, and can be large,
+    so it is saved to its own file and only rewritten when it has grown.
+    """
+    def __init__(self,fname):
+        self.fname = fname
+        self.masker_fname = f'{fname}.masker'
+        self.__nmasker = None
+
+    def exists(self):
+        return os.path.exists(self.fname)
+
+    def save(self,state,masker=None):
+        nmasker = None if masker is None else len(masker)
+        if nmasker != self.__nmasker or not os.path.exists(self.masker_fname):
+            _write_atomic(self.masker_fname,masker)
+            self.__nmasker = nmasker
+        _write_atomic(self.fname,{**state,'version':CHECKPOINT_VERSION,'nmasker':nmasker})
+        self.logger.debug(f"saved checkpoint for {state.get('table')} chunk {state.get('chunk')}")
+
+    def load(self):
+        """
+        Returns the saved state and the person_id masker
+        """
+        with open(self.fname,'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != CHECKPOINT_VERSION:
+            raise CannotResume(f"{self.fname} was saved by a different version of the checkpointing")
+        with open(self.masker_fname,'rb') as f:
+            masker = pickle.load(f)
+        nmasker = None if masker is None else len(masker)
+        if state['nmasker'] is None:
+            masker = nmasker = None
+        elif nmasker is not None and nmasker > state['nmasker']:
+            #saved just before a crash, but the checkpoint it belongs to wasn't,
+            #the masker is only ever added to, so the persons of the checkpoint are the first ones
+            masker = dict(itertools.islice(masker.items(),state['nmasker']))
+            nmasker = len(masker)
+        if nmasker != state['nmasker']:
+            raise CannotResume(f"{self.masker_fname} does not match the checkpoint")
+        self.__nmasker = nmasker
+        return state,masker
+
+    def remove(self):
+        for fname in [self.fname,self.masker_fname]:
+            if os.path.exists(fname):
+                os.remove(fname)
@@ -81,10 +81,13 @@ conda activate carrot-env
             if "--analysis" in commands:
                 return analysis(model,*args,**kwargs)
             else:
-                commands.extend(["--analysis",analysis.__name__])
+                #the job loads the already processed tables, rather than rerunning the ETL
+                snapshot = model.save_snapshot()
+                commands.extend(["--analysis",analysis.__name__,"--snapshot",snapshot])
                 name = "analysis"
                 _id = format(id(analysis),'X')
                 return self.run(commands=commands,jobname=f"{name}_{analysis.__name__}_{_id}")
+        wrapper.uses_snapshot = True
         return wrapper
     #return _qsub
 
@@ -0,0 +1,88 @@
+import threading
+import numpy as np
+import pandas as pd
+from carrot.tools.logger import Logger
+
+
+def is_indexed_column(column):
+    return column == 'person_id' or column.endswith('_concept_id')
+
+
+class ColumnIndex():
+    """
+    Secondary index on one column of a table, stored in a CSR like layout:
+    the row positions sorted by key (stable, so each key's rows stay in table order)
+    and the offsets into these for each of the (sorted) unique keys.
+    Null values are not indexed.
+    """
+    def __init__(self,series):
+        codes,keys = pd.factorize(series,sort=True)
+        self.keys = pd.Index(keys)
+        order = np.argsort(codes,kind='stable')
+        #nulls have code -1 so are sorted to the start
+        self.order = order[np.count_nonzero(codes < 0):]
+        counts = np.bincount(codes[codes >= 0],minlength=len(self.keys))
+        self.offsets = np.concatenate([[0],np.cumsum(counts)])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self,values):
+        """
+        Sorted positions of all rows matching any of the values
+        """
+        if np.isscalar(values):
+            values = [values]
+        codes = self.keys.get_indexer(pd.Index(values).unique())
+        codes = codes[codes >= 0]
+        if len(codes) == 1:
+            return self.order[self.offsets[codes[0]]:self.offsets[codes[0]+1]]
+        starts = self.offsets[codes]
+        lengths = self.offsets[codes+1] - starts
+        #expand each [start,start+length) range without a python loop
+        idx = np.repeat(starts - np.cumsum(lengths) + lengths,lengths) + np.arange(lengths.sum())
+        return np.sort(self.order[idx])
+
+
+class TableIndexes(Logger):
+    """
+    Secondary indexes on the person_id and *_concept_id columns of the processed tables.
+    Indexes are built once (e.g. after CommonDataModel.process) or when first used,
+    and rebuilt if the table they were built for has been replaced.
+    """
+    def __init__(self):
+        self.indexes = {}
+        self._lock = threading.Lock()
+
+    def drop(self,table):
+        self.indexes.pop(table,None)
+
+    def clear(self):
+        self.indexes.clear()
+
+    def build(self,tables):
+        for table,df in tables.items():
+            if df is None:
+                continue
+            for column in [df.index.name] + list(df.columns):
+                if column is not None and is_indexed_column(column):
+                    self.get(table,column,df)
+        self.logger.debug(f"built indexes for {list(self.indexes.keys())}")
+
+    def get(self,table,column,df):
+        """
+        The index of a column of a table, or None if this column is not indexed
+        """
+        if not is_indexed_column(column):
+            return None
+        if column != df.index.name and column not in df.columns:
+            return None
+        with self._lock:
+            source,nrows,indexes = self.indexes.get(table,(None,0,{}))
+            if source is not df or nrows != len(df):
+                indexes = {}
+                self.indexes[table] = (df,len(df),indexes)
+            if column not in indexes:
+                series = df.index if column == df.index.name else df[column]
+                indexes[column] = ColumnIndex(series)
+            return indexes[column]
@@ -4,17 +4,18 @@ import numpy as np
 import json
 import copy
 import getpass
-import operator
 
 import shutil
 import threading
+import multiprocessing
 import concurrent.futures
-from time import gmtime, strftime, sleep, time
+from time import gmtime, strftime, time
 
 from .operations import OperationTools
 from carrot.tools.logger import Logger
 from carrot.tools.profiling import Profiler
 from carrot.tools.metrics import Metrics
+from carrot.tools.tracing import Tracer, set_tracer, nbytes
 import carrot.tools
 from carrot.io import DataCollection
 
@@ -22,6 +23,12 @@ from carrot import __version__ as carrot_version
 from .objects import DestinationTable, FormatterLevel
 from .objects import get_cdm_class, get_cdm_decorator
 from .decorators import load_file, analysis
+from .view import CDMView, evaluate
+from .index import TableIndexes
+from .snapshot import SharedTables, attach_tables, save_snapshot
+from .checkpoint import Checkpoint, CannotResume
+from .backend import Backend
+from .polars import PolarsBackend
 
 class BadInputObject(Exception):
     pass
@@ -48,6 +55,30 @@ class CommonDataModel(Logger):
         cdm._load_inputs(inputs)
         return cdm
 
+    @classmethod
+    def from_tables(cls,tables,**kwargs):
+        """
+        Create a model from already processed tables, e.g. a snapshot or tables in shared memory
+        """
+        default_kwargs = {'save_files':False,'do_mask_person_id':False,'format_level':0}
+        default_kwargs.update(kwargs)
+        cdm = cls(**default_kwargs)
+        for name,df in tables.items():
+            cdm[name] = df
+        return cdm
+
+    @classmethod
+    def from_sql(cls,backend,**kwargs):
+        """
+        Create a model for analyses over CDM outputs registered with an SqlBackend,
+        filters are run by the sql engine rather than in memory
+        """
+        default_kwargs = {'save_files':False,'do_mask_person_id':False,'format_level':0}
+        default_kwargs.update(kwargs)
+        cdm = cls(**default_kwargs)
+        cdm.sql = backend
+        return cdm
+
     @classmethod
     def from_rules(cls,rules,**kwargs):
         cdm = cls(**kwargs)
@@ -60,10 +91,12 @@ class CommonDataModel(Logger):
                  save_files=True,
                  inputs=None,
                  use_profiler=False,
+                 trace=False,
                  format_level=None,
                  do_mask_person_id=True,
                  drop_duplicates=True,
-                 automatically_fill_missing_columns=True):
+                 automatically_fill_missing_columns=True,
+                 backend=None):
         """
         CommonDataModel class initialisation
         Args:
@@ -75,6 +108,10 @@ class CommonDataModel(Logger):
                                         or can be a DataCollection object
             use_profiler (bool): Turn on/off profiling of the CPU/Memory of running the current process.
                                  The default is set to false.
+            trace (bool): Save a Chrome trace of the timing of each stage of processing.
+                          A summary of the timings is always saved with the meta data.
+            backend (str): How objects created from rules are executed, 'pandas' (default) or 'polars',
+                           or a Backend e.g. RulesSqlBackend
         """
         self.profiler = None
         self.metrics = Metrics("Unknown")
@@ -102,10 +139,10 @@ class CommonDataModel(Logger):
         self.outputs = outputs
         self.save_files = save_files
 
-        if use_profiler:
-            self.logger.debug(f"Turning on cpu/memory profiling")
-            self.profiler = Profiler(name=name)
-            self.profiler.start()
+        #record the timing of each stage of processing
+        self.trace = trace
+        self.tracer = Tracer(name=name,keep_events=trace)
+        set_tracer(self.tracer)
 
         #perform some checks on the input data
         if isinstance(inputs,dict):
@@ -146,6 +183,10 @@ class CommonDataModel(Logger):
         #   ....
         #}
         self.__df_map = {}
+        #secondary indexes (person_id, *_concept_id) on the processed tables
+        self.indexes = TableIndexes()
+        #optional sql engine over output files, see from_sql
+        self.sql = None
 
         #stores the invididual objects associated to this model
         # {
@@ -162,6 +203,17 @@ class CommonDataModel(Logger):
         #     ...
         # }
         self.__objects = {}
+
+        #execute the rules with polars or sql, rather than pandas
+        if backend in [None,'pandas']:
+            self.backend = None
+        elif backend == 'polars':
+            self.backend = PolarsBackend(self.inputs,format_level=self.format_level)
+        elif isinstance(backend,Backend):
+            self.backend = backend
+        else:
+            raise NotImplementedError(f"'{backend}' is not a known backend, choose from pandas or polars")
+
         #check if objects have already been registered with this class
         #via the decorator methods
 
@@ -192,6 +244,16 @@ class CommonDataModel(Logger):
             }
         }
 
+        if use_profiler:
+            self.logger.debug(f"Turning on cpu/memory profiling")
+            #samples are streamed to the logs folder as they are taken, if there is an output folder
+            fname = None
+            if self._get_output_folder():
+                date = self.logs['meta']['created_at']
+                fname = f'{self._get_logs_folder()}statistics_{date}.csv'
+            self.profiler = Profiler(name=name,fname=fname)
+            self.profiler.start()
+
     def _get_user(self):
         try:
             user = getpass.getuser()
@@ -210,9 +272,18 @@ class CommonDataModel(Logger):
 
             df = obj.get_df(force_rebuild=False)
             self[destination_table] = df.set_index(df.columns[0])
+        self.build_indexes()
+
+    def build_indexes(self):
+        """
+        Build the secondary indexes used to look up rows by person_id or concept_id,
+        otherwise they are built the first time they are needed
+        """
+        self.indexes.build({k:v for k,v in self.__df_map.items() if isinstance(v,pd.DataFrame)})
 
     def reset(self):
         self.__df_map.clear()
+        self.indexes.clear()
         [x.reset() for x in self.get_all_objects()]
         self.inputs.reset()
 
@@ -234,27 +305,49 @@ class CommonDataModel(Logger):
 
         self.logger.info(json.dumps(self.logs['meta'],indent=6))
         #self.logger.info(self.metrics.get_summary())
+        if hasattr(self,'tracer'):
+            self.logs['timing'] = self.tracer.summary()
+
         if self.outputs:
             self.outputs.write_meta(self.logs)
             self.outputs.write_tsv_summary(self.metrics.get_summary(), 'summary')
             self.outputs.finalise()
 
+        #the run has completed, so there is nothing to resume
+        if getattr(self,'checkpoint',None):
+            self.checkpoint.remove()
+            self.checkpoint = None
+
+        if getattr(self,'trace',False):
+            date = self.logs['meta']['created_at']
+            self.tracer.write_chrome_trace(f'{self._get_logs_folder()}trace_{date}.json')
+
         if not hasattr(self,'profiler'):
             return
         if self.profiler:
             self.profiler.stop()
-            df_profile = self.profiler.get_df()
-            f_out = self.output_folder
-            f_out = f'{f_out}{os.path.sep}logs{os.path.sep}'
-            if not os.path.exists(f'{f_out}'):
-                self.logger.info(f'making output folder {f_out}')
-                os.makedirs(f'{f_out}')
-
-            date = self.logs['meta']['created_at']
-            fname = f'{f_out}{os.path.sep}statistics_{date}.csv'
-            df_profile.to_csv(fname)
+            fname = self.profiler.fname
+            if fname is None:
+                f_out = self._get_logs_folder()
+                if not os.path.exists(f'{f_out}'):
+                    self.logger.info(f'making output folder {f_out}')
+                    os.makedirs(f'{f_out}')
+                date = self.logs['meta']['created_at']
+                fname = f'{f_out}statistics_{date}.csv'
+                self.profiler.get_df().to_csv(fname)
             self.logger.info(f"Writen the memory/cpu statistics to {fname}")
             self.logger.info("Finished")
+            self.profiler = None
+
+    def _get_output_folder(self):
+        if hasattr(self.outputs,'get_output_folder'):
+            return self.outputs.get_output_folder()
+        return None
+
+    def _get_logs_folder(self):
+        f_out = self._get_output_folder()
+        f_out = f_out if f_out else '.'
+        return f'{f_out}{os.path.sep}logs{os.path.sep}'
 
     @classmethod
     def from_existing(cls,**kwargs):
@@ -303,6 +396,9 @@ class CommonDataModel(Logger):
             pandas.DataFrame if a processed object is found, otherwise returns None
         """
         if key not in self.__df_map.keys():
+            if self.sql is not None and key in self.sql.tables():
+                self.logger.warning(f"loading the whole of {key} from {self.sql.engine}, use filter to only load what is needed")
+                return self.sql.table(key)
             return None
         else:
             return self.__df_map[key]
@@ -316,6 +412,7 @@ class CommonDataModel(Logger):
         """
         self.logger.debug(f"creating {obj} for {key}")
         self.__df_map[key] = obj
+        self.indexes.drop(key)
 
     def print(self):
         for name in self.keys():
@@ -361,6 +458,8 @@ class CommonDataModel(Logger):
                 #and will be able to apply these rules to the inputs that are loaded
                 #(this is useful when chunk)
                 obj.define = lambda x,rules=rules : carrot.tools.apply_rules(x,rules,inputs=self.inputs)
+                if self.backend is not None:
+                    obj.set_backend(self.backend,rules)
 
                 #register this object with the CDM model, so it can be processed
                 self.add(obj)
@@ -379,108 +478,136 @@ class CommonDataModel(Logger):
     def run_analysis(self,f):
         return f(self)
 
-    def run_analyses(self,analyses=None,max_workers=4):
+    def save_snapshot(self,fname=None):
+        """
+        Serialise the processed tables (once), so that batch jobs running analyses
+        can load them rather than rerunning the whole ETL
+        """
+        if getattr(self,'snapshot_file',None) is not None and os.path.exists(self.snapshot_file):
+            return self.snapshot_file
+        if fname is None:
+            fname = f"carrot_snapshot_{os.getpid()}_{format(id(self),'X')}.pkl"
+        self.snapshot_file = save_snapshot({k:self[k] for k in self.keys()},fname)
+        self.logger.info(f"saved a snapshot of {list(self.keys())} to {self.snapshot_file}")
+        return self.snapshot_file
+
+    def run_analyses(self,analyses=None,max_workers=4,processes=True):
+        """
+        Run analyses in parallel, returning a map of each analysis name to
+        its result and how long it took, e.g. {'name':{'result':...,'time[s]':1.2}}.
+        With processes, the tables are placed in shared memory once and each
+        worker process attaches to them, otherwise the analyses share this model in threads.
+        Args:
+            analyses (list or dict): names of the analyses to run, or a map of name to analysis.
+                                     The default is to run all analyses added to the model.
+        """
+        if analyses is None:
+            analyses = self.__analyses
+        elif not isinstance(analyses,dict):
+            analyses = {name:self.__analyses[name] for name in analyses}
 
-        def msg(x):
-            self.logger.info(f"finished with {x}")
-            self.logger.debug(x.result())
+        #analyses submitted as batch jobs are given a snapshot of the tables,
+        #save it once here, rather than once per job
+        if any(getattr(getattr(f,'_method',f),'uses_snapshot',False) for f in analyses.values()):
+            self.save_snapshot()
 
         start = time()
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {}
-            for name,f in self.__analyses.items():
-                self.logger.info(f"Start thread for {f} ")
-                future = executor.submit(f, self)
-                future.add_done_callback(msg)
-                futures[future] = name
-
-            while True:
-                status = {futures[f]:{'status':'running' if f.running() else 'done' if f.done() else 'waiting'} for f in futures}
-                self.logger.debug(json.dumps(status,indent=6))
-                if all([f.done() for f in futures]):
-                    break
-                sleep(1)
-
-
         results = {}
-        for future in concurrent.futures.as_completed(futures):
-            _id = futures[future]
-            results[_id] = future.result()
+
+        #analyses are often closures, which cannot be pickled,
+        #so the worker processes must be forked to inherit them
+        if processes and 'fork' not in multiprocessing.get_all_start_methods():
+            self.logger.warning("cannot fork worker processes on this platform, running analyses in threads")
+            processes = False
+
+        if processes:
+            with SharedTables({k:self[k] for k in self.keys()}) as shared:
+                _analysis_worker['analyses'] = analyses
+                _analysis_worker['sql'] = self.sql
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=max_workers,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=_init_analysis_worker,
+                    initargs=(shared.descriptor,getattr(self,'snapshot_file',None)))
+                with executor:
+                    futures = {executor.submit(_run_analysis_worker,name):name for name in analyses}
+                    self._collect_analyses(futures,results)
+                _analysis_worker.clear()
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(_timed_analysis,f,self):name for name,f in analyses.items()}
+                self._collect_analyses(futures,results)
 
         end = time() - start
         self.logger.info(f"Running analyses took {end} seconds")
         return results
 
+    def _collect_analyses(self,futures,results):
+        for name in futures.values():
+            self.logger.info(f"submitted {name}")
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            results[name] = future.result()
+            self.logger.info(f"finished with {name} in {results[name]['time[s]']:.3f} seconds")
+            self.logger.debug(results[name]['result'])
+
     def find_one(self,config,cols=None,dropna=False):
-        return self.filter(config,cols,dropna).sample(frac=1).iloc[0]
+        return self.filter(config,cols,dropna).sample(n=1).iloc[0]
 
     def find(self,config,cols=None,dropna=False):
         return self.filter(config,cols,dropna)
 
-    def _filter(self,df,filters):
-        ops = {
-            '>': operator.gt,
-            '<': operator.lt,
-            '>=': operator.ge,
-            '<=': operator.le,
-            '==': operator.eq
-        }
-
+    def lookup(self,table,**kwargs):
+        """
+        Rows of a table matching exact values, using the person_id/concept_id indexes
+        Example:
+            cdm.lookup('measurement',measurement_concept_id=3020891,person_id=cohort.index)
+        """
+        view = self.view().where(table,**kwargs)
+        return self[table].iloc[view.rows(table)]
 
+    def _filter(self,df,filters):
         if not isinstance(filters,dict):
             raise NotImplementedError("filter must be a 'dict' .")
 
+        mask = np.ones(len(df),dtype=bool)
         for col,value in filters.items():
-            if isinstance(value,dict):
-                for op_str,val in value.items():
-                    df = df[ops[op_str](df[col],val)]
-            else:
-                df = df[df[col] == value]
-        return df
-
+            mask &= evaluate(df[col],value)
+        return df[mask]
 
-    def filter(self,config,cols=None,dropna=False):
-        retval = copy.deepcopy(self)
-        for table,spec in config.items():
-            df = retval[table]
+    def view(self):
+        """
+        Get a lazy view over the processed tables, to be filtered without copying any data
+        """
+        tables = {}
+        for table,df in self.__df_map.items():
             if isinstance(df,DestinationTable):
                 df = df.get_df()
-            for col,func in spec.items():
-                df = df[df[col].apply(func)]
+            tables[table] = df
+        return CDMView(tables,indexes=self.indexes)
 
-            retval[table] = df
-
-        if dropna:
-            retval = retval.dropna(axis=1)
+    def filter(self,config,cols=None,dropna=False):
+        """
+        Filter the processed tables, joining them on person_id
+        Args:
+            config (dict): filters for each table e.g. {'person':{'gender_concept_id':8507},
+                                                         'measurement':{'value_as_number':{'>':10}}}
+                           a filter can be a value, a list of values, a dict of comparisons or a callable
+            cols (dict or list): columns to keep
+            dropna (bool): drop columns that are all null
+        Returns:
+            pandas.DataFrame: the selected rows and columns
+        """
+        if self.sql is not None:
+            return self.sql.filter(config,cols,dropna)
+        view = self.view()
+        for table,spec in config.items():
+            view = view.where(table)
+            for col,predicate in spec.items():
+                view = view.where(table,col,predicate)
         if cols is not None:
-            index = retval.index.name
-            retval = retval.reset_index()
-            retval = retval[[col for col,keep in cols.items() if keep]]
-            if index in retval.columns:
-                retval = retval.set_index(index)
-
-        return retval
-
-
-        # for obj in config:
-        #     if isinstance(obj,str):
-        #         df = self[obj].get_df()
-        #         if df.index.name != 'person_id':
-        #             df = df.set_index('person_id')
-        #     elif isinstance(obj,dict):
-        #         for key,value in obj.items():
-        #             print (self[key])
-        #             df = self[key]
-        #             df = self._filter(df,value)
-        #             if df.index.name != 'person_id':
-        #                 df = df.set_index('person_id')
-        #             if retval is None:
-        #                 retval = df
-        #             else:
-        #                 retval = retval.merge(df,left_index=True,right_index=True)
-        #     else:
-        #         raise NotImplementedError("need to pass a json object to filter()")
+            view = view.select(cols)
+        return view.to_df(dropna=dropna)
 
 
     def get_all_objects(self):
@@ -549,7 +676,7 @@ class CommonDataModel(Logger):
             #if masker has not been defined, define it
             if destination_table == 'person':
                 if self.person_id_masker is not None:
-                    start_index = int(list(self.person_id_masker.values())[-1]) + 1
+                    start_index = max(int(x) for x in self.person_id_masker.values()) + 1
                     new = False
                 else:
                     self.person_id_masker = {}
@@ -632,7 +759,72 @@ class CommonDataModel(Logger):
         return self.__objects
 
 
-    def process(self,object_list=None,conserve_memory=False):
+    def _get_fingerprint(self):
+        #what a checkpoint is only valid for: the same objects, input files and chunking
+        objects = {
+            table:sorted(objs.keys())
+            for table,objs in self.__objects.items()
+        }
+        files = {}
+        for key,brick in self.inputs.items():
+            files[key] = [
+                (os.path.realpath(fname),os.stat(fname).st_size,os.stat(fname).st_mtime_ns)
+                for fname in brick.get_source_files()
+            ]
+        return {'objects':objects,'inputs':files,'chunksize':self.inputs.chunksize}
+
+    def _get_checkpoint(self):
+        """
+        A checkpoint is kept while processing chunked inputs that are saved to files, if the outputs support it
+        """
+        if not self.save_files or not self.outputs or not self.inputs:
+            return None
+        if self.inputs.chunksize is None:
+            return None
+        try:
+            self.outputs.get_checkpoint([])
+        except NotImplementedError:
+            self.logger.warning(f"checkpoints are not supported by {type(self.outputs).__name__}, "
+                                "an interrupted run cannot be resumed")
+            return None
+        return Checkpoint(f'{self._get_output_folder()}{os.path.sep}.checkpoint')
+
+    def _save_checkpoint(self,fingerprint,table,chunk,tables_done):
+        state = {
+            'fingerprint':fingerprint,
+            'table':table,
+            'chunk':chunk,
+            'tables_done':tables_done,
+            #where the next chunk of each input starts
+            'inputs':self.inputs.get_positions(),
+            'chunksize':self.inputs.chunksize,
+            'outputs':self.outputs.get_checkpoint(self.execution_order+['person_ids']),
+            'logs':self.logs,
+            'metrics':self.metrics
+        }
+        with self.tracer.span('checkpoint',table=table):
+            self.checkpoint.save(state,self.person_id_masker)
+
+    def _resume(self,fingerprint):
+        """
+        Restore the state of an interrupted run from its checkpoint, returns the state
+        """
+        state,masker = self.checkpoint.load()
+        for key,value in fingerprint.items():
+            if state['fingerprint'][key] != value:
+                raise CannotResume(f"cannot resume from {self.checkpoint.fname}, '{key}' has changed since it was saved")
+
+        self.logger.warning(f"resuming from {state['table']} chunk {state['chunk']}, "
+                            f"having completed {state['tables_done']}")
+        self.logs = state['logs']
+        self.metrics = state['metrics']
+        self.person_id_masker = masker
+        self.inputs.chunksize = state['chunksize']
+        #remove anything written after the checkpoint was saved
+        self.outputs.rollback(state['outputs'],self.execution_order+['person_ids'])
+        return state
+
+    def process(self,object_list=None,conserve_memory=False,resume=False):
         """
         Process chunked data, processes as follows
         * While the chunking of is not yet finished
@@ -642,15 +834,37 @@ class CommonDataModel(Logger):
         * For the current chunk slice, save the data/logs to files
         * Retrieve the next chunk of data
 
+        When chunked data is saved to files, a checkpoint is saved after each chunk,
+        with resume=True an interrupted run continues from the last chunk completed.
         """
         self.execution_order = self.get_execution_order()
         self.logger.info(f"Starting processing in order: {self.execution_order}")
         self.count_objects()
 
+        self.checkpoint = self._get_checkpoint()
+        state = None
+        if self.checkpoint:
+            fingerprint = self._get_fingerprint()
+            if resume and self.checkpoint.exists():
+                state = self._resume(fingerprint)
+            elif resume:
+                self.logger.warning(f"no checkpoint found in {self._get_output_folder()}, starting from the beginning")
+        elif resume:
+            raise CannotResume("can only resume chunked runs that save their outputs to files")
+        tables_done = list(state['tables_done']) if state else []
+
         for destination_table in self.execution_order:
+            if destination_table in tables_done:
+                continue
             first = True
             i = 0
+            if state and destination_table == state['table']:
+                #carry on from the chunk after the last one saved
+                self.inputs.seek(state['inputs'])
+                first = False
+                i = state['chunk'] + 1
             while True:
+                self.tracer.chunk = i
                 df_generator = self.process_table(destination_table,object_list=object_list)
                 ntables = 0
                 nrows = 0
@@ -662,7 +876,7 @@ class CommonDataModel(Logger):
                     nrows += len(df)
                     if conserve_memory and self.save_files:
                         mode = None if first else 'a'
-                        self.save_dataframe(destination_table,df,mode=mode)
+                        self.save_dataframe(destination_table,df,mode=mode,name=obj.name)
                         first = False
                         obj.clear()
                         del df
@@ -675,9 +889,11 @@ class CommonDataModel(Logger):
                     if self.save_files:
                         if self.drop_duplicates and destination_table != 'person':
                             nbefore = len(df)
-                            df_hash = pd.util.hash_pandas_object(df.drop(df.columns[0],axis=1),index=False)
-                            df_temp = df[df_hash.duplicated(keep=False)].head(10).dropna(axis=1)
-                            df = df[~df_hash.duplicated()]
+                            with self.tracer.span('dedup',table=destination_table,rows_in=nbefore) as span:
+                                df_hash = pd.util.hash_pandas_object(df.drop(df.columns[0],axis=1),index=False)
+                                df_temp = df[df_hash.duplicated(keep=False)].head(10).dropna(axis=1)
+                                df = df[~df_hash.duplicated()]
+                                span.set(rows_out=len(df))
                             nafter = len(df)
                             ndiff = nbefore - nafter
                             if ndiff>0:
@@ -711,19 +927,23 @@ class CommonDataModel(Logger):
                         self.inputs.next()
                     except StopIteration:
                         break
+                    if self.checkpoint:
+                        self._save_checkpoint(fingerprint,destination_table,i-1,tables_done)
                 else:
                     break
 
-
+            tables_done.append(destination_table)
+            if self.checkpoint:
+                self._save_checkpoint(fingerprint,destination_table,i-1,tables_done)
 
             #if inputs are defined, and we havent just finished the last table,
             #reset the inputs
             if self.inputs and not destination_table == self.execution_order[-1]:
                 self.inputs.reset()
 
-        #for destination_table in self.execution_order:
-        #    index = self.get_start_index(destination_table)
-        #    print (index)
+        #tables kept for analyses, rather than saved chunk by chunk, are indexed once here
+        if not conserve_memory and not self.save_files:
+            self.build_indexes()
 
 
     def process_simult(self,object_list=None,conserve_memory=False):
@@ -735,6 +955,7 @@ class CommonDataModel(Logger):
         self.count_objects()
         i=0
         while True:
+            self.tracer.chunk = i
             for destination_table in self.execution_order:
                 df_generator = self.process_table(destination_table,object_list=object_list)
                 ntables = 0
@@ -747,7 +968,7 @@ class CommonDataModel(Logger):
                     nrows += len(df)
                     if self.save_files:
                         mode = None if j==0 else 'a'
-                        self.save_dataframe(destination_table,df,mode=mode)
+                        self.save_dataframe(destination_table,df,mode=mode,name=obj.name)
                         first = False
                     if not conserve_memory:
                         dfs.append(df)
@@ -820,6 +1041,12 @@ class CommonDataModel(Logger):
 
         nrows_processed = self.logs['meta']['total_data_processed'][destination_table]
 
+        #run the plans of all the objects together
+        backend_objects = [obj for obj in objects if obj.get_backend() is not None]
+        if backend_objects:
+            with self.tracer.span('collect',table=destination_table):
+                backend_objects[0].get_backend().collect(backend_objects)
+
         for i,obj in enumerate(objects):
             self.logger.info(f"starting on {obj.name}")
 
@@ -843,7 +1070,9 @@ class CommonDataModel(Logger):
                 continue
 
             if self.do_mask_person_id:
-                df = self.mask_person_id(df,destination_table)
+                with self.tracer.span('mask',table=destination_table,object=obj.name,rows_in=len(df)) as span:
+                    df = self.mask_person_id(df,destination_table)
+                    span.set(rows_out=len(df))
 
             obj._meta.update(df.attrs)
             nrows_processed += len(df)
@@ -857,11 +1086,12 @@ class CommonDataModel(Logger):
             obj.set_df(df)
             yield obj
 
-    def save_dataframe(self,table,df=None,mode=None):
+    def save_dataframe(self,table,df=None,mode=None,name=None):
         if self.outputs:
             _id = hex(id(df))
             self.logger.info(f"saving dataframe ({_id}) to {self.outputs}")
-            self.outputs.write(table,df,mode)
+            with self.tracer.span('write',table=table,object=name,rows_in=len(df),rows_out=len(df),bytes=nbytes(df)):
+                self.outputs.write(table,df,mode)
         else:
             self.logger.info(f"called save_dateframe but outputs are not defined. save_files: {self.save_files}")
 
@@ -901,3 +1131,33 @@ class CommonDataModel(Logger):
                 self.logger.error(f"trying to set index '{index}' on dataset '{key}', but this index is not in the columns! something really wrong!")
                 continue
             self.inputs[key].index = self.inputs[key][index].rename('index')
+
+        #keep the indexing for the chunks still to be read
+        self.inputs.set_index_map(index_map)
+        if self.inputs.chunksize is not None and not self.inputs.aligned:
+            self.logger.warning("the inputs are chunked, so rules using data from different input tables "
+                                "can only be matched within a chunk, co-partition the inputs (see carrot.io.copartition) "
+                                "to keep all the rows of a person in the same chunk")
+
+
+#state of an analysis worker process,
+#the analyses are set before the pool is forked, the model when the worker starts
+_analysis_worker = {}
+
+def _init_analysis_worker(descriptor,snapshot_file):
+    blocks = []
+    tables = attach_tables(descriptor,blocks)
+    model = CommonDataModel.from_tables(tables,name='worker')
+    model.snapshot_file = snapshot_file
+    #connections are reopened by the worker when first used
+    model.sql = _analysis_worker.get('sql')
+    _analysis_worker['blocks'] = blocks
+    _analysis_worker['model'] = model
+
+def _run_analysis_worker(name):
+    return _timed_analysis(_analysis_worker['analyses'][name],_analysis_worker['model'])
+
+def _timed_analysis(f,model):
+    start = time()
+    result = f(model)
+    return {'result':result,'time[s]':time()-start,'pid':os.getpid()}
@@ -1,54 +1,63 @@
-import carrot 
+import carrot
 import importlib
 import inspect
 
 __default_cdm_version = '5.3.1'
-if 'cdm' in carrot.params:
-    __cdm_version = carrot.params['cdm']
-else:
-    __cdm_version = __default_cdm_version
-
-__cdm_version_split = '_'.join(__cdm_version.split('.'))
-
-try:
-    __cdm_tables = importlib.import_module(f'carrot.cdm.objects.versions.v{__cdm_version_split}')
-except ModuleNotFoundError as e:
-    raise ModuleNotFoundError(f'Cannot find CDM version {__cdm_version}, this does not exist in this package!') from e
-
-__cdm_tables = {
-    m[0]:getattr(__cdm_tables,m[0])
-    for m in inspect.getmembers(
-            __cdm_tables,
-            inspect.isclass)
-}
-
-
-__cdm_object_map = {
-    obj.name : obj
-    for obj in __cdm_tables.values()
-}
-def get_cdm_tables():
-    return __cdm_object_map
-
-import sys
-this = sys.modules[__name__]
-
-for name,_class in __cdm_tables.items():
-    setattr(this,name,_class)
 
-from .. import decorators
+#the classes for the CDM version are only imported when first needed,
+#so the version can still be changed (carrot.params['cdm']) after carrot has been imported
+_cdm_tables = None
+_cdm_object_map = None
+_cdm_decorator_map = None
+
+def _load_cdm_tables():
+    global _cdm_tables,_cdm_object_map
+    if _cdm_tables is not None:
+        return _cdm_tables
+
+    cdm_version = carrot.params.get('cdm',__default_cdm_version)
+    cdm_version_split = '_'.join(cdm_version.split('.'))
+    try:
+        module = importlib.import_module(f'carrot.cdm.objects.versions.v{cdm_version_split}')
+    except ModuleNotFoundError as e:
+        raise ModuleNotFoundError(f'Cannot find CDM version {cdm_version}, this does not exist in this package!') from e
+
+    tables = {
+        m[0]:m[1]
+        for m in inspect.getmembers(
+                module,
+                inspect.isclass)
+    }
+    _cdm_object_map = {
+        obj.name : obj
+        for obj in tables.values()
+    }
+    globals().update(tables)
+    _cdm_tables = tables
+    return _cdm_tables
+
+def __getattr__(name):
+    tables = _load_cdm_tables()
+    if name in tables:
+        return tables[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-__cdm_decorator_map = {
-    name.replace("define_",""):getattr(decorators,name)
-    for name in dir(decorators)
-    if 'define' in name
-}
+def get_cdm_tables():
+    _load_cdm_tables()
+    return _cdm_object_map
 
 def get_cdm_decorator(key):
-    return __cdm_decorator_map[key]
+    global _cdm_decorator_map
+    if _cdm_decorator_map is None:
+        from .. import decorators
+        _cdm_decorator_map = {
+            name.replace("define_",""):getattr(decorators,name)
+            for name in dir(decorators)
+            if 'define' in name
+        }
+    return _cdm_decorator_map[key]
 
 def get_cdm_class(key):
-    return __cdm_object_map[key]
+    return get_cdm_tables()[key]
 
 from .common import DestinationTable, DataFormatter, FormatterLevel
-
@@ -7,6 +7,7 @@ import collections
 from enum import Enum
 from carrot.cdm.operations import OperationTools
 from carrot.tools.logger import Logger
+from carrot.tools.tracing import get_tracer, nbytes
 
 class RequiredFieldIsNone(Exception):
     pass
@@ -199,6 +200,9 @@ class DestinationTable(Logger):
         
         self.automatically_fill_missing_columns = True
         self.tools = OperationTools()
+        #executes the rules instead of define, see set_backend
+        self.__backend = None
+        self.__rules = None
 
 
     def get_field_names(self):
@@ -291,6 +295,19 @@ class DestinationTable(Logger):
         """
         return list(self.fields)
 
+    def set_backend(self,backend,rules):
+        """
+        Build the dataframe by executing the rules with a backend (e.g. PolarsBackend), rather than with define
+        """
+        self.__backend = backend
+        self.__rules = rules
+
+    def get_backend(self):
+        return self.__backend
+
+    def get_rules(self):
+        return self.__rules
+
     def update(self,that):
         #extract all objects from the passed object
         objs = {k:v for k,v in that.__dict__.items() if k!='logger' }
@@ -326,7 +343,20 @@ class DestinationTable(Logger):
             else:
                 return self.__df
 
-        self.define(self)
+        tracer = get_tracer()
+        if self.__backend is not None:
+            with tracer.span('plan',table=self._type,object=self.name) as span:
+                df = self.__backend.get_df(self,**kwargs)
+                span.set(rows_out=len(df),bytes=nbytes(df))
+            if dropna:
+                df = df.dropna(axis=1)
+            self.__df = df
+            self.set_df_name()
+            self.logger.info(f"created df ({hex(id(df))})[{self.get_df_name()}]")
+            return self.__df
+
+        with tracer.span('define',table=self._type,object=self.name):
+            self.define(self)
 
         #get a dict of all series
         #each object is a pandas series
@@ -378,8 +408,12 @@ class DestinationTable(Logger):
         #simply order the columns 
         df = df[self.fields]
 
-        df = self.finalise(df,**kwargs)
-        df = self.format(df)
+        with tracer.span('finalise',table=self._type,object=self.name,rows_in=len(df)) as span:
+            df = self.finalise(df,**kwargs)
+            span.set(rows_out=len(df))
+        with tracer.span('format',table=self._type,object=self.name,rows_in=len(df)) as span:
+            df = self.format(df)
+            span.set(rows_out=len(df),bytes=nbytes(df))
                     
         if dropna:
             df = df.dropna(axis=1)
@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+try:
+    import polars as pl
+except ImportError:
+    #optional, the default pandas backend is used if polars is not installed
+    pl = None
+
+from carrot.tools.rules_helpers import get_source_table, get_source_field
+from .objects.common import FormatterLevel
+from .backend import Backend
+
+_TIMESTAMP = '%Y-%m-%d %H:%M:%S%.6f'
+_DATE = '%Y-%m-%d'
+
+
+def _to_text(expr):
+    return expr.cast(pl.Utf8)
+
+def _to_datetime(expr):
+    return _to_text(expr).str.strip_chars().str.to_datetime(strict=False)
+
+def _to_numeric(expr):
+    #integers are cast directly so large values keep their precision
+    expr = _to_text(expr).str.strip_chars()
+    return pl.coalesce(expr.cast(pl.Int64,strict=False),
+                       expr.cast(pl.Float64,strict=False))
+
+#polars versions of the OperationTools, others are applied to a pandas series
+_operations = {
+    'get_datetime':lambda x: _to_datetime(x).dt.to_string(_TIMESTAMP),
+    'get_date':lambda x: _to_datetime(x).dt.to_string(_DATE),
+    'get_year':lambda x: _to_datetime(x).dt.year(),
+    'get_month':lambda x: _to_datetime(x).dt.month(),
+    'get_day':lambda x: _to_datetime(x).dt.day()
+}
+
+#polars versions of the DataFormatter
+_formatters = {
+    'Integer':lambda x: _to_numeric(x).cast(pl.Int64,strict=False),
+    'Float':lambda x: _to_numeric(x).cast(pl.Float64,strict=False),
+    'Text20':lambda x: _to_text(x).fill_null('').str.slice(0,20),
+    'Text50':lambda x: _to_text(x).fill_null('').str.slice(0,50),
+    'Text60':lambda x: _to_text(x).fill_null('').str.slice(0,60),
+    'Timestamp':lambda x: _to_datetime(x).dt.to_string(_TIMESTAMP),
+    'Date':lambda x: _to_datetime(x).dt.to_string(_DATE)
+}
+
+
+class PolarsBackend(Backend):
+    """
+    Execute the rules of each CDM object as a lazy polars plan, rather than with pandas:
+    the source fields are projected, operations and term mappings applied, rows without required fields dropped,
+    primary keys assigned and the columns formatted all in one plan (see Backend).
+    The plans of all objects of a destination table are collected together for each chunk (see collect),
+    so they are optimised together and run on the polars thread pool (POLARS_MAX_THREADS).
+    The result of each object is a pandas dataframe, as made by DestinationTable.get_df
+    """
+    name = 'polars'
+
+    def __init__(self,inputs,format_level=FormatterLevel.ON):
+        if pl is None:
+            raise ImportError("You are trying to use the polars backend, "
+                              "but the package 'polars' hasn't been installed. pip install polars pyarrow")
+        super().__init__(format_level)
+        self.inputs = inputs
+        self.__sources = {}
+        self.__results = {}
+
+    def get_source(self,name,fields):
+        """
+        The columns of a source table as a polars dataframe, converted once per chunk
+        """
+        df = get_source_table(self.inputs,name)
+        cached = self.__sources.get(name)
+        if cached is None or cached[0] is not df:
+            cached = self.__sources[name] = (df,{})
+        columns = cached[1]
+        for field in fields:
+            if field not in columns:
+                series = get_source_field(df,field)
+                if isinstance(series.dtype,pd.CategoricalDtype):
+                    series = series.astype(object)
+                columns[field] = pl.from_pandas(series.reset_index(drop=True))
+        return pl.DataFrame([columns[field].alias(field) for field in fields])
+
+    def _get_key(self,name):
+        #what rows from different source tables are matched on, as with the pandas index
+        df = get_source_table(self.inputs,name)
+        index = getattr(self.inputs,'index_map',{}).get(name)
+        if index is not None and index in df.columns:
+            return pl.from_pandas(df[index].reset_index(drop=True)).alias('__key')
+        return pl.Series('__key',np.arange(len(df)))
+
+    def _get_expression(self,obj,destination_field,rule):
+        expr = pl.col(f"{rule['source_table']}::{rule['source_field']}")
+        for operation in rule.get('operations') or []:
+            if operation in _operations:
+                expr = _operations[operation](expr)
+            else:
+                function = obj.tools[operation]
+                expr = expr.map_batches(lambda s,f=function,name=rule['source_field']:
+                                        pl.from_pandas(f(s.to_pandas().rename(name)).astype('string')),
+                                        return_dtype=pl.Utf8)
+        term_mapping = rule.get('term_mapping')
+        if isinstance(term_mapping,dict):
+            # value level mapping
+            mapping = {str(k):str(v) for k,v in term_mapping.items()}
+            expr = _to_text(expr).replace_strict(mapping,default=None,return_dtype=pl.Utf8)
+        elif term_mapping is not None:
+            # field level mapping
+            expr = pl.lit(str(term_mapping),dtype=pl.Utf8)
+        return expr.alias(destination_field)
+
+    def get_plan(self,obj):
+        """
+        Build the lazy plans for an object, returns the plan of the output rows and
+        the plans counting the rows kept by requiring each field to be filled, before and after formatting
+        """
+        rules = obj.get_rules()
+        obj._meta['source_files'] = {}
+        tables = {}
+        for destination_field,rule in rules.items():
+            tables.setdefault(rule['source_table'],[])
+            if rule['source_field'] not in tables[rule['source_table']]:
+                tables[rule['source_table']].append(rule['source_field'])
+            obj._meta['source_files'][destination_field] = {'table':rule['source_table'],'field':rule['source_field']}
+
+        lf = None
+        for name,fields in tables.items():
+            df = self.get_source(name,fields)
+            df = df.rename({field:f'{name}::{field}' for field in fields})
+            if len(tables) > 1:
+                df = df.with_columns(self._get_key(name))
+            lf = df.lazy() if lf is None else lf.join(df.lazy(),on='__key',how='full',coalesce=True)
+
+        exprs = [
+            self._get_expression(obj,field,rules[field]) if field in rules
+            else pl.lit(None,dtype=pl.Utf8).alias(field)
+            for field in obj.fields
+        ]
+        lf = lf.select(exprs)
+
+        def count(lf,fields):
+            #the number of rows, then the rows left after requiring each field in turn
+            masks = [pl.col(field).is_not_null() for field in fields]
+            return lf.select([pl.len().alias('__rows')] +
+                             [pl.all_horizontal(masks[:i+1]).sum().alias(field) for i,field in enumerate(fields)])
+
+        #finalise: drop rows without the required fields, and number the rows for the primary key
+        required = self.get_required(obj)
+        counts = [count(lf,required)]
+        if required:
+            lf = lf.filter(pl.all_horizontal([pl.col(field).is_not_null() for field in required]))
+        if self.is_numbered(obj):
+            lf = lf.with_columns(pl.int_range(pl.len(),dtype=pl.Int64).alias(obj.fields[0]))
+
+        #format the columns that have been mapped, apart from the primary key and person_id
+        formatted = self.get_formatted(obj)
+        if self.format_level is FormatterLevel.ON:
+            lf = lf.with_columns([_formatters[obj[field].dtype](pl.col(field)).alias(field)
+                                  for field in formatted])
+            required = [field for field in formatted if field in obj.required_fields]
+            counts.append(count(lf,required))
+            if required:
+                lf = lf.filter(pl.all_horizontal([pl.col(field).is_not_null() for field in required]))
+        return [lf] + counts
+
+    def collect(self,objects):
+        """
+        Run the plans of many objects together, keeping the results for get_df
+        """
+        plans = {id(obj):self.get_plan(obj) for obj in objects}
+        if not plans:
+            return
+        results = pl.collect_all([plan for _plans in plans.values() for plan in _plans])
+        i = 0
+        for key,_plans in plans.items():
+            self.__results[key] = results[i:i+len(_plans)]
+            i += len(_plans)
+        self.logger.debug(f"collected the plans of {len(plans)} objects")
+
+    def get_df(self,obj,start_index=1,**kwargs):
+        """
+        The output dataframe of an object, from its collected plan, or running its plan now
+        """
+        results = self.__results.pop(id(obj),None)
+        if results is None:
+            results = pl.collect_all(self.get_plan(obj))
+        df,counts = results[0],results[1:]
+        self.set_meta(obj,counts[0].row(0,named=True),'after')
+        if len(counts) > 1:
+            self.set_meta(obj,counts[1].row(0,named=True),'after_formatting')
+        return self.to_cdm(obj,df.to_pandas(),start_index)
+
+    def clear(self):
+        self.__sources.clear()
+        self.__results.clear()
@@ -0,0 +1,290 @@
+import os
+import json
+import sqlite3
+import tempfile
+import pandas as pd
+try:
+    import duckdb
+except ImportError:
+    #optional, sqlite is used if duckdb is not installed
+    duckdb = None
+
+from carrot.io.compression import open_input, get_compression
+from .objects.common import FormatterLevel
+from .backend import Backend
+from .sql import _quote
+
+
+def _literal(value):
+    return "'" + str(value).replace("'","''") + "'"
+
+def _trim(x):
+    return f"trim(CAST({x} AS TEXT))"
+
+def _is_number(x):
+    x = _trim(x)
+    return f"({x} <> '' AND {x} NOT GLOB '*[^0-9.eE+-]*' AND {x} GLOB '*[0-9]*')"
+
+#how each operation and formatter (see OperationTools and DataFormatter) is written in each sql dialect
+_sqlite = {
+    #sqlite times are to the millisecond, SS.SSS
+    'datetime':lambda x: f"strftime('%Y-%m-%d %H:%M:%f',{_trim(x)}) || '000'",
+    'date':lambda x: f"date({_trim(x)})",
+    'year':lambda x: f"CAST(strftime('%Y',{_trim(x)}) AS INTEGER)",
+    'month':lambda x: f"CAST(strftime('%m',{_trim(x)}) AS INTEGER)",
+    'day':lambda x: f"CAST(strftime('%d',{_trim(x)}) AS INTEGER)",
+    #digits are cast directly, so large integers keep their precision
+    'integer':lambda x: f"CASE WHEN {_trim(x)} GLOB '[0-9]*' AND {_trim(x)} NOT GLOB '*[^0-9]*' THEN CAST({_trim(x)} AS INTEGER) "
+                        f"WHEN {_is_number(x)} THEN CAST(CAST({_trim(x)} AS REAL) AS INTEGER) END",
+    'float':lambda x: f"CASE WHEN {_is_number(x)} THEN CAST({_trim(x)} AS REAL) END",
+    'text':lambda x,n: f"substr(COALESCE(CAST({x} AS TEXT),''),1,{n})"
+}
+
+_duckdb = {
+    'datetime':lambda x: f"strftime(TRY_CAST(trim(CAST({x} AS VARCHAR)) AS TIMESTAMP),'%Y-%m-%d %H:%M:%S.%f')",
+    'date':lambda x: f"strftime(TRY_CAST(trim(CAST({x} AS VARCHAR)) AS TIMESTAMP),'%Y-%m-%d')",
+    'year':lambda x: f"year(TRY_CAST(trim(CAST({x} AS VARCHAR)) AS TIMESTAMP))",
+    'month':lambda x: f"month(TRY_CAST(trim(CAST({x} AS VARCHAR)) AS TIMESTAMP))",
+    'day':lambda x: f"day(TRY_CAST(trim(CAST({x} AS VARCHAR)) AS TIMESTAMP))",
+    'integer':lambda x: f"COALESCE(TRY_CAST(trim(CAST({x} AS VARCHAR)) AS BIGINT),"
+                        f"TRY_CAST(TRY_CAST(trim(CAST({x} AS VARCHAR)) AS DOUBLE) AS BIGINT))",
+    'float':lambda x: f"TRY_CAST(trim(CAST({x} AS VARCHAR)) AS DOUBLE)",
+    'text':lambda x,n: f"substr(COALESCE(CAST({x} AS VARCHAR),''),1,{n})"
+}
+
+_operations = {
+    'get_datetime':'datetime',
+    'get_date':'date',
+    'get_year':'year',
+    'get_month':'month',
+    'get_day':'day'
+}
+
+_formatters = {
+    'Integer':lambda d,x: d['integer'](x),
+    'Float':lambda d,x: d['float'](x),
+    'Text20':lambda d,x: d['text'](x,20),
+    'Text50':lambda d,x: d['text'](x,50),
+    'Text60':lambda d,x: d['text'](x,60),
+    'Timestamp':lambda d,x: d['datetime'](x),
+    'Date':lambda d,x: d['date'](x)
+}
+
+
+class RulesSqlBackend(Backend):
+    """
+    Compile the rules of each CDM object into sql, run by an embedded engine over the input files (see Backend):
+    * duckdb: the files are scanned (in parallel) into tables with read_csv
+    * sqlite: the files are streamed in chunks into a database file
+    Value level term mappings are loaded as tables, and joined to the source table.
+    Each object is a single query over the whole of its source table, so the inputs are not chunked.
+    Fields can only be mapped from one source table per object, and only the operations with sql versions can be used.
+    Date parsing follows the engine, e.g. sqlite only parses ISO 8601 dates and times.
+    """
+    name = 'sql'
+
+    def __init__(self,inputs,fields=None,engine=None,database=None,format_level=FormatterLevel.ON,
+                 sep=',',na_values=[''],chunksize=100000):
+        """
+        Args:
+            inputs (dict): a map between the source table name and its file, or files if split into parts
+            fields (dict): [optional] only load these fields of each source table, e.g. those used by the rules
+        """
+        super().__init__(format_level)
+        if engine is None:
+            engine = 'duckdb' if duckdb is not None else 'sqlite'
+        if engine == 'duckdb' and duckdb is None:
+            raise ImportError("You are trying to use the duckdb engine, "
+                              "but the package 'duckdb' hasn't been installed. pip install duckdb")
+        if engine not in ['duckdb','sqlite']:
+            raise NotImplementedError(f"'{engine}' is not a known sql engine, choose from duckdb or sqlite")
+        self.engine = engine
+        self.dialect = _duckdb if engine == 'duckdb' else _sqlite
+
+        self._tmp = None
+        if database is None and engine == 'sqlite':
+            fd,database = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+            self._tmp = database
+        self.database = database
+        if engine == 'sqlite':
+            self.conn = sqlite3.connect(database)
+        else:
+            self.conn = duckdb.connect(database or ':memory:')
+
+        self.inputs = {name:[files] if isinstance(files,str) else list(files) for name,files in inputs.items()}
+        self.fields = fields or {}
+        self.sep = sep
+        self.na_values = na_values
+        self.chunksize = chunksize
+        self.__loaded = set()
+        self.__term_maps = {}
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self._tmp is not None and os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+    def query(self,sql):
+        if self.engine == 'sqlite':
+            return pd.read_sql_query(sql,self.conn)
+        return self.conn.execute(sql).df()
+
+    def load(self,name):
+        """
+        Load a source table into the engine, when first used
+        """
+        if name in self.__loaded:
+            return
+        if name not in self.inputs:
+            raise KeyError(f"Cannot find {name} in inputs. Options are {list(self.inputs.keys())}")
+        files = self.inputs[name]
+        fields = self.fields.get(name)
+        table = _quote(name)
+        if self.engine == 'duckdb':
+            fnames = '[' + ','.join(_literal(f) for f in files) + ']'
+            columns = ', '.join(_quote(f) for f in fields) if fields else '*'
+            self.conn.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT {columns} FROM "
+                              f"read_csv({fnames},delim={_literal(self.sep)},header=true,all_varchar=true)")
+        else:
+            self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+            source = open_input(files) if len(files) > 1 or get_compression(files[0]) else files[0]
+            chunks = pd.read_csv(source,sep=self.sep,dtype=str,keep_default_na=False,
+                                 na_values=self.na_values,usecols=fields,chunksize=self.chunksize)
+            nrows = 0
+            for df in chunks:
+                df.to_sql(name,self.conn,if_exists='append',index=False)
+                nrows += len(df)
+            if nrows == 0:
+                df.to_sql(name,self.conn,if_exists='replace',index=False)
+            if not isinstance(source,str):
+                source.close()
+            self.conn.commit()
+        self.__loaded.add(name)
+        self.logger.info(f"loaded {name} into {self.engine}")
+
+    def get_term_map(self,term_mapping):
+        """
+        The table holding a value level term mapping, identical mappings share a table
+        """
+        key = json.dumps({str(k):str(v) for k,v in term_mapping.items()},sort_keys=True)
+        if key not in self.__term_maps:
+            name = f'_carrot_term_map_{len(self.__term_maps)}'
+            df = pd.DataFrame({'source_value':[str(k) for k in term_mapping.keys()],
+                               'concept_id':[str(v) for v in term_mapping.values()]})
+            if self.engine == 'duckdb':
+                self.conn.register('_carrot_df',df)
+                self.conn.execute(f"CREATE OR REPLACE TABLE {name} AS SELECT * FROM _carrot_df")
+                self.conn.unregister('_carrot_df')
+            else:
+                df.to_sql(name,self.conn,if_exists='replace',index=False)
+                self.conn.execute(f"CREATE UNIQUE INDEX ix{name} ON {name} (source_value)")
+                self.conn.commit()
+            self.__term_maps[key] = name
+        return self.__term_maps[key]
+
+    def compile(self,obj):
+        """
+        Compile the rules of an object into sql, returns the statements to run in order as (kind,sql):
+        * 'table': a temporary table of the rows mapped, then of the rows kept and formatted
+        * 'count': the rows kept by requiring each field to be filled, before and after formatting
+        * 'select': the output rows
+        Only the mapped fields (and a numbered primary key) are selected, the others are left empty by to_cdm
+        """
+        rules = obj.get_rules()
+        tables = set(rule['source_table'] for rule in rules.values())
+        if len(tables) != 1:
+            raise NotImplementedError(f"{obj.name} maps fields from the source tables {sorted(tables)}, "
+                                      "the sql backend can only map from one source table per object")
+        table = tables.pop()
+        self.load(table)
+
+        obj._meta['source_files'] = {}
+        joins = {}
+        exprs = []
+        for field in obj.fields:
+            if field not in rules:
+                continue
+            rule = rules[field]
+            obj._meta['source_files'][field] = {'table':rule['source_table'],'field':rule['source_field']}
+            expr = f"s.{_quote(rule['source_field'])}"
+            for operation in rule.get('operations') or []:
+                if operation not in _operations:
+                    raise NotImplementedError(f"the operation '{operation}' used by {obj.name} cannot be run by the sql backend")
+                expr = self.dialect[_operations[operation]](expr)
+            term_mapping = rule.get('term_mapping')
+            if isinstance(term_mapping,dict):
+                # value level mapping, fields with the same mapping of the same values share a join
+                term_map = self.get_term_map(term_mapping)
+                if (term_map,expr) not in joins:
+                    alias = f"m{len(joins)}"
+                    joins[(term_map,expr)] = (alias,f"LEFT JOIN {term_map} {alias} "
+                                                    f"ON {alias}.source_value = CAST({expr} AS TEXT)")
+                expr = f"{joins[(term_map,expr)][0]}.concept_id"
+            elif term_mapping is not None:
+                # field level mapping
+                expr = _literal(term_mapping)
+            exprs.append(f"{expr} AS {_quote(field)}")
+
+        def count(table,fields):
+            #the number of rows, then the rows left after requiring each field in turn
+            sums = [f"SUM(CASE WHEN {' AND '.join(f'{_quote(f)} IS NOT NULL' for f in fields[:i+1])} THEN 1 ELSE 0 END) AS {_quote(field)}"
+                    for i,field in enumerate(fields)]
+            return ('count',f"SELECT {', '.join(['COUNT(*) AS __rows'] + sums)} FROM {table}")
+
+        def not_null(fields):
+            return ' AND '.join(f'{_quote(field)} IS NOT NULL' for field in fields) if fields else '1 = 1'
+
+        mapped = [field for field in obj.fields if field in rules]
+        statements = [('table',f"CREATE TEMP TABLE _carrot_mapped AS SELECT s.rowid AS __row, {', '.join(exprs)} "
+                               f"FROM {_quote(table)} s {' '.join(join for _,join in joins.values())}")]
+
+        #finalise: drop rows without the required fields, and number the rows for the primary key
+        required = self.get_required(obj)
+        statements.append(count('_carrot_mapped',required))
+
+        #format the columns that have been mapped, apart from the primary key and person_id
+        formatted = self.get_formatted(obj)
+        columns = [
+            f"{_formatters[obj[field].dtype](self.dialect,_quote(field))} AS {_quote(field)}" if field in formatted
+            else _quote(field)
+            for field in mapped
+        ]
+        if self.is_numbered(obj):
+            mapped = [obj.fields[0]] + mapped
+            columns = [f"ROW_NUMBER() OVER (ORDER BY __row) - 1 AS {_quote(obj.fields[0])}"] + columns
+        statements.append(('table',f"CREATE TEMP TABLE _carrot_formatted AS SELECT __row, {', '.join(columns)} "
+                                   f"FROM _carrot_mapped WHERE {not_null(required)}"))
+        if self.format_level is FormatterLevel.ON:
+            required = [field for field in formatted if field in obj.required_fields]
+            statements.append(count('_carrot_formatted',required))
+        else:
+            required = []
+
+        statements.append(('select',f"SELECT {', '.join(_quote(field) for field in mapped)} FROM _carrot_formatted "
+                                    f"WHERE {not_null(required)} ORDER BY __row"))
+        return statements
+
+    def get_df(self,obj,start_index=1,**kwargs):
+        """
+        The output dataframe of an object, from running its compiled sql
+        """
+        counts = []
+        try:
+            for kind,sql in self.compile(obj):
+                self.logger.debug(sql)
+                if kind == 'table':
+                    self.conn.execute(sql)
+                elif kind == 'count':
+                    counts.append(self.query(sql).iloc[0].to_dict())
+                else:
+                    df = self.query(sql)
+        finally:
+            for table in ['_carrot_mapped','_carrot_formatted']:
+                self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+        self.set_meta(obj,counts[0],'after')
+        if len(counts) > 1:
+            self.set_meta(obj,counts[1],'after_formatting')
+        return self.to_cdm(obj,df,start_index)
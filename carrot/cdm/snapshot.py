@@ -0,0 +1,155 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from carrot.tools.logger import Logger
+
+
+def _share_array(arr,blocks):
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True,size=max(arr.nbytes,1))
+    np.ndarray(arr.shape,dtype=arr.dtype,buffer=shm.buf)[:] = arr
+    blocks.append(shm)
+    return {'name':shm.name,'dtype':arr.dtype.str,'shape':arr.shape}
+
+def _attach_array(spec,blocks):
+    shm = shared_memory.SharedMemory(name=spec['name'])
+    blocks.append(shm)
+    arr = np.ndarray(spec['shape'],dtype=np.dtype(spec['dtype']),buffer=shm.buf)
+    #workers share the same memory, so must not write to it
+    arr.flags.writeable = False
+    return arr
+
+def _share_bytes(data,blocks):
+    return _share_array(np.frombuffer(data,dtype=np.uint8),blocks)
+
+def _attach_bytes(spec,blocks):
+    return _attach_array(spec,blocks).tobytes()
+
+
+def _share_series(series,blocks):
+    array = series.array
+    if hasattr(array,'_data') and hasattr(array,'_mask'):
+        #nullable (masked) arrays e.g. Int64, the values and mask are both plain numpy arrays
+        return {'kind':'masked','dtype':str(series.dtype),
+                'data':_share_array(array._data,blocks),
+                'mask':_share_array(array._mask,blocks)}
+    elif series.dtype.kind in 'biufcmM':
+        return {'kind':'numpy','data':_share_array(series.values,blocks)}
+    else:
+        #strings and other objects cannot be shared directly,
+        #so share them as categorical codes, with the unique values pickled once
+        cat = series.astype('category').array
+        return {'kind':'category','dtype':str(series.dtype),
+                'codes':_share_array(cat.codes,blocks),
+                'categories':_share_bytes(pickle.dumps(cat.categories,protocol=pickle.HIGHEST_PROTOCOL),blocks)}
+
+def _attach_series(spec,blocks):
+    if spec['kind'] == 'masked':
+        cls = pd.api.types.pandas_dtype(spec['dtype']).construct_array_type()
+        return cls(_attach_array(spec['data'],blocks),_attach_array(spec['mask'],blocks))
+    elif spec['kind'] == 'numpy':
+        return _attach_array(spec['data'],blocks)
+    else:
+        categories = pickle.loads(_attach_bytes(spec['categories'],blocks))
+        cat = pd.Categorical.from_codes(_attach_array(spec['codes'],blocks),categories=categories)
+        if spec['dtype'] == 'category':
+            return cat
+        #give back the original dtype, so analyses see the same columns as when run in threads
+        return cat.astype(spec['dtype'])
+
+
+def _runs(df):
+    #split the columns into runs of consecutive numpy columns with the same dtype,
+    #each run is shared as a single 2D array so pandas can use it as one block without copying
+    runs = []
+    for col in df.columns:
+        dtype = df[col].dtype
+        is_numpy = isinstance(dtype,np.dtype) and dtype.kind in 'biufcmM'
+        if is_numpy and runs and runs[-1][0] is not None and runs[-1][0] == dtype:
+            runs[-1][1].append(col)
+        else:
+            runs.append((dtype if is_numpy else None,[col]))
+    return runs
+
+
+class SharedTables(Logger):
+    """
+    Place the processed CDM tables in shared memory,
+    so that worker processes can attach to them without copying or pickling the data.
+    Numeric, datetime and nullable integer columns are shared as they are,
+    string columns are shared as categorical codes, and converted back to their dtype when attached.
+    """
+    def __init__(self,tables):
+        self.blocks = []
+        self.descriptor = {}
+        for name,df in tables.items():
+            if df is None:
+                continue
+            runs = []
+            for dtype,cols in _runs(df):
+                if dtype is None:
+                    runs.append({'kind':'series','column':cols[0],'data':_share_series(df[cols[0]],self.blocks)})
+                else:
+                    #shape is (ncolumns,nrows), the same layout as a pandas block
+                    values = np.stack([df[col].values for col in cols])
+                    runs.append({'kind':'block','columns':cols,'data':_share_array(values,self.blocks)})
+            self.descriptor[name] = {
+                'index':df.index.name,
+                'index_data':_share_series(df.index.to_series(),self.blocks),
+                'runs':runs
+            }
+        nbytes = sum(shm.size for shm in self.blocks)
+        self.logger.info(f"shared {len(self.descriptor)} tables using {len(self.blocks)} blocks ({nbytes/2**20:.1f} MB)")
+
+    def close(self):
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+        return False
+
+
+def attach_tables(descriptor,blocks):
+    """
+    Rebuild the dataframes from a SharedTables descriptor,
+    the shared memory blocks are appended to blocks and must be kept open while the tables are in use
+    """
+    tables = {}
+    for name,spec in descriptor.items():
+        index = pd.Index(_attach_series(spec['index_data'],blocks),name=spec['index'])
+        frames = []
+        for run in spec['runs']:
+            if run['kind'] == 'block':
+                values = _attach_array(run['data'],blocks)
+                frames.append(pd.DataFrame(values.T,columns=run['columns'],index=index,copy=False))
+            else:
+                frames.append(pd.DataFrame({run['column']:_attach_series(run['data'],blocks)},index=index))
+        if frames:
+            df = pd.concat(frames,axis=1,copy=False)
+        else:
+            df = pd.DataFrame(index=index)
+        tables[name] = df
+    return tables
+
+
+def save_snapshot(tables,fname):
+    """
+    Serialise the processed tables once, so batch jobs can load them rather than rerunning the ETL
+    """
+    _dir = os.path.dirname(fname)
+    if _dir and not os.path.exists(_dir):
+        os.makedirs(_dir)
+    tables = {k:v for k,v in tables.items() if v is not None}
+    pd.to_pickle(tables,fname)
+    return fname
+
+def load_snapshot(fname):
+    return pd.read_pickle(fname)
@@ -0,0 +1,265 @@
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+try:
+    import duckdb
+except ImportError:
+    #optional, sqlite is used if duckdb is not installed
+    duckdb = None
+
+from carrot.tools.logger import Logger
+from carrot.tools.merge import group_files_by_table
+from carrot.tools.file_helpers import get_separator_from_filename
+from .view import BadFilter, evaluate
+from .index import is_indexed_column
+
+#sqlite has a limit on the number of bound parameters,
+#larger lists of values (e.g. a cohort of person_ids) are filtered after the query
+_MAX_PARAMS = 900
+
+_sql_ops = {'>':'>','<':'<','>=':'>=','<=':'<=','==':'=','!=':'<>'}
+
+
+def _param(value):
+    return value.item() if isinstance(value,np.generic) else value
+
+def _quote(name):
+    return '"' + name.replace('"','""') + '"'
+
+
+class SqlBackend(Logger):
+    """
+    Embedded SQL engine over the CDM output files, so analyses can run on outputs larger than memory.
+    Filters (and any aggregation, via query) are pushed down to the engine,
+    only the selected rows and columns are returned as a dataframe.
+    * duckdb: files (tsv/csv, or parquet if present) are registered as views and scanned in parallel
+    * sqlite: files are streamed in chunks into a database file, with indexes on person_id and *_concept_id,
+              a database given with `database` is reused if the files have not changed since it was built
+    """
+    def __init__(self,inputs,engine=None,database=None,chunksize=100000):
+        if engine is None:
+            engine = 'duckdb' if duckdb is not None else 'sqlite'
+        if engine == 'duckdb' and duckdb is None:
+            raise ImportError("You are trying to use the duckdb engine, "
+                              "but the package 'duckdb' hasn't been installed. pip install duckdb")
+        if engine not in ['duckdb','sqlite']:
+            raise NotImplementedError(f"'{engine}' is not a known sql engine, choose from duckdb or sqlite")
+        self.engine = engine
+
+        if isinstance(inputs,str):
+            inputs = [inputs]
+        exts = ['.tsv','.csv','.parquet'] if engine == 'duckdb' else ['.tsv','.csv']
+        self.files = group_files_by_table(inputs,exts=exts)
+        self.files.pop('summary',None)
+
+        self._tmp = None
+        if database is None and engine == 'sqlite':
+            fd,database = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+            self._tmp = database
+        self.database = database
+        self.chunksize = chunksize
+
+        self._local = threading.local()
+        self._columns = {}
+        if engine == 'sqlite':
+            self._load_sqlite()
+        self.logger.info(f"registered {list(self.files.keys())} with {engine}")
+
+    def close(self):
+        conn = getattr(self._local,'conn',None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+        if self._tmp is not None and os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+    def connect(self):
+        """
+        Connection for the current thread (and process), connections cannot be shared between these
+        """
+        conn = getattr(self._local,'conn',None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        if self.engine == 'sqlite':
+            conn = sqlite3.connect(self.database)
+        else:
+            conn = duckdb.connect(self.database or ':memory:')
+            for table,files in self.files.items():
+                conn.execute(f"CREATE OR REPLACE VIEW {_quote(table)} AS SELECT * FROM {self._duckdb_scan(files)}")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _duckdb_scan(self,files):
+        fnames = '[' + ','.join("'" + f.replace("'","''") + "'" for f in sorted(files)) + ']'
+        if all(f.endswith('.parquet') for f in files):
+            return f"read_parquet({fnames})"
+        sep = get_separator_from_filename(files[0])
+        return f"read_csv_auto({fnames},delim='{sep}',header=true)"
+
+    def _sources(self,files):
+        return [[f,os.path.getsize(f),os.path.getmtime(f)] for f in sorted(files)]
+
+    def _load_sqlite(self):
+        conn = self.connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS _carrot_sources (name TEXT PRIMARY KEY, sources TEXT)")
+        loaded = dict(conn.execute("SELECT name,sources FROM _carrot_sources").fetchall())
+        for table,files in self.files.items():
+            sources = json.dumps(self._sources(files))
+            if loaded.get(table) == sources:
+                self.logger.debug(f"{table} is already loaded and up to date")
+                continue
+            conn.execute(f"DROP TABLE IF EXISTS {_quote(table)}")
+            nrows = 0
+            for fname in sorted(files):
+                chunks = pd.read_csv(fname,sep=get_separator_from_filename(fname),chunksize=self.chunksize)
+                for df in chunks:
+                    df.to_sql(table,conn,if_exists='append',index=False)
+                    nrows += len(df)
+            for col in self.columns(table):
+                if is_indexed_column(col):
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS {_quote(f'ix_{table}_{col}')} "
+                                 f"ON {_quote(table)} ({_quote(col)})")
+            conn.execute("INSERT OR REPLACE INTO _carrot_sources VALUES (?,?)",(table,sources))
+            conn.commit()
+            self.logger.info(f"loaded {nrows} rows of {table} into {self.database}")
+
+    def tables(self):
+        return list(self.files.keys())
+
+    def columns(self,table):
+        if table not in self._columns:
+            if table not in self.files:
+                raise BadFilter(f"{table} is not one of the registered tables {self.tables()}")
+            self._columns[table] = list(self.query(f"SELECT * FROM {_quote(table)} LIMIT 0").columns)
+        return self._columns[table]
+
+    def query(self,sql,params=None):
+        """
+        Run any query e.g. an aggregation, returning a dataframe
+        """
+        conn = self.connect()
+        params = [_param(x) for x in params] if params else []
+        if self.engine == 'sqlite':
+            return pd.read_sql_query(sql,conn,params=params)
+        return conn.execute(sql,params).df()
+
+    def table(self,table):
+        return self.query(f"SELECT * FROM {_quote(table)}")
+
+    def _predicate(self,column,predicate,params):
+        #sql for a single filter, or None if it can only be evaluated after the query
+        if callable(predicate):
+            return None
+        if isinstance(predicate,dict):
+            clauses = []
+            for op_str,value in predicate.items():
+                if op_str in _sql_ops:
+                    clause = f"{column} {_sql_ops[op_str]} ?"
+                    params.append(value)
+                    if op_str == '!=':
+                        #pandas keeps nulls when filtering on !=
+                        clause = f"({clause} OR {column} IS NULL)"
+                elif op_str in ['in','not in']:
+                    clause = self._predicate(column,list(value),params)
+                    if clause is None:
+                        return None
+                    if op_str == 'not in':
+                        clause = f"(NOT {clause} OR {column} IS NULL)"
+                else:
+                    raise BadFilter(f"'{op_str}' is not a known comparison, choose from {list(_sql_ops.keys())+['in','not in']}")
+                clauses.append(clause)
+            return ' AND '.join(clauses) if clauses else None
+        if isinstance(predicate,(list,tuple,set,np.ndarray,pd.Index)):
+            values = list(predicate)
+            if len(values) > _MAX_PARAMS:
+                return None
+            if len(values) == 0:
+                return "1 = 0"
+            params.extend(values)
+            return f"{column} IN ({','.join('?'*len(values))})"
+        params.append(predicate)
+        return f"{column} = ?"
+
+    def compile(self,config,cols=None):
+        """
+        Compile a filter config (see CommonDataModel.filter) into sql,
+        returning the sql, its parameters and any filters that need to be applied to the result.
+        Tables are joined on person_id, repeated column names are suffixed with _<table>
+        """
+        if len(config) == 0:
+            raise BadFilter("no tables have been selected")
+        selected = []
+        names = {}
+        wheres = []
+        params = []
+        remaining = []
+        for i,(table,filters) in enumerate(config.items()):
+            alias = f"t{i}"
+            columns = self.columns(table)
+            needed = [col for col,predicate in filters.items() if callable(predicate)]
+            for col in columns:
+                if i > 0 and col == 'person_id':
+                    continue
+                if cols is not None and col not in cols and col != 'person_id' and col not in needed:
+                    continue
+                name = col if col not in names.values() else f"{col}_{table}"
+                names[(table,col)] = name
+                selected.append(f"{alias}.{_quote(col)} AS {_quote(name)}")
+            for col,predicate in filters.items():
+                if col not in columns:
+                    raise BadFilter(f"{col} is not a column of {table}")
+                clause = self._predicate(f"{alias}.{_quote(col)}",predicate,params)
+                if clause is None:
+                    if (table,col) not in names:
+                        name = col if col not in names.values() else f"{col}_{table}"
+                        names[(table,col)] = name
+                        selected.append(f"{alias}.{_quote(col)} AS {_quote(name)}")
+                    remaining.append((names[(table,col)],predicate))
+                else:
+                    wheres.append(clause)
+
+        tables = list(config.keys())
+        sql = f"SELECT {', '.join(selected)} FROM {_quote(tables[0])} t0"
+        for i,table in enumerate(tables[1:],start=1):
+            sql += f" JOIN {_quote(table)} t{i} ON t0.{_quote('person_id')} = t{i}.{_quote('person_id')}"
+        if wheres:
+            sql += " WHERE " + " AND ".join(wheres)
+        return sql,params,remaining
+
+    def filter(self,config,cols=None,dropna=False):
+        """
+        Same as CommonDataModel.filter, but the filters are run by the sql engine
+        """
+        if isinstance(cols,dict):
+            cols = [col for col,keep in cols.items() if keep]
+        sql,params,remaining = self.compile(config,cols)
+        self.logger.debug(sql)
+        df = self.query(sql,params)
+        if remaining:
+            mask = np.ones(len(df),dtype=bool)
+            for name,predicate in remaining:
+                mask &= evaluate(df[name],predicate)
+            df = df[mask].reset_index(drop=True)
+        if dropna:
+            df = df.dropna(axis=1,how='all')
+        if cols is not None:
+            df = df[[col for col in cols if col in df.columns]]
+        if 'person_id' in df.columns and (cols is None or 'person_id' in cols):
+            df = df.set_index('person_id')
+        return df
+
+    def count(self,config):
+        """
+        Number of rows passing the filters, counted by the sql engine
+        """
+        sql,params,remaining = self.compile(config)
+        if remaining:
+            return len(self.filter(config))
+        sql = f"SELECT COUNT(*) AS n FROM ({sql}) AS q"
+        return int(self.query(sql,params)['n'].iloc[0])
@@ -0,0 +1,180 @@
+import operator
+import numpy as np
+import pandas as pd
+from carrot.tools.logger import Logger
+
+class BadFilter(Exception):
+    pass
+
+_ops = {
+    '>': operator.gt,
+    '<': operator.lt,
+    '>=': operator.ge,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+    'in': lambda s,v: s.isin(v),
+    'not in': lambda s,v: ~s.isin(v)
+}
+
+def evaluate(series,predicate):
+    """
+    Evaluate a predicate on a series, returning a boolean numpy mask. The predicate can be:
+    * a dict of comparisons e.g. {'>':10,'<=':20}
+    * a list/set of values to match
+    * a callable, applied to the whole series if possible, otherwise row by row
+    * any other value to match exactly
+    """
+    if callable(predicate):
+        try:
+            mask = predicate(series)
+            if isinstance(mask,pd.Series) and mask.dtype == bool and len(mask) == len(series):
+                return mask.values
+        except Exception:
+            pass
+        return series.apply(predicate).values.astype(bool)
+    elif isinstance(predicate,dict):
+        mask = np.ones(len(series),dtype=bool)
+        for op_str,value in predicate.items():
+            if op_str not in _ops:
+                raise BadFilter(f"'{op_str}' is not a known comparison, choose from {list(_ops.keys())}")
+            mask &= _ops[op_str](series,value).values
+        return mask
+    elif isinstance(predicate,(list,tuple,set,np.ndarray,pd.Index)):
+        return series.isin(predicate).values
+    else:
+        return (series == predicate).values
+
+
+def is_lookup(predicate):
+    #exact values can be looked up in an index, rather than compared row by row
+    return not callable(predicate) and not isinstance(predicate,dict)
+
+
+class CDMView(Logger):
+    """
+    Lazy, read only view over the processed tables of a CommonDataModel.
+    Filters are only stored until the view is materialised, at which point
+    only the selected rows and columns are copied.
+    Filters on exact values of indexed columns (person_id, *_concept_id) are index lookups,
+    other filters are only evaluated on the rows these select.
+    Tables are joined together on person_id.
+    """
+    def __init__(self,tables,filters=None,columns=None,indexes=None):
+        #tables is a map of table name to dataframe, these are never modified
+        self.tables = tables
+        self.filters = filters if filters is not None else {}
+        self.columns = columns
+        self.indexes = indexes
+
+    def where(self,table,column=None,predicate=None,**kwargs):
+        """
+        Return a new view with an extra filter on a table,
+        e.g. view.where('person',gender_concept_id=8507) or view.where('measurement','value_as_number',{'>':10})
+        """
+        if table not in self.tables or self.tables[table] is None:
+            raise BadFilter(f"{table} has not been processed, cannot filter on it")
+        filters = {k:list(v) for k,v in self.filters.items()}
+        filters.setdefault(table,[])
+        if column is not None:
+            filters[table].append((column,predicate))
+        filters[table].extend(kwargs.items())
+        return CDMView(self.tables,filters,self.columns,self.indexes)
+
+    def select(self,columns):
+        """
+        Return a new view only keeping some columns, either a list or a dict of column:keep
+        """
+        if isinstance(columns,dict):
+            columns = [col for col,keep in columns.items() if keep]
+        return CDMView(self.tables,self.filters,list(columns),self.indexes)
+
+    def _get_index(self,table,column):
+        if self.indexes is None:
+            return None
+        return self.indexes.get(table,column,self.tables[table])
+
+    def rows(self,table,person_ids=None):
+        """
+        Sorted positions of the rows of a table passing the filters,
+        optionally only for some persons (e.g. a cohort selected from another table)
+        """
+        df = self.tables[table]
+        filters = list(self.filters.get(table,[]))
+        if person_ids is not None:
+            filters.append(('person_id',person_ids))
+
+        rows = None
+        remaining = []
+        for column,predicate in filters:
+            index = self._get_index(table,column) if is_lookup(predicate) else None
+            if index is None:
+                remaining.append((column,predicate))
+                continue
+            found = index.lookup(predicate)
+            rows = found if rows is None else np.intersect1d(rows,found,assume_unique=True)
+
+        if not remaining:
+            return rows if rows is not None else np.arange(len(df))
+
+        mask = None
+        for column,predicate in remaining:
+            if column == df.index.name:
+                series = df.index.to_series()
+            else:
+                series = df[column]
+            if rows is not None:
+                series = series.iloc[rows]
+            mask = evaluate(series,predicate) if mask is None else mask & evaluate(series,predicate)
+        return rows[mask] if rows is not None else np.flatnonzero(mask)
+
+    def mask(self,table):
+        mask = np.zeros(len(self.tables[table]),dtype=bool)
+        mask[self.rows(table)] = True
+        return mask
+
+    def count(self,table=None):
+        """
+        Number of rows passing the filters (for one table), without materialising anything
+        """
+        if table is not None:
+            return len(self.rows(table))
+        return len(self.to_df())
+
+    def _get_table(self,table,person_ids=None):
+        df = self.tables[table]
+        rows = self.rows(table,person_ids)
+        columns = list(df.columns)
+        if self.columns is not None:
+            columns = [col for col in columns if col in self.columns or col == 'person_id']
+        df = df.iloc[rows,df.columns.get_indexer(columns)]
+        if df.index.name is not None and (self.columns is None or df.index.name in self.columns
+                                          or df.index.name == 'person_id'):
+            df = df.reset_index()
+        return df
+
+    def to_df(self,dropna=False):
+        """
+        Materialise the view, joining the filtered tables on person_id
+        """
+        tables = list(self.filters.keys())
+        if len(tables) == 0:
+            raise BadFilter("no tables have been selected")
+
+        retval = None
+        for table in tables:
+            if retval is None:
+                retval = self._get_table(table)
+            else:
+                #only look up the rows of the persons selected so far
+                person_ids = pd.Index(retval['person_id'].dropna().unique()) if 'person_id' in retval.columns else None
+                df = self._get_table(table,person_ids)
+                retval = retval.merge(df,on='person_id',how='inner',suffixes=('',f'_{table}'))
+
+        if dropna:
+            retval = retval.dropna(axis=1,how='all')
+        if self.columns is not None:
+            retval = retval[[col for col in self.columns if col in retval.columns]]
+        if 'person_id' in retval.columns and (self.columns is None or 'person_id' in self.columns):
+            retval = retval.set_index('person_id')
+        return retval
@@ -1,22 +1,40 @@
-from .subcommands.info import info
-from .subcommands.etl import etl
-from .subcommands.display import display
-from .subcommands.run import run
-from .subcommands.airflow import airflow
-from .subcommands.generate import generate
-
-from .subcommands.get import get
-from .subcommands.search import search
-from .subcommands.pseudonymise import pseudonymise
-
-from carrot.tools.logger import _Logger as Logger
 import carrot as c
 
+import importlib
 import click
-import json
 
+#subcommands are only imported when they are used (or listed in --help),
+#so that e.g. `carrot info version` does not pay for importing pandas and the etl
+_subcommands = {
+    'etl':'carrot.cli.subcommands.etl:etl',
+    'run':'carrot.cli.subcommands.run:run',
+    'info':'carrot.cli.subcommands.info:info',
+    'display':'carrot.cli.subcommands.display:display',
+    'generate':'carrot.cli.subcommands.generate:generate',
+    'get':'carrot.cli.subcommands.get:get',
+    'search':'carrot.cli.subcommands.search:search',
+    'pseudonymise':'carrot.cli.subcommands.pseudonymise:pseudonymise',
+    'rules':'carrot.cli.subcommands.rules:rules',
+    'airflow':'carrot.cli.subcommands.airflow:airflow',
+}
+
+
+class LazyGroup(click.Group):
+    def __init__(self,*args,lazy_commands=None,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self,ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands.keys()))
 
-@click.group(invoke_without_command=True)
+    def get_command(self,ctx,name):
+        if name not in self.commands and name in self.lazy_commands:
+            module,attr = self.lazy_commands[name].split(':')
+            self.add_command(getattr(importlib.import_module(module),attr),name)
+        return super().get_command(ctx,name)
+
+
+@click.group(cls=LazyGroup,lazy_commands=_subcommands,invoke_without_command=True)
 @click.option("--version","-v",is_flag=True)
 @click.option("--log-level","-l",
               type=click.Choice(['0','1','2','3']),
@@ -33,6 +51,7 @@ def carrot(ctx,version,log_level,cprofile):
         return
            
 
+    from carrot.tools.logger import _Logger as Logger
     c.params['debug_level'] = int(log_level)
     log = Logger("carrot")
     if cprofile:
@@ -49,17 +68,6 @@ def carrot(ctx,version,log_level,cprofile):
         ctx.call_on_close(callback)
 
         
-carrot.add_command(etl, "etl")
-carrot.add_command(run, "run")
-carrot.add_command(info, "info")
-carrot.add_command(display, "display")
-carrot.add_command(generate, "generate")
-carrot.add_command(get, "get")
-carrot.add_command(search, "search")
-carrot.add_command(pseudonymise, "pseudonymise")
-carrot.add_command(airflow,'airflow')
-
-
 
 if __name__ == "__main__":
     carrot()
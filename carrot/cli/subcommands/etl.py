@@ -18,6 +18,8 @@ import lockfile
 import shutil
 import io
 import time
+import contextlib
+import concurrent.futures
 import datetime
 import yaml
 import json
@@ -27,6 +29,7 @@ import pandas as pd
 import carrot
 from carrot.tools.bclink_helpers import BCLinkHelpers
 from carrot.tools.logger import _Logger as Logger
+from carrot.tools.profiling import parse_memory
 
 from .run import map as cc_map
 from .pseudonymise import pseudonymise
@@ -191,8 +194,223 @@ def _run_data(data,clean,ctx):
     return True
 
 
+#rough number of bytes of memory needed per byte of input csv
+#once loaded into pandas as string (object) columns
+_MEMORY_PER_INPUT_BYTE = 10
 
-def _run_etl(ctx,config_file):
+def _get_data_size(data):
+    input_folder = data['input']
+    if isinstance(input_folder,dict):
+        input_folder = input_folder['input']
+    if not os.path.isdir(input_folder):
+        return 0
+    return sum(os.path.getsize(f) for f in carrot.tools.get_files(input_folder,type='csv'))
+
+def _get_shared_output_folder(output):
+    if isinstance(output,dict):
+        return output['cache']
+    return output
+
+def _get_staging_folder(_id,data):
+    input_folder = data['input']
+    if isinstance(input_folder,dict):
+        input_folder = input_folder['input']
+    name = os.path.basename(os.path.normpath(input_folder))
+    shared = _get_shared_output_folder(data['output'])
+    return os.path.join(shared,'.staging',f"{name}_{_id[:8]}")
+
+def _run_data_isolated(data,staging_folder,debug_level):
+    """
+    Run a single dataset in a worker process, writing all outputs, person_ids and logs
+    to its own staging folder so that it does not interact with any other dataset
+    """
+    carrot.params['debug_level'] = debug_level
+    log_file = os.path.join(staging_folder,'logs','carrot.log')
+    os.makedirs(os.path.dirname(log_file),exist_ok=True)
+
+    _data = copy.deepcopy(data)
+    _data['output'] = staging_folder
+    _data['split_outputs'] = False
+    _data['write_mode'] = 'w'
+
+    with open(log_file,'w') as f, contextlib.redirect_stderr(f), contextlib.redirect_stdout(f):
+        with click.Context(etl) as ctx:
+            _run_data(_data,False,ctx)
+    return staging_folder
+
+def _commit_staged_data(data,staging_folder,chunksize=100000):
+    """
+    Move the outputs of a dataset processed in isolation into the shared output.
+    Person ids and primary keys are renumbered to follow on from what already exists
+    in the shared output.
+    """
+    logger = Logger("_commit_staged_data")
+    output = data['output']
+    write_separate = data.get('split_outputs',True)
+    write_mode = data.get('write_mode','a')
+
+    f_person_ids = os.path.join(staging_folder,'person_ids.tsv')
+    if not os.path.exists(f_person_ids):
+        logger.warning(f"nothing to commit from {staging_folder}")
+        return False
+
+    if isinstance(output,dict):
+        outputs = carrot.tools.create_bclink_store(bclink_settings=output['bclink'],
+                                                   output_folder=output['cache'],
+                                                   sep='\t',
+                                                   write_separate=write_separate,
+                                                   write_mode=write_mode)
+    else:
+        outputs = carrot.tools.create_csv_store(output_folder=output,
+                                                sep='\t',
+                                                write_separate=write_separate,
+                                                write_mode=write_mode)
+
+    person_id_masker = outputs.load_global_ids()
+    indexing = outputs.load_indexing() or {}
+
+    df_ids = pd.read_csv(f_person_ids,sep='\t',dtype=str)
+    if person_id_masker:
+        existing = df_ids['TARGET_SUBJECT'].isin(person_id_masker.keys())
+        if existing.any():
+            logger.error(f"{existing.sum()} people in {staging_folder} have already been processed and present in existing data.")
+            logger.error("Check the person_id map/lookup!")
+            return False
+        start_index = max(int(x) for x in person_id_masker.values()) + 1
+    else:
+        start_index = int(indexing.get('person',1))
+    person_offset = start_index - 1
+
+    df_ids['SOURCE_SUBJECT'] = df_ids['SOURCE_SUBJECT'].astype(int) + person_offset
+    outputs.write('person_ids',df_ids,None)
+
+    for fname in carrot.tools.get_files(staging_folder,type='tsv'):
+        table = os.path.splitext(os.path.basename(fname))[0]
+        if table in ['person_ids','summary']:
+            continue
+        pk_offset = person_offset if table == 'person' else int(indexing.get(table,1)) - 1
+        logger.info(f"committing {table} with offsets person_id+{person_offset} pk+{pk_offset}")
+        mode = None
+        for df in pd.read_csv(fname,sep='\t',dtype=str,chunksize=chunksize):
+            pk = df.columns[0]
+            if pk != 'person_id':
+                df[pk] = df[pk].astype(float).astype(pd.Int64Dtype()) + pk_offset
+            df['person_id'] = df['person_id'].astype(float).astype(pd.Int64Dtype()) + person_offset
+            outputs.write(table,df,mode)
+            mode = 'a'
+
+    f_meta = os.path.join(staging_folder,'.meta.json')
+    if os.path.exists(f_meta):
+        for meta in carrot.tools.load_json(f_meta).values():
+            outputs.write_meta(meta)
+
+    f_summary = os.path.join(staging_folder,'summary.tsv')
+    if os.path.exists(f_summary):
+        with open(f_summary) as f:
+            outputs.write_tsv_summary(f.read(),'summary')
+
+    outputs.finalise()
+    return True
+
+def _remove_staging_folder(data,staging_folder):
+    """
+    Remove the staging folder of a dataset, whether it was committed or not,
+    keeping its log with the logs of the shared output
+    """
+    if not os.path.isdir(staging_folder):
+        return
+    log_file = os.path.join(staging_folder,'logs','carrot.log')
+    if os.path.exists(log_file):
+        log_folder = os.path.join(_get_shared_output_folder(data['output']),'logs')
+        os.makedirs(log_folder,exist_ok=True)
+        shutil.move(log_file,os.path.join(log_folder,f"{os.path.basename(staging_folder)}.log"))
+    shutil.rmtree(staging_folder)
+
+def _run_data_concurrently(data,clean,ctx,max_workers,memory_budget=None):
+    """
+    Run independent datasets across a process pool.
+    * datasets are submitted largest first
+    * a new dataset is only started if the estimated memory of all running datasets fits the budget
+    * each finished dataset is committed to the shared output one at a time, under a file lock
+    """
+    logger = Logger("_run_data_concurrently")
+
+    if not data:
+        return
+    data = {k:v for k,v in data.items() if v.get('rules') is not None}
+    if not data:
+        logger.warning('no rules to run')
+        return
+
+    if clean:
+        outputs = {_make_id(d['output']):d['output'] for d in data.values()}
+        for output in outputs.values():
+            if isinstance(output,dict):
+                ctx.invoke(clean_tables)
+            elif os.path.exists(output) and os.path.isdir(output):
+                logger.warning(f"removing {output}")
+                shutil.rmtree(output)
+
+    sizes = {_id:_get_data_size(d) for _id,d in data.items()}
+    queue = sorted(data.keys(),key=lambda _id: sizes[_id],reverse=True)
+    logger.info(f"running {len(queue)} datasets with {max_workers} workers and a memory budget of {memory_budget} bytes")
+
+    running = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while queue or running:
+            while queue and len(running) < max_workers:
+                _id = queue[0]
+                required = sizes[_id]*_MEMORY_PER_INPUT_BYTE
+                used = sum(sizes[x]*_MEMORY_PER_INPUT_BYTE for x in running.values())
+                if running and memory_budget is not None and used + required > memory_budget:
+                    break
+                queue.pop(0)
+                staging_folder = _get_staging_folder(_id,data[_id])
+                if os.path.exists(staging_folder):
+                    shutil.rmtree(staging_folder)
+                logger.info(f"starting {staging_folder} ({sizes[_id]} bytes of input)")
+                future = executor.submit(_run_data_isolated,
+                                         data[_id],
+                                         staging_folder,
+                                         carrot.params['debug_level'])
+                running[future] = _id
+
+            done,_ = concurrent.futures.wait(running,return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                _id = running.pop(future)
+                staging_folder = _get_staging_folder(_id,data[_id])
+                try:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"failed to process {data[_id]['input']}")
+                        logger.error(e)
+                        continue
+
+                    shared = _get_shared_output_folder(data[_id]['output'])
+                    os.makedirs(shared,exist_ok=True)
+                    with lockfile.FileLock(os.path.join(shared,'.carrot')):
+                        committed = _commit_staged_data(data[_id],staging_folder)
+                    if committed:
+                        logger.info(f"finished {data[_id]['input']}")
+                    else:
+                        logger.error(f"failed to commit {data[_id]['input']}")
+                finally:
+                    #never leave a staging folder behind, even if the dataset failed
+                    _remove_staging_folder(data[_id],staging_folder)
+
+    for d in data.values():
+        staging = os.path.join(_get_shared_output_folder(d['output']),'.staging')
+        if os.path.isdir(staging) and not os.listdir(staging):
+            os.rmdir(staging)
+
+def _run_all_data(data,clean,ctx,max_workers=1,memory_budget=None):
+    if max_workers is None or max_workers <= 1:
+        return [_run_data(d,clean if i==0 else False,ctx) for i,d in enumerate(data.values())]
+    return _run_data_concurrently(data,clean,ctx,max_workers,memory_budget)
+
+
+def _run_etl(ctx,config_file,max_workers=None):
     logger = Logger("run_etl")
     last_modified_config = os.path.getmtime(config_file)
     logger.info(f"running etl on {config_file} (last modified: {last_modified_config})")
@@ -208,9 +426,12 @@ def _run_etl(ctx,config_file):
     settings = conf.get('settings',{})
     listen_for_changes = settings.get('listen_for_changes',False)
     clean = settings.get('clean',False)
-    
+    if max_workers is None:
+        max_workers = settings.get('max_workers',1)
+    memory_budget = parse_memory(settings.get('memory_budget'))
+
     #run the data
-    _ = [_run_data(d,clean if i==0 else False,ctx) for i,d in enumerate(data.values())]
+    _ = _run_all_data(data,clean,ctx,max_workers,memory_budget)
         
     display_msg = True
     while True:
@@ -232,7 +453,7 @@ def _run_etl(ctx,config_file):
         
         display_msg = True if data_to_process else display_msg
         #run the data
-        _ = [_run_data(d,False,ctx) for d in data_to_process.values()]
+        _ = _run_all_data(data_to_process,False,ctx,max_workers,memory_budget)
 
         #update the data to 
         data = _load_transform_data(conf['transform']['data'])
@@ -253,8 +474,9 @@ def _run_etl(ctx,config_file):
 @click.option('config_file','--config','--config-file',help='specify a yaml configuration file')
 @click.option('run_as_daemon','--daemon','-d',help='run the ETL as a daemon process',is_flag=True)
 @click.option('--log-file','-l',default='carrot.log',help='specify the log file to write to')
+@click.option('--max-workers','-j',default=None,type=int,help='number of datasets to process concurrently (overrides settings: max_workers)')
 @click.pass_context
-def etl(ctx,config_file,run_as_daemon,log_file):
+def etl(ctx,config_file,run_as_daemon,log_file,max_workers):
     logger = Logger("etl")
     
     if run_as_daemon and daemon is None:
@@ -279,9 +501,9 @@ def etl(ctx,config_file,run_as_daemon,log_file):
                 pidfile=TimeoutPIDLockFile('etl.pid', -1)
             )
             with d_ctx:
-                _run_etl(ctx,config_file)
+                _run_etl(ctx,config_file,max_workers)
     else:
-        _run_etl(ctx,config_file)
+        _run_etl(ctx,config_file,max_workers)
 
 
 
@@ -314,7 +536,7 @@ def bclink(ctx,force,config_file,interactive):
                                f" via 'rules:<path of file>'")
 
     try:
-        rules = carrot.tools.load_json(config['rules'])
+        rules = carrot.tools.load_rules(config['rules'])
         destination_tables = list(rules['cdm'].keys())
     except Exception as e:
         raise BadRulesFile(e)
@@ -471,7 +693,7 @@ def _process_list_data(ctx):
             #need to pick up the full rules for the next loop
             #incase we insert new data
             # --> we dont want to just apply the delta to the new data
-            rules = carrot.tools.load_json(current_rules_file)
+            rules = carrot.tools.load_rules(current_rules_file)
        
         if ctx.obj['listen_for_changes'] == False:
             break
@@ -899,10 +1121,12 @@ def _extract(ctx,data,rules,bclink_helpers):
         if 'salt' not in _pseudonymise:
             raise Exception("To use pseudonymise a salt must be provided!")
         salt = _pseudonymise['salt']
+        mode = _pseudonymise.get('mode','sha256')
+        workers = _pseudonymise.get('workers',1)
                 
         logger.info(f"Called do_pseudonymisation on input data {data} ")
         if not isinstance(rules,dict):
-            rules = carrot.tools.load_json(rules)
+            rules = carrot.tools.load_rules(rules)
         person_id_map = carrot.tools.get_person_ids(rules)
 
         input_map = {os.path.basename(x):x for x in inputs}
@@ -920,7 +1144,9 @@ def _extract(ctx,data,rules,bclink_helpers):
                               output_folder=output,
                               chunksize=chunksize,
                               salt=salt,
-                              person_id=person_id
+                              person_id=person_id,
+                              mode=mode,
+                              workers=workers
                           )
             inputs.append(fout)
         
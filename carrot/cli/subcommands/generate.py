@@ -10,6 +10,7 @@ import secrets
 import random
 import datetime
 import time
+from carrot.tools.scan_report import make_report
 
 class MissingToken(Exception):
     pass
@@ -360,10 +361,22 @@ def report_to_xlsx(report,f_out):
 @click.option("rows_per_table","--rows-per-table",
               default=100000,
               type=int,
-              help='specify the maximum of rows to scan per input data file (table).')
+              help='specify the maximum of rows to scan per input data file (table), 0 to scan all rows.')
 @click.option("randomise","--randomise",
               is_flag=True,
               help='randomise rows')
+@click.option("chunksize","--chunksize",
+              default=100000,
+              type=int,
+              help='specify the number of rows to load at a time when scanning a file.')
+@click.option("max_exact","--max-exact-values",
+              default=10000,
+              type=int,
+              help='number of distinct values of a field to count exactly, above this the counts of the most frequent values are estimated.')
+@click.option("workers","--workers","-j",
+              default=1,
+              type=int,
+              help='number of files to scan in parallel.')
 @click.option("as_type","--as-type","--save-as",
               default=None,
               type=click.Choice(['xlsx','json','latex']),
@@ -376,55 +389,16 @@ def report_to_xlsx(report,f_out):
               help='give a name to the report')
 @click.argument("inputs",
                 nargs=-1)
-def report(inputs,name,max_distinct_values,min_cell_count,rows_per_table,randomise,as_type,f_out):
-    skiprows = None
-        
-    data = []
-    for fname in inputs:
-        #get the name of the data table
-        table_name = os.path.basename(fname)
-        #load as a pandas dataframe
-        #load it and preserve the original data (i.e. no NaN conversions)
-        df = pd.read_csv(fname,
-                         dtype=str,
-                         keep_default_na=False,
-                         nrows=rows_per_table,
-                         skiprows=skiprows)
-        if randomise:
-            df = df.sample(frac=1)
-
-        #get a list of all column (field) names
-        column_names = df.columns.tolist()
-        fields = []
-        #loop over all colimns
-        for col in column_names:
-            #value count the columns
-            series = df[col].value_counts()
-            #reduce the size of the value counts depending on specifications of max distinct values 
-            if max_distinct_values>0 and len(series)>=max_distinct_values:
-                series = series.iloc[:max_distinct_values]
-
-            #if the min cell count is set, remove value counts that are below this threshold
-            if not min_cell_count is None:
-                series = series[series >= min_cell_count]
-
-            #convert into a frequency instead of value count
-            series = (series/len(df)).rename('frequency').round(4) 
-
-            #convert the values to a dictionary 
-            frame = series.to_frame()
-                        
-            values = frame.rename_axis('value').reset_index().to_dict(orient='records')
-            #record the value (frequency counts) for this field
-            fields.append({'field':col,'values':values})
-
-        meta = {
-            'dataset':name,
-            'nscanned':len(df),
-            'max_distinct_values':max_distinct_values,
-            'min_cell_count':min_cell_count
-        }
-        data.append({'table':table_name,'fields':fields, 'meta':meta})
+def report(inputs,name,max_distinct_values,min_cell_count,rows_per_table,randomise,chunksize,max_exact,workers,as_type,f_out):
+    #stream through each file, counting value frequencies in bounded memory
+    data = make_report(list(inputs),name,
+                       workers=workers,
+                       max_distinct_values=max_distinct_values,
+                       min_cell_count=min_cell_count,
+                       rows_per_table=rows_per_table,
+                       chunksize=chunksize,
+                       randomise=randomise,
+                       max_exact=max_exact)
 
     if as_type == 'json':
         f_out = f_out if f_out != None else 'ScanReport.json'
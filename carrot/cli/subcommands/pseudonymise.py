@@ -1,52 +1,58 @@
 import click
-import requests
 import carrot
-import hashlib
 import os
-from carrot.tools.logger import Logger
+from carrot.tools.logger import _Logger as Logger
+from carrot.tools.pseudonymise import Pseudonymiser, modes
+from carrot.io.compression import open_output, compressions, extensions, strip_compression
 
 @click.command(help="Command to help pseudonymise data.")
-@click.option("-s","--salt",help="salt hash",required=True,type=str)
-@click.option("--person-id","-i","--id",help="name of the person_id",required=True,type=str)
+@click.option("-s","--salt",help="salt hash (used as the key for the keyed hash modes)",required=True,type=str)
+@click.option("--person-id","-i","--id",help="name of the person_id, or other id column(s) to pseudonymise",required=True,type=str,multiple=True)
 @click.option("--output-folder","-o",help="path of the output folder",required=True,type=str)
 @click.option("--chunksize",help="set the chunksize when loading data",type=int,default=None)
-@click.argument("input",required=True)
-def pseudonymise(input,output_folder,chunksize,salt,person_id):
+@click.option("--mode","-m",help="the hashing method to use",type=click.Choice(modes),default='sha256')
+@click.option("--workers","-j",help="number of processes to use for hashing",type=int,default=1)
+@click.option("--compression",help="compress the output files",type=click.Choice(compressions),default=None)
+@click.argument("input",required=True,nargs=-1)
+def pseudonymise(input,output_folder,chunksize,salt,person_id,mode='sha256',workers=1,compression=None):
 
     logger = Logger("pseudonymise")
-    logger.info(f"Working on file {input}, pseudonymising column '{person_id}' with salt '{salt}'")
-    
+
+    #can be called with a single file from the etl
+    single = isinstance(input,str)
+    inputs = [input] if single else list(input)
+    columns = [person_id] if isinstance(person_id,str) else list(person_id)
+
     #create the dir
     os.makedirs(output_folder,exist_ok=True)
-    f_out = f"{output_folder}{os.path.sep}{os.path.basename(input)}"
-
-    logger.info(f"Saving new file to {f_out}")
-    
-    #load data
-    data = carrot.tools.load_csv(input,chunksize=chunksize)
-
-    i = 0 
-    while True:
-        data[input][person_id] =  data[input][person_id].apply(
-            lambda x: hashlib.sha256((x+salt).encode("UTF-8")).hexdigest()
-        )
-        logger.info(data[input][person_id])
-
-        mode = 'w'
-        header=True
-        if i > 0 :
-            mode = 'a'
-            header=False
-        
-        data[input].to_csv(f_out,mode=mode,header=header,index=False)
-        log.info(f"Finished {input} of size={len(data[input])} on iteration {i}")
-        i+=1
-        
-        try:
-            data.next()
-        except StopIteration:
-            break
-    
+
+    outputs = []
+    #share the pseudonymiser so the cache is reused across files
+    with Pseudonymiser(salt,mode=mode,workers=workers) as pseudonymiser:
+        for fin in inputs:
+            logger.info(f"Working on file {fin}, pseudonymising columns {columns} with mode '{mode}'")
+            f_out = f"{output_folder}{os.path.sep}{os.path.basename(fin)}"
+            if compression is not None:
+                f_out = f"{strip_compression(f_out)}.{extensions[compression]}"
+            logger.info(f"Saving new file to {f_out}")
+
+            #load data
+            data = carrot.tools.load_csv(fin,chunksize=chunksize)
+            name = list(data.keys())[0]
+
+            i = 0
+            with open_output(f_out,'w') as f:
+                while True:
+                    df = pseudonymiser.pseudonymise(data[name],columns)
+                    df.to_csv(f,header=(i==0),index=False)
+                    logger.info(f"Finished {fin} of size={len(df)} on iteration {i}")
+                    i+=1
+
+                    try:
+                        data.next()
+                    except StopIteration:
+                        break
+            outputs.append(f_out)
 
     logger.info("Done!")
-    return f_out
+    return outputs[0] if single else outputs
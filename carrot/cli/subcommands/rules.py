@@ -0,0 +1,51 @@
+import os
+import time
+import click
+import carrot
+from carrot.tools.logger import _Logger as Logger
+from carrot.tools import compiled_rules as cr
+
+@click.group(help="Commands for working with the mapping rules.")
+def rules():
+    pass
+
+
+@click.command(help="Compile a rules json into a binary artifact that `run map` and `etl` load instead of parsing the json")
+@click.option("-o","--output",default=None,
+              help="where to write the compiled rules, the default is the cache, keyed by the hash of the json, where they are found automatically")
+@click.argument("rules_file")
+def compile(rules_file,output):
+    logger = Logger("rules::compile")
+    start = time.time()
+    with open(rules_file,'rb') as f:
+        data = f.read()
+    content_hash = cr.content_hash(data)
+    rules = carrot.tools.load_json(rules_file)
+    compiled = cr.compile_rules(rules,content_hash)
+
+    if output is None:
+        output = cr.get_artifact_path(content_hash)
+    cr.write_compiled_rules(compiled,output)
+
+    nobjects = sum(len(x) for x in compiled['cdm'].values())
+    logger.info(f"compiled {nobjects} objects ({compiled.nterm_maps} distinct term mappings) "
+                f"from {rules_file} in {time.time()-start:.2f} seconds")
+    print (output)
+
+
+@click.command(help="Show the cache of compiled rules")
+@click.option("--clear",is_flag=True,help="remove all compiled rules from the cache")
+def cache(clear):
+    _dir = cr.get_cache_dir()
+    if not os.path.exists(_dir):
+        return
+    for fname in sorted(os.listdir(_dir)):
+        path = os.path.join(_dir,fname)
+        if clear:
+            os.remove(path)
+        else:
+            print (path,os.path.getsize(path))
+
+
+rules.add_command(compile,"compile")
+rules.add_command(cache,"cache")
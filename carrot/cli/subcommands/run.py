@@ -1,15 +1,14 @@
-import pandas as pd
 import csv
 import inspect
 import os, time
 import datetime
-import fnmatch
 import sys
 import click
 import json
 import yaml
 import glob
 import copy
+import shutil
 import subprocess
 import cProfile, pstats
 import carrot
@@ -167,36 +166,22 @@ def format(inputs,number_of_rows_per_chunk,output_folder):
 
 @click.command()
 @click.option("--output-folder","-o",required=True,type=str,help='specify an output folder of where to put the merged tables')
+@click.option("--chunksize",default=100000,type=int,help='number of rows to load at a time from each file')
+@click.option("--workers","-j",default=1,type=int,help='number of tables to merge in parallel')
+@click.option("--keep-duplicates",is_flag=True,help='dont remove duplicate rows')
+@click.option("--keep-ids",is_flag=True,help='dont renumber the primary keys')
 @click.argument("inputs",nargs=-1,required=True)
-def merge(inputs,output_folder):
+def merge(inputs,output_folder,chunksize=100000,workers=1,keep_duplicates=False,keep_ids=False):
     """
-    Build a CDM model from subfiles
+    Merge (split) output files into one file per CDM table.
+    INPUTS can be files or folders of .tsv/.csv files
     """
-    types = list(set([
-        os.path.splitext(fname)[1]
-        for fname in inputs
-    ]))
-    if len(types) > 1:
-        raise Exception(f"Running with mixed input files '{types}'. Only input tsv or csv files.")
-    types = types[0]
-
-    inputs = {
-        os.path.basename(x):x
-        for x in inputs
-    }
-    if types == '.csv':
-        inputs = tools.load_csv(inputs)#,chunksize=number_of_rows_per_chunk)
-    else:
-        inputs = tools.load_tsv(inputs)#,chunksize=number_of_rows_per_chunk)
-
-    outputs = carrot.tools.create_csv_store(output_folder=output_folder,sep='\t',write_mode='w',write_separate=False)
-
-    cdm = carrot.cdm.CommonDataModel.from_existing(inputs=inputs,
-                                                      do_mask_person_id=False,
-                                                      drop_duplicates=True,
-                                                      format_level=0,
-                                                      outputs=outputs)
-    cdm.process()
+    from carrot.tools.merge import merge as merge_tables
+    merge_tables(inputs,output_folder,
+                 workers=workers,
+                 chunksize=chunksize,
+                 drop_duplicates=not keep_duplicates,
+                 renumber=not keep_ids)
 
 
 @click.command(help="loading")
@@ -234,6 +219,7 @@ def format_input_data(column,operation,input):
     allowed_operations = optools.keys()
     if operation not in allowed_operations:
         raise Exception(f"Operation '{operation}' is not a known operation. Choose from {allowed_operations}")
+    import pandas as pd
     df_input = pd.read_csv(input)
     df_input[column] = optools[operation](df_input[column])
     n = 5 if len(df_input) > 5 else len(df_input)
@@ -256,9 +242,19 @@ from importlib import import_module
 
 @click.command()
 @click.option("analysis_name","--analysis",default=None,type=str)
+@click.option("--snapshot",default=None,type=click.Path(exists=True),
+              help="snapshot of the processed tables to run the analysis on, instead of rerunning the ETL")
+@click.option("cdm","--cdm",default=None,multiple=True,type=click.Path(exists=True),
+              help="CDM output files/folder to run the analyses on with an sql engine, instead of rerunning the ETL")
+@click.option("--sql-engine",default=None,type=click.Choice(['duckdb','sqlite']),
+              help="sql engine to use with --cdm, the default is duckdb if installed, otherwise sqlite")
+@click.option("--database",default=None,type=str,
+              help="database file for the sql engine, an sqlite database can be reused between runs")
+@click.option("--max-workers",default=None,type=int)
+@click.option("--threads",is_flag=True,help="run the analyses in threads rather than processes")
 @click.argument("analysis_file")
 @click.pass_context
-def analysis(ctx,analysis_file,analysis_name):
+def analysis(ctx,analysis_file,analysis_name,snapshot,cdm,sql_engine,database,max_workers,threads):
     """
     Use this command to run analyses on input data (in the CDM format) given a configuration yaml file
     """
@@ -266,26 +262,48 @@ def analysis(ctx,analysis_file,analysis_name):
     fname = os.path.splitext(os.path.basename(analysis_file))[0]
     sys.path.append(_dir)
     module = import_module(fname)
-    clsmembers = inspect.getmembers(module, inspect.isclass)
+    #use the first class defined in the file, rather than any imported into it
+    clsmembers = [(name,cls) for name,cls in inspect.getmembers(module, inspect.isclass)
+                  if cls.__module__ == module.__name__]
     name,cls = clsmembers[0]
+    if snapshot or cdm:
+        #the tables already exist, so only the analyses of the class are needed
+        if snapshot:
+            obj = carrot.cdm.CommonDataModel.from_tables(carrot.cdm.load_snapshot(snapshot))
+        else:
+            backend = carrot.cdm.SqlBackend(list(cdm),engine=sql_engine,database=database)
+            obj = carrot.cdm.CommonDataModel.from_sql(backend)
+        analyses = {x:getattr(cls,x) for x in dir(cls)
+                    if isinstance(getattr(cls,x),carrot.cdm.decorators.analysis)}
+        if analysis_name:
+            res = obj.run_analysis(analyses[analysis_name])
+            print (res)
+        else:
+            obj.run_analyses(analyses,max_workers=max_workers,processes=not threads)
+        if cdm:
+            backend.close()
+        return
     obj = cls()
     if analysis_name:
         ana = obj.get_analysis(analysis_name)
         res = obj.run_analysis(ana)
         print (res)
     else:
-        #print (obj.get_analyses())
-        #exit(0)
-        obj.run_analyses()
+        obj.run_analyses(max_workers=max_workers,processes=not threads)
 
 
 @click.command()
 @click.option("--max-workers",default=None,type=int)
+@click.option("--threads",is_flag=True,help="run the analyses in threads rather than processes")
+@click.option("--sql-engine",default=None,type=click.Choice(['duckdb','sqlite']),
+              help="query the cdm files with an sql engine, rather than loading them into memory")
+@click.option("--database",default=None,type=str,
+              help="database file for the sql engine, an sqlite database can be reused between runs")
 @click.option("--batch",default=None,type=click.Choice(['condor']))
 @click.option("analysis_names","--analysis-name",default=None,multiple=True,type=str)
 @click.argument("config")
 @click.pass_context
-def ___analysis(ctx,config,analysis_names,max_workers,batch):
+def ___analysis(ctx,config,analysis_names,max_workers,threads,sql_engine,database,batch):
     """
     Use this command to run analyses on input data (in the CDM format) given a configuration yaml file
     """
@@ -294,11 +312,13 @@ def ___analysis(ctx,config,analysis_names,max_workers,batch):
     stream = open(config)
     config = yaml.safe_load(stream)
 
-    inputs = config['cdm']
-    inputs = carrot.tools.load_tsv(config['cdm'],
-                                      dtype=None)
-
-    cdm = carrot.cdm.CommonDataModel.load(inputs=inputs)
+    if sql_engine:
+        backend = carrot.cdm.SqlBackend(config['cdm'],engine=sql_engine,database=database)
+        cdm = carrot.cdm.CommonDataModel.from_sql(backend)
+    else:
+        inputs = carrot.tools.load_tsv(config['cdm'],
+                                       dtype=None)
+        cdm = carrot.cdm.CommonDataModel.load(inputs=inputs)
 
     analyses = config['analyses']
 
@@ -329,7 +349,7 @@ def ___analysis(ctx,config,analysis_names,max_workers,batch):
             f = func.create_analysis(cohort)
         cdm.add_analysis(f)
 
-    results = cdm.run_analyses(max_workers=max_workers)
+    results = cdm.run_analyses(max_workers=max_workers,processes=not threads)
 
 
 
@@ -347,6 +367,9 @@ def ___analysis(ctx,config,analysis_names,max_workers,batch):
 @click.option("--use-profiler",
               is_flag=True,
               help="turn on saving statistics for profiling CPU and memory usage")
+@click.option("--trace",
+              is_flag=True,
+              help="save a (Chrome trace-event) json of the timing of each processing stage to the logs folder")
 @click.option("format_level","--format-level",
               default='1',
               type=click.Choice(['0','1','2']),
@@ -361,6 +384,14 @@ def ___analysis(ctx,config,analysis_names,max_workers,batch):
 @click.option("--split-outputs",
               is_flag=True,
               help="force the output files to be split into separate files")
+@click.option("--compression",
+              default=None,
+              type=click.Choice(['gzip','zstd']),
+              help="compress the output files, e.g. person.tsv.gz")
+@click.option("--partitions",
+              default=None,
+              type=int,
+              help="split the output of each table into this number of files by a hash of the person_id, described by a manifest.json")
 @click.option("--allow-missing-data",
               is_flag=True,
               help="don't crash if there is data tables in rules file that hasnt been loaded")
@@ -374,6 +405,25 @@ def ___analysis(ctx,config,analysis_names,max_workers,batch):
               default=None,
               type=int,
               help="the total number of rows to process")
+@click.option("--memory-budget",
+              default=None,
+              type=str,
+              help="memory (e.g. 4G) to stay within, the chunksize is adapted between chunks to use up to this amount of memory. Starts from the given chunksize if set.")
+@click.option("--compact-strings",
+              is_flag=True,
+              help="load low cardinality input columns as categoricals, saving memory and speeding up term mappings")
+@click.option("--resume",
+              is_flag=True,
+              help="carry on an interrupted (chunked) run from the last chunk it completed, using the checkpoint in the output folder")
+@click.option("--copartition",
+              is_flag=True,
+              help="first split the chunked (-nc) inputs by a hash of their person_id, so each chunk holds all the rows of its persons in every input")
+@click.option("--backend",
+              default='pandas',
+              type=click.Choice(['pandas','polars','sql']),
+              help="execute the rules with pandas, as lazy polars plans (needs polars and pyarrow), or compiled to sql (see --sql-engine)")
+@click.option("--sql-engine",default=None,type=click.Choice(['duckdb','sqlite']),
+              help="sql engine to run the rules in with --backend sql, the default is duckdb if installed, otherwise sqlite")
 @click.option("--person-id-map",
               default=None,
               help="pass the location of a file containing existing masked person_ids")
@@ -412,13 +462,14 @@ def ___analysis(ctx,config,analysis_names,max_workers,batch):
 @click.pass_context
 def map(ctx,rules,inputs,format_level,
         output_folder,output_database,
-        csv_separator,use_profiler,log_file,
+        csv_separator,use_profiler,trace,log_file,
         no_mask_person_id,indexing_conf,
         person_id_map,max_rules,merge_output,
         objects,tables,db,write_mode,split_outputs,
         dont_automatically_fill_missing_columns,
         number_of_rows_per_chunk,allow_missing_data,
-        number_of_rows_to_process):
+        number_of_rows_to_process,memory_budget=None,compact_strings=False,resume=False,
+        partitions=None,compression=None,copartition=False,backend='pandas',sql_engine=None):
     """
     Perform OMOP Mapping given an json file and a series of input files
 
@@ -437,11 +488,11 @@ def map(ctx,rules,inputs,format_level,
     else:
         carrot.params['log_file'] = log_file
 
-    #load the json loads
+    #load the json loads (or the compiled rules, if they exist)
     if type(rules) == dict:
         config = rules
     else:
-        config = tools.load_json(rules)
+        config = tools.load_rules(rules)
 
     if tables:
         tables = list(set(tables))
@@ -477,6 +528,7 @@ def map(ctx,rules,inputs,format_level,
         elif indexing_conf.endswith(".json") and os.path.exists(indexing_conf):
             indexing_conf = tools.load_json(indexing_conf)
         elif indexing_conf.endswith(".csv") and os.path.exists(indexing_conf):
+            import pandas as pd
             try:
                 indexing_conf = pd.read_csv(indexing_conf,header=None,index_col=0)[1].to_dict()
             except pd.errors.EmptyDataError:
@@ -525,20 +577,31 @@ def map(ctx,rules,inputs,format_level,
                 new_inputs.append(x)
         inputs = new_inputs
 
-    inputs = list(inputs)
-
+    files = []
     for x in inputs:
         if os.path.isdir(x):
-            inputs.remove(x)
-            inputs.extend(glob.glob(f'{x}{os.path.sep}*.csv'))
+            #including compressed files e.g. .csv.gz
+            files.extend(tools.get_files(x,type='csv'))
+        else:
+            files.append(x)
 
-    #convert the list into a map between the filename and the full path
-    inputs = {
-        os.path.basename(x):x
-        for x in inputs
-    }
+    #convert the list into a map between the source table name and the full path,
+    #or the paths of the parts of a source table that has been split into several files
+    inputs = tools.get_file_map(files)
 
-    if db:
+    if backend == 'sql' and not db:
+        if allow_missing_data:
+            config = carrot.tools.remove_missing_sources_from_rules(config,inputs)
+        if number_of_rows_per_chunk is not None or copartition:
+            tools.logger._Logger("map").warning("the sql backend maps whole input files, chunking is ignored")
+        #the input files are loaded into the sql engine, rather than by the model
+        backend = carrot.cdm.RulesSqlBackend(inputs,
+                                             fields=tools.get_mapped_fields_from_rules(config),
+                                             engine=sql_engine,
+                                             format_level=int(format_level))
+        inputs = None
+        copartition = False
+    elif db:
         inputs = tools.load_sql(connection_string=db,chunksize=number_of_rows_per_chunk,nrows=number_of_rows_to_process)
     else:
         if allow_missing_data:
@@ -547,7 +610,15 @@ def map(ctx,rules,inputs,format_level,
         inputs = tools.load_csv(inputs,
                                 rules=config,
                                 chunksize=number_of_rows_per_chunk,
-                                nrows=number_of_rows_to_process)
+                                nrows=number_of_rows_to_process,
+                                memory_budget=memory_budget,
+                                compact_strings=compact_strings)
+        if copartition:
+            if inputs.chunksize is None:
+                raise click.UsageError("--copartition splits chunked inputs, give a chunksize with -nc")
+            inputs = carrot.io.copartition(inputs,
+                                           tools.get_person_ids(config),
+                                           work_dir=f'{output_folder}{os.path.sep}.copartitioned')
 
     #do something with
     #person_id_map
@@ -558,14 +629,17 @@ def map(ctx,rules,inputs,format_level,
                                                           output_folder=output_database['cache'],
                                                           sep=csv_separator,
                                                           write_separate=split_outputs,
-                                                          write_mode=write_mode)
+                                                          write_mode=write_mode,
+                                                          compression=compression)
         else:
             raise NotImplementedError(f"dont know how to configure outputs... {output_database}")
     elif output_database == None:
         outputs = carrot.tools.create_csv_store(output_folder=output_folder,
                                                    sep=csv_separator,
                                                    write_separate=split_outputs,
-                                                   write_mode=write_mode)
+                                                   write_mode=write_mode,
+                                                   partitions=partitions,
+                                                   compression=compression)
     else:
         outputs = carrot.tools.create_sql_store()
 
@@ -578,15 +652,21 @@ def map(ctx,rules,inputs,format_level,
                                         #output_folder=output_folder,
                                         #output_database=output_database,
                                         automatically_fill_missing_columns=not dont_automatically_fill_missing_columns,
-                                        use_profiler=use_profiler)
+                                        use_profiler=use_profiler,
+                                        trace=trace,
+                                        backend=backend)
     #allow the csv separator to be changed
     #the default is tab (\t) separation
     #if not csv_separator is None:
     #    cdm.set_csv_separator(csv_separator)
     cdm.create_and_add_objects(config)
 
-    cdm.process(conserve_memory=True)
+    cdm.process(conserve_memory=True,resume=resume)
     cdm.close()
+    if isinstance(backend,carrot.cdm.RulesSqlBackend):
+        backend.close()
+    if copartition and not db:
+        shutil.rmtree(f'{output_folder}{os.path.sep}.copartitioned')
 
     if merge_output:
         ctx.invoke(merge,
@@ -628,13 +708,23 @@ def map(ctx,rules,inputs,format_level,
               required=False,
               default=0,
               help="Lower outcount limit for logfile output")
+@click.option("--compression",
+              default=None,
+              type=click.Choice(['gzip','zstd']),
+              help="compress the output tsv files, e.g. person.tsv.gz")
 @click.argument("input-dir",
                 required=False,
                 nargs=-1)
-def mapstream(rules_file, output_dir, write_mode, person_file, omop_ddl_file, omop_config_file, saved_person_id_file, use_input_person_ids, last_used_ids_file, log_file_threshold, input_dir):
+def mapstream(rules_file, output_dir, write_mode, person_file, omop_ddl_file, omop_config_file, saved_person_id_file, use_input_person_ids, last_used_ids_file, log_file_threshold, input_dir, compression=None):
     """
     Map to output using input streams
     """
+    from carrot.io.compression import open_output, open_input, get_compression_pool, extensions as compression_extensions
+    outext = ".tsv"
+    #threads compressing the outputs, shared by all the output files
+    compression_pool = get_compression_pool()
+    if compression != None:
+        outext += "." + compression_extensions[compression]
     print(input_dir)
     if os.path.isdir(input_dir[0]) == False:
         print("Not a directory, input dir {0}".format(input_dir[0]))
@@ -645,7 +735,7 @@ def mapstream(rules_file, output_dir, write_mode, person_file, omop_ddl_file, om
         sys.exit(1)
 
     if saved_person_id_file == None:
-        saved_person_id_file = output_dir + "/" + "person_ids.tsv"
+        saved_person_id_file = output_dir + "/" + "person_ids" + outext
         if os.path.exists(saved_person_id_file):
             os.remove(saved_person_id_file)
    
@@ -680,13 +770,13 @@ def mapstream(rules_file, output_dir, write_mode, person_file, omop_ddl_file, om
         #fhp = open(person_file, mode="r", encoding="utf-8-sig")
         #csvrp = csv.reader(fhp)
         person_lookup, rejected_person_count = load_person_ids(person_file, person_lookup, mappingrules, use_input_person_ids, last_used_integer)
-        fhpout = open(saved_person_id_file, mode="w")
+        fhpout = open_output(saved_person_id_file, mode="w")
         fhpout.write("SOURCE_SUBJECT\tTARGET_SUBJECT\n")
         for person_id, person_assigned_id in person_lookup.items():
             fhpout.write("{0}\t{1}\n".format(str(person_id), str(person_assigned_id)))
         fhpout.close()
         for tgtfile in output_files:
-            fhd[tgtfile] = open(output_dir + "/" + tgtfile + ".tsv", mode=write_mode)
+            fhd[tgtfile] = open_output(output_dir + "/" + tgtfile + outext, mode=write_mode, compression=compression, pool=compression_pool)
             if write_mode == 'w':
                 outhdr = omopcdm.get_omop_column_list(tgtfile)
                 fhd[tgtfile].write("\t".join(outhdr) + "\n")
@@ -699,7 +789,9 @@ def mapstream(rules_file, output_dir, write_mode, person_file, omop_ddl_file, om
     print("person_id stats: total loaded {0}, reject count {1}".format(len(person_lookup), rejected_person_count))
 
     # TODO get this list of input files from the  parsed rules
-    existing_input_files = fnmatch.filter(os.listdir(input_dir[0]), '*.csv')
+    #including compressed files, and tables split into several parts
+    input_file_map = tools.get_file_map_from_dir(input_dir[0])
+    existing_input_files = list(input_file_map.keys())
     rules_input_files = mappingrules.get_all_infile_names()
     for infile in existing_input_files:
         if infile not in rules_input_files:
@@ -726,7 +818,7 @@ def mapstream(rules_file, output_dir, write_mode, person_file, omop_ddl_file, om
         rcount = 0
 
         try:
-            fh = open(input_dir[0] + "/" + srcfilename, mode="r", encoding="utf-8-sig")
+            fh = open_input(input_file_map.get(srcfilename, input_dir[0] + "/" + srcfilename), encoding="utf-8-sig")
             csvr = csv.reader(fh)
         except IOError as e:
             print("Unable to open: {0}".format(input_dir[0] + "/" + srcfilename))
@@ -735,9 +827,14 @@ def mapstream(rules_file, output_dir, write_mode, person_file, omop_ddl_file, om
 
         tgtfiles, src_to_tgt = mappingrules.parse_rules_src_to_tgt(srcfilename)
         infile_datetime_source, infile_person_id_source = mappingrules.get_infile_date_person_id(srcfilename)
+        #ids of the metrics keys that are the same for every row of this input
+        src_key = metrics.key_id((srcfilename, "all", "all", "all", ""))
+        tgt_keys = {}
         for tgtfile in tgtfiles:
             outcounts[tgtfile] = 0
             rejcounts[tgtfile] = 0
+            tgt_keys[tgtfile] = (metrics.key_id(("all", "all", tgtfile, "all", "")),
+                                 metrics.key_id((srcfilename, "all", tgtfile, "all", "")))
         datacolsall = []
         hdrdata = next(csvr)
         dflist = mappingrules.get_infile_data_fields(srcfilename)
@@ -752,8 +849,7 @@ def mapstream(rules_file, output_dir, write_mode, person_file, omop_ddl_file, om
 
         for indata in csvr:
             #indata = inputline.strip().split(",")
-            key = srcfilename + "~all~all~all~"
-            metrics.increment_key_count(key, "input_count")
+            metrics.increment(src_key, "input_count")
             rcount += 1
             strdate = indata[datetime_col].split(" ")[0]
             fulldate = parse_date(strdate)
@@ -761,13 +857,15 @@ def mapstream(rules_file, output_dir, write_mode, person_file, omop_ddl_file, om
                 #fulldate = "{0}-{1:02}-{2:02}".format(dt.year, dt.month, dt.day)
                 indata[datetime_col] = fulldate
             else:
-                metrics.increment_key_count(key, "invalid_date_fields")
+                metrics.increment(src_key, "invalid_date_fields")
                 continue
 
             for tgtfile in tgtfiles:
                 tgtcolmap = tgtcolmaps[tgtfile]
-                auto_num_col = omopcdm.get_omop_auto_number_field(tgtfile)
-                pers_id_col = omopcdm.get_omop_person_id_field(tgtfile)
+                tgtschema = omopcdm.get_table(tgtfile)
+                auto_num_idx = tgtschema.auto_number_index
+                pers_id_idx = tgtschema.person_id_index
+                tgt_key, src_tgt_key = tgt_keys[tgtfile]
 
                 datacols = datacolsall
                 if tgtfile in dflist:
@@ -777,36 +875,26 @@ def mapstream(rules_file, output_dir, write_mode, person_file, omop_ddl_file, om
                     built_records, outrecords, metrics = get_target_records(tgtfile, tgtcolmap, src_to_tgt, datacol, indata, inputcolmap, srcfilename, omopcdm, metrics)
                     if built_records == True:
                         for outrecord in outrecords:
-                            if auto_num_col != None:
-                                outrecord[tgtcolmap[auto_num_col]] = str(record_numbers[tgtfile])
+                            if auto_num_idx != None:
+                                outrecord[auto_num_idx] = str(record_numbers[tgtfile])
                                 record_numbers[tgtfile] += 1
-                            if (outrecord[tgtcolmap[pers_id_col]]) in person_lookup:
-                                outrecord[tgtcolmap[pers_id_col]] = person_lookup[outrecord[tgtcolmap[pers_id_col]]]
+                            if (outrecord[pers_id_idx]) in person_lookup:
+                                outrecord[pers_id_idx] = person_lookup[outrecord[pers_id_idx]]
                                 outcounts[tgtfile] += 1
-                                key = srcfilename + "~all~all~all~"
-                                metrics.increment_key_count(key, "output_count")
-                                key = "all~all~" + tgtfile + "~all~"
-                                metrics.increment_key_count(key, "output_count")
-                                key = srcfilename + "~all~" + tgtfile + "~all~"
-                                metrics.increment_key_count(key, "output_count")
+                                metrics.increment(src_key, "output_count")
+                                metrics.increment(tgt_key, "output_count")
+                                metrics.increment(src_tgt_key, "output_count")
                                 if tgtfile == "person":
-                                    key = srcfilename + "~all~" + tgtfile + "~" + outrecord[1] +"~"
-                                    metrics.increment_key_count(key, "output_count")
-                                    key = srcfilename + "~" + datacol +"~" + tgtfile + "~" + outrecord[1] + "~" + outrecord[2]
-                                    metrics.increment_key_count(key, "output_count")
+                                    metrics.increment((srcfilename, "all", tgtfile, outrecord[1], ""), "output_count")
+                                    metrics.increment((srcfilename, datacol, tgtfile, outrecord[1], outrecord[2]), "output_count")
                                 else:
-                                    key = srcfilename + "~" + datacol +"~" + tgtfile + "~" + outrecord[2] + "~"
-                                    metrics.increment_key_count(key, "output_count")
-                                    key = srcfilename + "~all~" + tgtfile + "~" + outrecord[2] + "~"
-                                    metrics.increment_key_count(key, "output_count")
-                                    key = "all~all~" + tgtfile + "~" + outrecord[2] + "~"
-                                    metrics.increment_key_count(key, "output_count")
-                                    key = "all~all~all~" + outrecord[2] + "~"
-                                    metrics.increment_key_count(key, "output_count")
+                                    metrics.increment((srcfilename, datacol, tgtfile, outrecord[2], ""), "output_count")
+                                    metrics.increment((srcfilename, "all", tgtfile, outrecord[2], ""), "output_count")
+                                    metrics.increment(("all", "all", tgtfile, outrecord[2], ""), "output_count")
+                                    metrics.increment(("all", "all", "all", outrecord[2], ""), "output_count")
                                 fhd[tgtfile].write("\t".join(outrecord) + "\n")
                             else:
-                                key = srcfilename + "~all~" + tgtfile + "~all~"
-                                metrics.increment_key_count(key, "invalid_person_ids")
+                                metrics.increment(src_tgt_key, "invalid_person_ids")
                                 rejidcounts[srcfilename] += 1
 
         fh.close()
@@ -816,6 +904,11 @@ def mapstream(rules_file, output_dir, write_mode, person_file, omop_ddl_file, om
         for outtablename, count in outcounts.items():
             print("TARGET: {0}: output count {1}".format(outtablename, str(count)))
 
+    #compressed outputs are only complete once closed
+    for tgtfile in fhd:
+        fhd[tgtfile].close()
+    compression_pool.shutdown()
+
     print("--------------------------------------------------------------------------------")
     data_summary = metrics.get_mapstream_summary()
     log_report = metrics.get_log_data()
@@ -839,12 +932,12 @@ def mapstream(rules_file, output_dir, write_mode, person_file, omop_ddl_file, om
 def get_target_records(tgtfilename, tgtcolmap, rulesmap, srcfield, srcdata, srccolmap, srcfilename, omopcdm, metrics):
     build_records = False
     tgtrecords = []
-    date_col_data = omopcdm.get_omop_datetime_linked_fields(tgtfilename)
-    date_component_data = omopcdm.get_omop_date_field_components(tgtfilename)
-    notnull_numeric_fields = omopcdm.get_omop_notnull_numeric_fields(tgtfilename)
+    tgtschema = omopcdm.get_table(tgtfilename)
+    date_col_data = tgtschema.datetime_linked_fields
+    date_component_data = tgtschema.date_field_components
 
     srckey = srcfilename + "~" + srcfield + "~" + tgtfilename
-    summarykey = srcfilename + "~" + srcfield + "~" + tgtfilename + "~all~"
+    summarykey = (srcfilename, srcfield, tgtfilename, "all", "")
     if valid_value(str(srcdata[srccolmap[srcfield]])):
         srcfullkey = srcfilename + "~" + srcfield + "~" + str(srcdata[srccolmap[srcfield]]) + "~" + tgtfilename
         dictkeys = []
@@ -858,9 +951,7 @@ def get_target_records(tgtfilename, tgtcolmap, rulesmap, srcfield, srcdata, srcc
             for dictkey in dictkeys:
                 for out_data_elem in rulesmap[dictkey]:
                     valid_data_elem = True
-                    tgtarray = ['']*len(tgtcolmap)
-                    for req_integer in notnull_numeric_fields:
-                        tgtarray[tgtcolmap[req_integer]] = "0"
+                    tgtarray = list(tgtschema.row_template)
                     for infield, outfield_list in out_data_elem.items():
                         for output_col_data in outfield_list:
                             if "~" in output_col_data:
@@ -881,7 +972,7 @@ def get_target_records(tgtfilename, tgtcolmap, rulesmap, srcfield, srcdata, srcc
                                     fulldate = "{0}-{1:02}-{2:02}".format(dt.year, dt.month, dt.day)
                                     tgtarray[tgtcolmap[output_col_data]] = fulldate
                                 else:
-                                    metrics.increment_key_count(summarykey, "invalid_date_fields")
+                                    metrics.increment(summarykey, "invalid_date_fields")
                                     valid_data_elem = False
                             elif output_col_data in date_col_data:
                                 fulldate = srcdata[srccolmap[infield]]
@@ -890,7 +981,7 @@ def get_target_records(tgtfilename, tgtcolmap, rulesmap, srcfield, srcdata, srcc
                     if valid_data_elem == True:
                         tgtrecords.append(tgtarray)
     else:
-        metrics.increment_key_count(summarykey, "invalid_source_fields")
+        metrics.increment(summarykey, "invalid_source_fields")
 
 
     return build_records, tgtrecords, metrics
@@ -1007,7 +1098,8 @@ def load_last_used_ids(last_used_ids_file, last_used_ids):
     return last_used_ids
 
 def load_saved_person_ids(person_file):
-    fh = open(person_file, mode="r", encoding="utf-8-sig")
+    from carrot.io.compression import open_input
+    fh = open_input(person_file, encoding="utf-8-sig")
     csvr = csv.reader(fh, delimiter="\t")
     last_int = 1
     person_ids = {}
@@ -1021,7 +1113,8 @@ def load_saved_person_ids(person_file):
     return person_ids, last_int
 
 def load_person_ids(person_file, person_ids, mappingrules, use_input_person_ids, person_number=1, delim=","):
-    fh = open(person_file, mode="r", encoding="utf-8-sig")
+    from carrot.io.compression import open_input
+    fh = open_input(person_file, encoding="utf-8-sig")
     csvr = csv.reader(fh, delimiter=delim)
     person_columns = {}
     person_col_in_hdr_number = 0
@@ -1083,6 +1176,9 @@ def load_person_ids(person_file, person_ids, mappingrules, use_input_person_ids,
               default=None,
               type=int,
               help="the total number of rows to process")
+@click.option("--copartition",
+              is_flag=True,
+              help="first split the chunked (-nc) inputs by a hash of their person_id, so each chunk holds all the rows of its persons in every input")
 @click.argument("inputs",
                 #help="give a list of input files to process, and/or an input directory",
                 nargs=-1)
@@ -1090,7 +1186,8 @@ def load_person_ids(person_file, person_ids, mappingrules, use_input_person_ids,
 def run_pyconfig(ctx,rules,pyconf,inputs,objects,
         output_folder,type,use_profiler,
         number_of_rows_per_chunk,
-        number_of_rows_to_process):
+        number_of_rows_to_process,
+        copartition=False):
 
     object_list = list(objects)
     if len(object_list) == 0:
@@ -1137,21 +1234,19 @@ def run_pyconfig(ctx,rules,pyconf,inputs,objects,
                             rules=rules,
                             chunksize=number_of_rows_per_chunk,
                             nrows=number_of_rows_to_process)
+    if copartition:
+        if inputs.chunksize is None:
+            raise click.UsageError("--copartition splits chunked inputs, give a chunksize with -nc")
+        inputs = carrot.io.copartition(inputs,
+                                       tools.get_person_ids(tools.load_json(rules)),
+                                       work_dir=f'{output_folder}{os.path.sep}.copartitioned')
 
     available_classes = tools.get_classes()
     if pyconf not in available_classes:
         ctx.invoke(list_classes)
         raise KeyError(f"cannot find config {pyconf}. Run 'carrot map py list' to see available classes.")
 
-    module = __import__(available_classes[pyconf]['module'],fromlist=[pyconf])
-    defined_classes = [
-        m[0]
-        for m in inspect.getmembers(module, inspect.isclass)
-        if m[1].__module__ == module.__name__
-    ]
-    #should only be running one class anyway
-    defined_class = defined_classes[0]
-    cls = getattr(module,defined_class)
+    cls = tools.registry.load_class(available_classes[pyconf])
 
     #build a class object
     cdm = cls(inputs=inputs,
@@ -1159,6 +1254,8 @@ def run_pyconfig(ctx,rules,pyconf,inputs,objects,
               use_profiler=use_profiler)
     #run it
     cdm.process(object_list)
+    if copartition:
+        shutil.rmtree(f'{output_folder}{os.path.sep}.copartitioned')
 
 @click.command(help="run as a Graphical User Interface (GUI)")
 @click.pass_context
@@ -1,4 +1,18 @@
-from .plugins.local import LocalDataCollection
-from .plugins.sql import SqlDataCollection
-from .plugins.bclink import BCLinkDataCollection
 from .common import DataCollection,DataBrick
+import importlib
+
+#plugins are only imported when used, e.g. the sql plugin needs sqlalchemy
+_plugins = {
+    'LocalDataCollection':'.plugins.local',
+    'SqlDataCollection':'.plugins.sql',
+    'BCLinkDataCollection':'.plugins.bclink',
+    'CoPartitionedDataCollection':'.copartition',
+    'copartition':'.copartition'
+}
+
+def __getattr__(name):
+    if name not in _plugins:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_plugins[name],__name__),name)
+    globals()[name] = value
+    return value
@@ -1,18 +1,95 @@
 import pandas as pd
 from carrot.tools.logger import Logger
+from carrot.tools.tracing import get_tracer, nbytes
+from carrot.tools.profiling import MemoryMonitor, parse_memory
+from carrot.io.compression import InputStream, open_input
 from types import GeneratorType
+import itertools
 import io
+import os
+
+class ChunkSizeController(Logger):
+    """
+    Adapt the chunksize between chunks to keep the memory (RSS) of the process under a budget.
+    The bytes per row are measured on the first chunk, then the peak RSS while processing
+    each chunk is used to grow (or shrink) the chunksize for the next chunk.
+    """
+    def __init__(self,memory_budget,chunksize=None,
+                 min_chunksize=1000,max_chunksize=None,
+                 safety=0.8,max_growth=2):
+        self.memory_budget = parse_memory(memory_budget)
+        self.safety = safety
+        self.max_growth = max_growth
+        self.min_chunksize = min_chunksize
+        self.max_chunksize = max_chunksize
+        self.chunksize = chunksize if chunksize else 10*min_chunksize
+        self.bytes_per_row = None
+        self.monitor = MemoryMonitor()
+        self.baseline = self.monitor.current()
+        self.logger.info(f"Using a memory budget of {self.memory_budget/2**20:.1f}MB "
+                         f"starting with a chunksize of {self.chunksize}")
+        if self.baseline > self.memory_budget*self.safety:
+            self.logger.warning(f"{self.baseline/2**20:.1f}MB already used, "
+                                f"this is close to the memory budget!")
+
+    def update(self,dfs):
+        """
+        Work out the chunksize for the next chunk, given the last chunk of data for each input
+        """
+        rows = max([len(df) for df in dfs],default=0)
+        peak = self.monitor.reset()
+        if rows == 0:
+            return self.chunksize
+
+        if self.bytes_per_row is None:
+            self.bytes_per_row = sum(df.memory_usage(index=False,deep=True).sum() for df in dfs)/rows
+            self.logger.info(f"measured {self.bytes_per_row:.1f} bytes per row of input data")
+
+        target = self.memory_budget*self.safety
+        #the memory used while processing the last chunk
+        used_per_row = max((peak - self.baseline)/rows,self.bytes_per_row)
+        if peak > target:
+            #shrink by at least a half
+            chunksize = min(rows*(target - self.baseline)/(peak - self.baseline),self.chunksize/2)
+        else:
+            #grow into the remaining headroom, limiting how quickly this can happen
+            chunksize = min(self.chunksize + (target - peak)/used_per_row,self.chunksize*self.max_growth)
+
+        chunksize = max(int(chunksize),self.min_chunksize)
+        if self.max_chunksize:
+            chunksize = min(chunksize,self.max_chunksize)
+
+        self.logger.info(f"peak memory {peak/2**20:.1f}MB for {rows} rows, "
+                         f"changing the chunksize from {self.chunksize} to {chunksize}")
+        self.chunksize = chunksize
+        return chunksize
+
 
 class DataCollection(Logger):
-    def __init__(self,chunksize=None,nrows=None,**kwargs):
+    #if each chunk holds the same persons in every input, see carrot.io.copartition
+    aligned = False
+
+    def __init__(self,chunksize=None,nrows=None,memory_budget=None,**kwargs):
         self.logger.info("DataCollection Object Created")
         self.__bricks = {}
+        self.index_map = {}
         self.chunksize = chunksize
         self.nrows = nrows
+        self.controller = None
+
+        if memory_budget is not None:
+            self.set_memory_budget(memory_budget)
 
         if self.chunksize is not None:
             self.logger.info(f"Using a chunksize of '{self.chunksize}' nrows")
 
+    def set_memory_budget(self,memory_budget,**kwargs):
+        """
+        Adapt the chunksize between chunks to stay within a memory budget (bytes or e.g. '4G')
+        """
+        self.controller = ChunkSizeController(memory_budget,chunksize=self.chunksize,**kwargs)
+        self.chunksize = self.controller.chunksize
+
     def print(self):
         print (self.all())
 
@@ -37,6 +114,17 @@ class DataCollection(Logger):
     def load_global_ids(self):
         return
 
+    def set_index_map(self,index_map):
+        """
+        Index each chunk of the inputs on a column, e.g. the person_id, see CommonDataModel.set_indexing
+        """
+        self.index_map = dict(index_map)
+
+    def _set_index(self,key,df):
+        index = self.index_map.get(key)
+        if df is not None and index is not None and index in df.columns:
+            df.index = df[index].rename('index')
+
     def load_indexing(self):
         return
 
@@ -44,6 +132,11 @@ class DataCollection(Logger):
         #loop over all loaded files
         self.logger.info("Getting next chunk of data")
 
+        if self.controller is not None:
+            dfs = [brick.get_df() for brick in self.__bricks.values()
+                   if brick.is_init() and not brick.is_finished() and brick.get_df() is not None]
+            self.chunksize = self.controller.update(dfs)
+
         used_bricks = []
         for key,brick in self.items():
             if brick.is_finished():
@@ -55,8 +148,12 @@ class DataCollection(Logger):
                 continue
 
             self.logger.info(f"Getting the next chunk of size '{self.chunksize}' for '{key}'")
-            brick.get_chunk(self.chunksize)
-            n = len(brick.get_df())
+            with get_tracer().span('read',table=key) as span:
+                brick.get_chunk(self.chunksize)
+                df = brick.get_df()
+                self._set_index(key,df)
+                n = len(df)
+                span.set(rows_out=n,bytes=nbytes(df))
             self.logger.info(f"--> Got {n} rows")
             if n == 0:
                 brick.set_finished(True)
@@ -85,7 +182,12 @@ class DataCollection(Logger):
         brick = self.__bricks[key]
         if not brick.is_init():
             self.logger.info(f"Retrieving initial dataframe for '{key}' for the first time")
-            brick.get_chunk(self.chunksize)
+            with get_tracer().span('read',table=key) as span:
+                brick.get_chunk(self.chunksize)
+                df = brick.get_df()
+                self._set_index(key,df)
+                if df is not None:
+                    span.set(rows_out=len(df),bytes=nbytes(df))
             brick.set_init(True)
 
         #if any(not x.is_init() for x in self.__bricks.values()):
@@ -100,6 +202,78 @@ class DataCollection(Logger):
         for key,brick in self.items():
             brick.reset()
 
+    def get_positions(self):
+        """
+        Where the current chunk of each input starts, see DataBrick.get_position
+        """
+        return {key:brick.get_position() for key,brick in self.items()}
+
+    def seek(self,positions):
+        """
+        Move the inputs to the given positions, so the next chunks read start from there
+        """
+        for key,position in positions.items():
+            if position['rows'] > 0:
+                self.logger.info(f"moving '{key}' to row {position['rows']}")
+                self.__bricks[key].seek(position['rows'],position.get('offset'))
+
+    def get_checkpoint(self,tables):
+        raise NotImplementedError(f"{type(self).__name__} does not support checkpointing")
+
+    def rollback(self,checkpoint,tables):
+        raise NotImplementedError(f"{type(self).__name__} does not support checkpointing")
+
+
+def _get_input_stream(df_handler):
+    #the InputStream a csv reader is reading from, for compressed files or files split into parts
+    handle = getattr(getattr(df_handler,'handles',None),'handle',None)
+    raw = getattr(getattr(handle,'buffer',None),'raw',None)
+    return raw if isinstance(raw,InputStream) else None
+
+def _get_source_file(df_handler):
+    #the file a csv reader was opened from, if it was opened from a (plain) file
+    if not isinstance(df_handler,pd.io.parsers.TextFileReader):
+        return None
+    if _get_input_stream(df_handler) is not None:
+        return None
+    fname = getattr(df_handler,'attrs',{}).get('original_file')
+    if fname is None and hasattr(df_handler,'handles'):
+        fname = getattr(df_handler.handles.handle,'name',None)
+    if isinstance(fname,str) and os.path.isfile(fname):
+        return fname
+    return None
+
+
+class _LineScanner():
+    """
+    Find the byte offset of a row of a csv file by scanning forward over its lines.
+    The offset is only reliable if rows are single lines, so rows with unbalanced quotes
+    (a quoted newline) or blank lines (skipped by pandas) make the offsets unavailable
+    """
+    def __init__(self,fname,offset=None,rows=0):
+        self.f = open(fname,'rb')
+        if offset is None:
+            #skip the header
+            self.f.readline()
+        else:
+            self.f.seek(offset)
+        self.rows = rows
+        self.reliable = True
+
+    def offset(self,rows):
+        if not self.reliable or rows < self.rows:
+            return None
+        for line in itertools.islice(self.f,rows - self.rows):
+            if line.count(b'"') % 2 == 1 or not line.strip():
+                self.reliable = False
+                return None
+        self.rows = rows
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+
 class DataBrick:
     def __init__(self,df_handler,name=None):
         self.name = name
@@ -107,6 +281,13 @@ class DataBrick:
         self.__df = None
         self.__end = False
         self.__is_init = False
+        #rows read before the current chunk, and in total
+        self.__start = 0
+        self.__nread = 0
+        #the reader to go back to on reset, if this brick has been moved with seek
+        self.__origin = None
+        self.__file = None
+        self.__scanner = None
 
     def get_handler(self):
         return self.__df_handler
@@ -123,7 +304,92 @@ class DataBrick:
     def set_init(self,value):
         self.__is_init = value
 
+    def get_source_file(self):
+        return _get_source_file(self.__df_handler if self.__origin is None else self.__origin)
+
+    def get_source_files(self):
+        """
+        All the files read, i.e. also compressed files and the parts of a file split into many
+        """
+        handler = self.__df_handler if self.__origin is None else self.__origin
+        stream = _get_input_stream(handler)
+        if stream is not None:
+            return list(stream.fnames)
+        fname = _get_source_file(handler)
+        return [fname] if fname is not None else []
+
+    def get_position(self):
+        """
+        Where the current chunk starts in the input: the number of rows read before it
+        and (for csv files, where this can be found) the byte offset of its first row
+        """
+        position = {'rows':self.__start,'offset':None}
+        fname = self.get_source_file()
+        if fname is not None and self.__start > 0:
+            if self.__scanner is None:
+                self.__scanner = _LineScanner(fname)
+            position['offset'] = self.__scanner.offset(self.__start)
+            position['file'] = fname
+        return position
+
+    def seek(self,rows,offset=None):
+        """
+        Move to a position (see get_position), so the next chunk starts at the given row.
+        For a csv file the reader starts from the byte offset if given, otherwise the rows are skipped
+        """
+        self.reset()
+        if rows == 0:
+            return
+        if isinstance(self.__df_handler,pd.DataFrame):
+            self.__origin = self.__df_handler
+            self.__df_handler = self.__df_handler.iloc[rows:]
+        elif isinstance(self.__df_handler,pd.io.parsers.TextFileReader):
+            fname = _get_source_file(self.__df_handler)
+            stream = _get_input_stream(self.__df_handler)
+            if fname is None and stream is None:
+                raise NotImplementedError(f"cannot seek {self.name}, it was not read from a file")
+            options = dict(self.__df_handler.orig_options)
+            if options.get('nrows') is not None:
+                options['nrows'] = max(options['nrows'] - rows,0)
+            if offset is not None and fname is not None:
+                #read the column names from the header, then start reading from the offset
+                columns = pd.read_csv(fname,nrows=0,sep=options.get('delimiter'),
+                                      encoding=options.get('encoding')).columns
+                options['header'] = None
+                options['names'] = list(columns)
+                f = self.__file = open(fname,'rb')
+                f.seek(offset)
+                self.__scanner = _LineScanner(fname,offset=offset,rows=rows)
+            elif stream is not None:
+                #compressed files can only be read from the start
+                options['skiprows'] = range(1,rows+1)
+                f = self.__file = open_input(stream.fnames)
+            else:
+                options['skiprows'] = range(1,rows+1)
+                f = fname
+            attrs = getattr(self.__df_handler,'attrs',{})
+            self.__origin = self.__df_handler
+            self.__df_handler = pd.io.parsers.TextFileReader(f,**options)
+            self.__df_handler.attrs = attrs
+        else:
+            raise NotImplementedError(f"cannot seek {type(self.__df_handler)}")
+        self.__start = self.__nread = rows
+
     def reset(self):
+        if self.__scanner is not None:
+            self.__scanner.close()
+            self.__scanner = None
+        self.__start = self.__nread = 0
+        if self.__origin is not None:
+            #go back to the original reader, rather than the one created by seek
+            if isinstance(self.__df_handler,pd.io.parsers.TextFileReader):
+                self.__df_handler.close()
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+            self.__df_handler = self.__origin
+            self.__origin = None
+
         if isinstance(self.__df_handler,pd.io.parsers.TextFileReader):
             options = self.__df_handler.orig_options
             if hasattr(self.__df_handler,'f'):
@@ -143,9 +409,12 @@ class DataBrick:
             else:
                 raise NotImplementedError('check your pandas version! It is not supported by the tool - try upgrading')
 
+            attrs = getattr(self.__df_handler,'attrs',None)
             del  self.__df_handler
             #f is an i/o object or a filename (string)
             self.__df_handler = pd.io.parsers.TextFileReader(f,**options)
+            if attrs is not None:
+                self.__df_handler.attrs = attrs
             
         self.__df = None
         self.__end = False
@@ -182,5 +451,8 @@ class DataBrick:
         else:
             raise NotImplementedError(f"{type(self.__df_handler)} not implemented")
 
+        self.__start = self.__nread
+        self.__nread += len(self.__df) if self.__df is not None else 0
+
     def get_df(self):
         return self.__df
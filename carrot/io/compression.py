@@ -0,0 +1,290 @@
+import io
+import os
+import gzip
+import queue
+import threading
+import collections
+import concurrent.futures
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#file extension of each supported compression
+extensions = {
+    'gzip':'gz',
+    'zstd':'zst'
+}
+compressions = list(extensions.keys())
+
+#commands that stream a decompressed file to stdout, e.g. to load it without writing it to disk
+decompress_commands = {
+    'gzip':['gzip','-dc'],
+    'zstd':['zstd','-dc']
+}
+
+
+def get_compression(fname):
+    """
+    The compression of a file, given its name e.g. person.tsv.gz -> gzip
+    """
+    for compression,extension in extensions.items():
+        if fname.endswith(f'.{extension}'):
+            return compression
+    return None
+
+
+def strip_compression(fname):
+    """
+    person.tsv.gz -> person.tsv
+    """
+    compression = get_compression(fname)
+    if compression is None:
+        return fname
+    return fname[:-len(extensions[compression])-1]
+
+
+def check_compression(compression):
+    if compression not in extensions:
+        raise ValueError(f"unknown compression '{compression}', choose from {compressions}")
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError("zstd compression needs the package 'zstandard'. pip install zstandard")
+
+
+def get_compression_pool(threads=None):
+    """
+    A pool of threads for ParallelGzipWriter, which can be shared by all the files written (see open_output)
+    """
+    return concurrent.futures.ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    Write a gzip file, compressing blocks of the data in a pool of threads (zlib releases the GIL).
+    Each block is written as a separate gzip member, in order, which is a valid gzip stream
+    that any reader (gzip, zcat, pandas) decompresses as one. Appending to a file adds more members,
+    so chunks written with mode='a' also make a valid file.
+    Only full blocks are compressed until the file is closed, so flushing does not add small members.
+    A pool can be given to share its threads between files, otherwise each file starts its own.
+    """
+    def __init__(self,fname,mode='w',level=6,threads=None,block_size=4*1024*1024,pool=None):
+        self.f = open(fname,mode.replace('b','')+'b')
+        self.level = level
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.own_pool = pool is None
+        self.pool = get_compression_pool(threads) if pool is None else pool
+        #bound the number of compressed blocks waiting to be written
+        self.max_pending = 2*self.pool._max_workers
+        self.pending = collections.deque()
+
+    def writable(self):
+        return True
+
+    def write(self,data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self,block):
+        self.pending.append(self.pool.submit(gzip.compress,block,self.level,mtime=0))
+        while len(self.pending) > self.max_pending:
+            self.f.write(self.pending.popleft().result())
+
+    def flush(self):
+        #the tail of the data (less than a block) is kept until close
+        if self.closed:
+            return
+        while self.pending:
+            self.f.write(self.pending.popleft().result())
+        self.f.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            super().close()
+        finally:
+            if self.own_pool:
+                self.pool.shutdown()
+            self.f.close()
+
+
+def open_output(fname,mode='w',compression='infer',threads=None,level=None,pool=None):
+    """
+    Open a file to write text to, compressed (by gzip or zstd) if the file name ends .gz or .zst,
+    or if a compression is given. Compression is done in multiple threads,
+    gzip files can share the threads of a pool (see get_compression_pool).
+    """
+    if compression == 'infer':
+        compression = get_compression(fname)
+    if compression is None:
+        return open(fname,mode,newline='')
+
+    check_compression(compression)
+    if compression == 'gzip':
+        raw = ParallelGzipWriter(fname,mode,level=6 if level is None else level,threads=threads,pool=pool)
+        return io.TextIOWrapper(io.BufferedWriter(raw),encoding='utf-8',newline='')
+    else:
+        #each time the file is opened a new zstd frame is written, frames can be concatenated
+        cctx = zstandard.ZstdCompressor(level=3 if level is None else level,threads=threads or -1)
+        raw = cctx.stream_writer(open(fname,mode.replace('b','')+'b'))
+        return io.TextIOWrapper(raw,encoding='utf-8',newline='')
+
+
+def open_input(fnames,encoding='utf-8'):
+    """
+    Open a file, or the parts of a file split into many, to read text from.
+    Files are decompressed if their names end .gz or .zst. Compressed files and multiple parts
+    are read (and decompressed) on a background thread, see InputStream.
+    """
+    if isinstance(fnames,str):
+        fnames = [fnames]
+    if len(fnames) == 1 and get_compression(fnames[0]) is None:
+        return open(fnames[0],'r',encoding=encoding,newline='')
+    for fname in fnames:
+        compression = get_compression(fname)
+        if compression is not None:
+            check_compression(compression)
+    #utf-8-sig also removes a byte order mark from the start of the first file
+    if encoding in ['utf-8','utf8']:
+        encoding = 'utf-8-sig'
+    return io.TextIOWrapper(io.BufferedReader(InputStream(fnames)),encoding=encoding,newline='')
+
+
+def _open_binary(fname):
+    compression = get_compression(fname)
+    if compression is None:
+        return open(fname,'rb')
+    check_compression(compression)
+    if compression == 'gzip':
+        return gzip.open(fname,'rb')
+    else:
+        dctx = zstandard.ZstdDecompressor()
+        return dctx.stream_reader(open(fname,'rb'),read_across_frames=True,closefd=True)
+
+
+class InputStream(io.RawIOBase):
+    """
+    Read one or more (compressed) files as a single stream, e.g. the parts of a source table
+    that has been split across many files. Each part must start with the same header line,
+    which is only kept for the first part.
+    The files are read, and decompressed, on a background thread, ahead of the reader (e.g. pandas.read_csv)
+    """
+    def __init__(self,fnames,block_size=1024*1024,buffers=8):
+        self.fnames = [fnames] if isinstance(fnames,str) else list(fnames)
+        self.block_size = block_size
+        self.buffers = buffers
+        self.thread = None
+        self._start()
+
+    def _start(self):
+        self.queue = queue.Queue(maxsize=self.buffers)
+        self.stop = threading.Event()
+        self.remaining = b''
+        self.position = 0
+        self.eof = False
+        self.thread = threading.Thread(target=self._read_files,daemon=True)
+        self.thread.start()
+
+    def _stop(self):
+        if self.thread is None:
+            return
+        self.stop.set()
+        #unblock the thread if it is waiting to add to a full queue
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.thread.join()
+        self.thread = None
+
+    def _put(self,item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item,timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read_files(self):
+        try:
+            header = None
+            last = b'\n'
+            for i,fname in enumerate(self.fnames):
+                with _open_binary(fname) as f:
+                    line = f.readline()
+                    if header is None:
+                        header = line
+                        data = line
+                    elif line.lstrip(b'\xef\xbb\xbf').rstrip(b'\r\n') != header.lstrip(b'\xef\xbb\xbf').rstrip(b'\r\n'):
+                        raise ValueError(f"{fname} has a different header to {self.fnames[0]}")
+                    else:
+                        #make sure the last row of the previous part is ended
+                        data = b'' if last == b'\n' else b'\n'
+                    while data is not None:
+                        if data:
+                            if not self._put(data):
+                                return
+                            last = data[-1:]
+                        data = f.read(self.block_size) or None
+            self._put(None)
+        except BaseException as err:
+            self._put(err)
+
+    def readable(self):
+        return True
+
+    def readinto(self,b):
+        while not self.remaining:
+            if self.eof:
+                return 0
+            item = self.queue.get()
+            if item is None:
+                self.eof = True
+            elif isinstance(item,BaseException):
+                self.eof = True
+                raise item
+            else:
+                self.remaining = item
+        n = min(len(b),len(self.remaining))
+        b[:n] = self.remaining[:n]
+        self.remaining = self.remaining[n:]
+        self.position += n
+        return n
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self,offset,whence=io.SEEK_SET):
+        #can only go back to the start (i.e. read the files again)
+        if whence == io.SEEK_CUR and offset == 0:
+            return self.position
+        if whence != io.SEEK_SET or offset != 0:
+            raise io.UnsupportedOperation("can only seek to the start of the input")
+        self.reset()
+        return 0
+
+    def reset(self):
+        """
+        Start reading from the first file again
+        """
+        if self.closed:
+            raise ValueError("cannot reset a closed InputStream")
+        self._stop()
+        self._start()
+
+    def close(self):
+        self._stop()
+        super().close()
@@ -0,0 +1,154 @@
+import os
+import math
+import shutil
+import pandas as pd
+from carrot.tools.logger import Logger, _Logger
+from carrot.io.common import DataCollection, DataBrick
+from carrot.io.compression import _open_binary
+from carrot.io.partitions import get_partitions
+
+
+def _count_rows(brick):
+    #an estimate of the number of rows of an input, from the lines in its files
+    handler = brick.get_handler()
+    if isinstance(handler,pd.DataFrame):
+        return len(handler)
+    nrows = 0
+    for fname in brick.get_source_files():
+        with _open_binary(fname) as f:
+            nlines = sum(block.count(b'\n') for block in iter(lambda: f.read(1024*1024),b''))
+        nrows += max(nlines - 1,0)
+    limit = getattr(handler,'orig_options',{}).get('nrows')
+    return nrows if limit is None else min(nrows,limit)
+
+
+def _get_read_options(brick):
+    #read the partitions back with the same dtypes and missing values as the original inputs
+    options = getattr(brick.get_handler(),'orig_options',{})
+    return {
+        'dtype':options.get('dtype',str),
+        'keep_default_na':options.get('keep_default_na',False),
+        'na_values':options.get('na_values',[''])
+    }
+
+
+def copartition(inputs,index_map,work_dir,npartitions=None,chunksize=None):
+    """
+    Split each input table into partitions by a hash of its person column (index_map),
+    so all the rows of a person are in the same partition of every table.
+    Tables without a person column are split into partitions by blocks of rows.
+
+    Args:
+        inputs (DataCollection): the inputs to partition, each is read through once in chunks
+        index_map (dict): the person column of each input table e.g. {'Demographics.csv':'PersonID'}
+        work_dir (str): folder to write the partitions to, anything already in it is removed
+        npartitions (int): the number of partitions, by default enough to keep each to about chunksize rows
+        chunksize (int): the number of rows read at a time, and the target size of a partition
+    Returns:
+        CoPartitionedDataCollection: inputs that deliver one partition of every table per chunk
+    """
+    logger = _Logger("carrot.io.copartition")
+    chunksize = chunksize or inputs.chunksize
+    if chunksize is None:
+        raise ValueError("co-partitioning the inputs needs a chunksize")
+
+    if npartitions is None:
+        nrows = max([_count_rows(brick) for _,brick in inputs.items()],default=0)
+        npartitions = max(math.ceil(nrows/chunksize),1)
+    logger.info(f"co-partitioning {len(inputs.keys())} inputs into {npartitions} partitions in {work_dir}")
+
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+
+    tables = {}
+    for n,(key,brick) in enumerate(inputs.items()):
+        folder = f'{work_dir}{os.path.sep}{n:03d}'
+        os.makedirs(folder)
+        column = index_map.get(key)
+        brick.reset()
+        columns = None
+        i = 0
+        while True:
+            brick.get_chunk(chunksize)
+            df = brick.get_df()
+            if df is None or len(df) == 0:
+                break
+            columns = list(df.columns)
+            if column is None:
+                #no person, so any partition will do
+                partitions = {i%npartitions:df}.items()
+            else:
+                if column not in df.columns:
+                    raise KeyError(f"cannot partition '{key}' on '{column}', it is not one of its columns {columns}")
+                partitions = df.groupby(get_partitions(df[column],npartitions),sort=False)
+            for partition,part in partitions:
+                fname = f'{folder}{os.path.sep}part-{partition:05d}.csv'
+                part.to_csv(fname,mode='a',header=not os.path.exists(fname),index=False)
+            i += 1
+        if columns is None:
+            columns = list(df.columns) if df is not None else []
+        brick.reset()
+        tables[key] = {'folder':folder,'columns':columns,'options':_get_read_options(brick)}
+        logger.info(f"partitioned '{key}'" + (f" on '{column}'" if column else " by rows"))
+
+    return CoPartitionedDataCollection(tables,npartitions,chunksize=chunksize)
+
+
+class CoPartitionedDataCollection(DataCollection):
+    """
+    Inputs split into partitions by copartition, each chunk is the same partition of every table,
+    so rules can combine fields from different tables (see CommonDataModel.set_indexing) while chunking
+    """
+    aligned = True
+
+    def __init__(self,tables,npartitions,chunksize=None,**kwargs):
+        super().__init__(chunksize=chunksize,**kwargs)
+        self.tables = tables
+        self.npartitions = npartitions
+        self.partition = 0
+        self._load_partition()
+
+    def get_partition_file(self,key,partition):
+        return f"{self.tables[key]['folder']}{os.path.sep}part-{partition:05d}.csv"
+
+    def _read(self,key,partition):
+        table = self.tables[key]
+        fname = self.get_partition_file(key,partition)
+        if not os.path.exists(fname):
+            return pd.DataFrame(columns=table['columns'],dtype=object)
+        return pd.read_csv(fname,**table['options'])
+
+    def _get_brick(self,key,partition):
+        #only read when the table is used
+        def read():
+            yield self._read(key,partition)
+        return DataBrick(read(),name=key)
+
+    def _load_partition(self):
+        for key in self.tables:
+            self[key] = self._get_brick(key,self.partition)
+
+    def next(self):
+        self.logger.info("Getting next partition of data")
+        if self.partition + 1 >= self.npartitions:
+            self.logger.info("All partitions of the input files have now been used.")
+            raise StopIteration
+        self.partition += 1
+        self._load_partition()
+
+    def reset(self):
+        self.logger.info(f"resetting to the first partition")
+        self.partition = 0
+        self._load_partition()
+
+    def get_positions(self):
+        return {'partition':self.partition,'npartitions':self.npartitions}
+
+    def seek(self,positions):
+        if positions['npartitions'] != self.npartitions:
+            raise ValueError(f"cannot move to partition {positions['partition']} of {positions['npartitions']}, "
+                             f"the inputs are now in {self.npartitions} partitions")
+        self.partition = positions['partition']
+        self.logger.info(f"moving to partition {self.partition}")
+        self._load_partition()
@@ -0,0 +1,121 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from carrot.tools.logger import Logger
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def get_partition_file(table,index,extension):
+    return f'{table}.part-{index:05d}.{extension}'
+
+
+def get_partition_key(table,columns):
+    """
+    Which column the rows of a table are partitioned on: the person, so all the rows of a person
+    are in the same partition of every table, otherwise the primary key
+    """
+    if 'person_id' in columns:
+        return 'person_id'
+    elif table == 'person_ids' and 'SOURCE_SUBJECT' in columns:
+        #holds the masked person_id
+        return 'SOURCE_SUBJECT'
+    return columns[0]
+
+
+def get_partitions(values,npartitions):
+    """
+    The partition of each value, from a hash of its string form, so is the same for any dtype,
+    between runs and on any machine (unlike python's hash)
+    """
+    values = pd.Series(values,copy=False).astype(str)
+    hashes = pd.util.hash_array(values.to_numpy(dtype=object),categorize=True)
+    return (hashes % np.uint64(npartitions)).astype(np.int64)
+
+
+def _to_json(value):
+    if pd.isna(value):
+        return None
+    try:
+        return int(value)
+    except (TypeError,ValueError):
+        return str(value)
+
+
+class Manifest(Logger):
+    """
+    Describes the partition files of each table: the number of rows,
+    and the ranges of the partition key and primary key in each file.
+    {
+        'npartitions':8,
+        'tables':{
+            'person':{
+                'key':'person_id',
+                'partitions':{
+                    '3':{'file':'person.part-00003.tsv','rows':100,
+                         'key_range':[1,998],'primary_key_range':[1,998]},
+                    ...
+    """
+    def __init__(self,npartitions,fname=None):
+        self.npartitions = npartitions
+        self.tables = {}
+        if fname is not None and os.path.exists(fname):
+            self.load(fname)
+
+    def load(self,fname):
+        with open(fname) as f:
+            data = json.load(f)
+        if data['npartitions'] != self.npartitions:
+            raise ValueError(f"{fname} has {data['npartitions']} partitions, not {self.npartitions}")
+        self.tables = data['tables']
+
+    def save(self,fname):
+        tmp = f'{fname}.tmp'
+        with open(tmp,'w') as f:
+            json.dump(self.get_state(),f,indent=6)
+        os.replace(tmp,fname)
+        self.logger.info(f"saved the partition manifest to {fname}")
+
+    def get_state(self):
+        return {'npartitions':self.npartitions,'tables':self.tables}
+
+    def set_state(self,state):
+        self.npartitions = state['npartitions']
+        self.tables = state['tables']
+
+    def clear(self,table):
+        self.tables.pop(table,None)
+
+    def update(self,table,key,partition,fname,df):
+        """
+        Add the rows of df, just written to partition file fname
+        """
+        entry = self.tables.setdefault(table,{'key':key,'partitions':{}})
+        stats = entry['partitions'].setdefault(str(partition),{
+            'file':os.path.basename(fname),
+            'rows':0,
+            'key_range':[None,None],
+            'primary_key_range':[None,None]
+        })
+        stats['rows'] += len(df)
+        for name,col in [('key_range',df[key]),('primary_key_range',df[df.columns[0]])]:
+            col = col.dropna()
+            if len(col) == 0:
+                continue
+            low,high = _to_json(col.min()),_to_json(col.max())
+            current = stats[name]
+            stats[name] = [low if current[0] is None else min(current[0],low),
+                           high if current[1] is None else max(current[1],high)]
+
+    def get_files(self,table,keys=None):
+        """
+        The partition files of a table, or only those that contain the given keys (e.g. person_ids)
+        """
+        if table not in self.tables:
+            return []
+        partitions = self.tables[table]['partitions']
+        if keys is not None:
+            wanted = set(get_partitions(keys,self.npartitions).tolist())
+            partitions = {k:v for k,v in partitions.items() if int(k) in wanted}
+        return [v['file'] for _,v in sorted(partitions.items(),key=lambda x: int(x[0]))]
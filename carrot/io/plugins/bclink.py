@@ -15,6 +15,7 @@ class BCLinkDataCollection(LocalDataCollection):
         self.job_ids = []
 
     def finalise(self):
+        super().finalise()
         self.logger.info("finalising, waiting for jobs to finish")
         self.logger.info(f"job_ids to wait for: {self.job_ids}")
 
@@ -41,7 +42,9 @@ class BCLinkDataCollection(LocalDataCollection):
     def write(self,*args,**kwargs):
         f_out = super().write(*args,**kwargs)
         destination_table = args[0]
-        self.load(f_out,destination_table)
+        #partitioned outputs are written to several files
+        for fname in (f_out if isinstance(f_out,list) else [f_out]):
+            self.load(fname,destination_table)
 
     def load(self,f_out,destination_table):
         job_id = self.bclink_helpers.load_table(f_out,destination_table)
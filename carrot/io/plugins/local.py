@@ -1,6 +1,9 @@
 import pandas as pd
 from carrot.io.common import DataCollection,DataBrick
+from carrot.io.partitions import Manifest, MANIFEST_NAME, get_partition_file, get_partition_key, get_partitions
+from carrot.io.compression import open_output, check_compression, get_compression_pool, extensions as compression_extensions
 import glob
+import copy
 import io
 import os
 import json
@@ -8,13 +11,29 @@ import pandas as pd
 from time import gmtime, strftime
 
 class LocalDataCollection(DataCollection):
-    def __init__(self,file_map=None,chunksize=None,nrows=None,output_folder=None,sep=',',write_mode='w',write_separate=False,**kwargs):
-        super().__init__(chunksize=chunksize,nrows=nrows)
+    def __init__(self,file_map=None,chunksize=None,nrows=None,output_folder=None,sep=',',write_mode='w',write_separate=False,partitions=None,compression=None,compression_threads=None,**kwargs):
+        super().__init__(chunksize=chunksize,nrows=nrows,**kwargs)
 
         self.__output_folder = output_folder
         self.__separator = sep
         self.__write_mode = write_mode
         self.__write_separate = write_separate
+        #gzip or zstd compress the output files
+        if compression is not None:
+            check_compression(compression)
+        self.__compression = compression
+        self.__compression_threads = compression_threads
+        #threads compressing the outputs, shared by all the files written (started when first needed)
+        self.__compression_pool = None
+
+        #split the rows of each table into this number of files, by a hash of the person_id
+        self.__partitions = partitions
+        self.__manifest = None
+        if partitions:
+            if write_separate:
+                raise ValueError("cannot both partition the outputs and write them separately")
+            manifest = self.get_manifest_file() if write_mode == 'a' else None
+            self.__manifest = Manifest(partitions,fname=manifest)
 
         if file_map is not None:
             self._load_input_files(file_map)
@@ -22,6 +41,21 @@ class LocalDataCollection(DataCollection):
     def get_output_folder(self):
         return self.__output_folder
 
+    def get_manifest_file(self):
+        return f'{self.__output_folder}{os.path.sep}{MANIFEST_NAME}'
+
+    def finalise(self):
+        if self.__manifest is not None:
+            self.__manifest.save(self.get_manifest_file())
+        if self.__compression_pool is not None:
+            self.__compression_pool.shutdown()
+            self.__compression_pool = None
+
+    def get_compression_pool(self):
+        if self.__compression == 'gzip' and self.__compression_pool is None:
+            self.__compression_pool = get_compression_pool(self.__compression_threads)
+        return self.__compression_pool
+
     def get_global_ids(self):
         if not self.__output_folder:
             return
@@ -53,20 +87,24 @@ class LocalDataCollection(DataCollection):
         Given the '_outfile_separator' to be used in `df.to_csv`,
         work out the file extension.
 
-        At current, only tab separated and comma separated values (files) are supported
+        At current, only tab separated and comma separated values (files) are supported,
+        with the extension of the compression added if the outputs are compressed e.g. tsv.gz
 
         Returns:
            str: outfile extension name
 
         """
         if self.__separator == ',':
-            return 'csv'
+            extension = 'csv'
         elif self.__separator == '\t':
-            return 'tsv'
+            extension = 'tsv'
         else:
             self.logger.warning(f"Don't know what to do with the extension '{self.__separator}' ")
             self.logger.warning("Defaulting to csv")
-            return 'csv'
+            extension = 'csv'
+        if self.__compression:
+            extension += '.' + compression_extensions[self.__compression]
+        return extension
 
 
     def load_meta(self,name='.meta'):
@@ -83,12 +121,14 @@ class LocalDataCollection(DataCollection):
         if not meta:
             return
 
+        #the indexing is the start index for each table
+        #i.e. one after the total number of rows already processed
         indexing = {}
         for _,v in meta.items():
             v = v['meta']['total_data_processed']
             for k,n in v.items():
                 if k not in indexing:
-                    indexing[k] = 0
+                    indexing[k] = 1
                 indexing[k] += n
         return indexing
 
@@ -137,6 +177,9 @@ class LocalDataCollection(DataCollection):
         if mode == None:
             mode = self.__write_mode
 
+        if self.__partitions:
+            return self._write_partitions(name,df,mode)
+
         if self.__write_separate:
             time = strftime("%Y-%m-%dT%H%M%S", gmtime())
             if 'name' in df.attrs:
@@ -160,18 +203,95 @@ class LocalDataCollection(DataCollection):
         else:
             self.logger.info(f'updating {name} in {fname}')
 
-        for col in df.columns:
-            if col.endswith("_id"):
-                df[col] = df[col].astype(float).astype(pd.Int64Dtype())
+        self._format_ids(df)
 
         df.set_index(df.columns[0],inplace=True)
         self.logger.debug(df.dtypes)
-        df.to_csv(fname,mode=mode,header=header,index=True,sep=self.__separator)
+        self._to_csv(df,fname,mode,header)
 
         self.logger.debug(df.dropna(axis=1,how='all'))
         self.logger.info("finished save to file")
         return fname
 
+    def _to_csv(self,df,fname,mode,header):
+        if not self.__compression:
+            df.to_csv(fname,mode=mode,header=header,index=True,sep=self.__separator)
+            return
+        #appending adds a new gzip member (zstd frame), so the file stays valid
+        with open_output(fname,mode,compression=self.__compression,threads=self.__compression_threads,
+                         pool=self.get_compression_pool()) as f:
+            df.to_csv(f,header=header,index=True,sep=self.__separator)
+
+    def _format_ids(self,df):
+        for col in df.columns:
+            if col.endswith("_id"):
+                df[col] = df[col].astype(float).astype(pd.Int64Dtype())
+
+    def _write_partitions(self,name,df,mode):
+        """
+        Append the rows of df to the partition files of the table, each row goes to the
+        partition given by a hash of its person_id. Returns the files written to.
+        """
+        f_out = self.__output_folder
+        file_extension = self.get_outfile_extension()
+        if mode == 'w':
+            #start the table again
+            for fname in self._get_output_files([name]):
+                os.remove(fname)
+            self.__manifest.clear(name)
+
+        self._format_ids(df)
+        key = get_partition_key(name,list(df.columns))
+        partitions = get_partitions(df[key],self.__partitions)
+
+        files = []
+        for index,part in df.groupby(partitions,sort=True):
+            fname = f'{f_out}{os.path.sep}{get_partition_file(name,index,file_extension)}'
+            header = not os.path.exists(fname)
+            self.__manifest.update(name,key,index,fname,part)
+            self._to_csv(part.set_index(part.columns[0]),fname,'a',header)
+            files.append(fname)
+
+        self.logger.info(f'saved {name} ({len(df)} rows) to {len(files)} partition(s)')
+        return files
+
+    def _get_output_files(self,tables):
+        extension = self.get_outfile_extension()
+        files = []
+        for table in tables:
+            #matches both <table>.csv and the <table>.<name>.<id>.<time>.csv of write_separate
+            files.extend(glob.glob(f'{self.__output_folder}{os.path.sep}{table}.*{extension}'))
+        return sorted(set(files))
+
+    def get_checkpoint(self,tables):
+        """
+        The size of each output file for the given tables (and the partition manifest),
+        to be able to rollback to this point
+        """
+        return {
+            'sizes':{fname:os.path.getsize(fname) for fname in self._get_output_files(tables)},
+            'manifest':copy.deepcopy(self.__manifest.get_state()) if self.__manifest else None
+        }
+
+    def rollback(self,checkpoint,tables):
+        """
+        Undo any writes made since get_checkpoint: files are truncated to the sizes they had,
+        and any other output files of the given tables are removed
+        """
+        sizes = checkpoint['sizes']
+        if self.__manifest is not None:
+            self.__manifest.set_state(checkpoint['manifest'])
+        for fname,size in sizes.items():
+            if not os.path.exists(fname) or os.path.getsize(fname) < size:
+                raise ValueError(f"{fname} no longer has the {size} bytes it had at the checkpoint")
+            with open(fname,'r+b') as f:
+                f.truncate(size)
+
+        for fname in self._get_output_files(tables):
+            if fname not in sizes:
+                self.logger.warning(f"removing {fname}, written after the checkpoint")
+                os.remove(fname)
+
     def _load_input_files(self,file_map):
         for name,path in file_map.items():
             df = pd.read_csv(path,
@@ -1,48 +1,62 @@
 import carrot
 import os
-import sys
 import json
-import glob
-import inspect
-import time
+import importlib
 
-from . import extract
-from .dag import make_dag,make_report_dag
+#the helpers are imported from their modules when first used,
+#so that e.g. importing the logger does not import pandas, sqlalchemy or graphviz
+_lazy = {
+    '.dag':['make_dag','make_report_dag'],
+    '.file_helpers':[
+        'load_json',
+        'load_json_delta',
+        'load_csv',
+        'load_tsv',
+        'load_sql',
+        'create_csv_store',
+        'create_sql_store',
+        'create_bclink_store',
+        'remove_missing_sources_from_rules',
+        'filter_rules_by_destination_tables',
+        'filter_rules_by_object_names',
+        'get_separator_from_filename',
+        'get_file_map_from_dir',
+        'get_file_map',
+        'get_input_name',
+        'get_mapped_fields_from_rules',
+        'get_source_tables_from_rules',
+        'get_subfolders',
+        'get_files',
+        'diff_csv'
+    ],
+    '.rules_helpers':[
+        'get_person_ids',
+        'get_source_field',
+        'get_source_table',
+        'apply_rules',
+        'load_from_file'
+    ],
+    '.compiled_rules':[
+        'load_rules',
+        'compile_rules',
+        'write_compiled_rules',
+        'read_compiled_rules'
+    ]
+}
+_lazy = {name:module for module,names in _lazy.items() for name in names}
+_submodules = ['bash_helpers','bclink_helpers','compiled_rules','dag','extract','file_helpers',
+               'logger','mappingrules','merge','metrics','omopcdm','profiling','pseudonymise',
+               'registry','rules_helpers','scan_report','tracing']
 
-from . import bclink_helpers
-
-from .file_helpers import (
-    load_json,
-    load_json_delta,
-    load_csv,
-    load_tsv,
-    load_sql,
-    create_csv_store,
-    create_sql_store,
-    create_bclink_store,
-    remove_missing_sources_from_rules,
-    filter_rules_by_destination_tables,
-    filter_rules_by_object_names,
-    get_separator_from_filename,
-    get_file_map_from_dir,
-    get_mapped_fields_from_rules,
-    get_source_tables_from_rules,
-    get_subfolders,
-    get_files,
-    diff_csv
-)
-
-from .rules_helpers import(
-    get_person_ids,
-    get_source_field,
-    get_source_table,
-    apply_rules,
-    load_from_file
-)
-
-from . import mappingrules
-
-from . import omopcdm
+def __getattr__(name):
+    if name in _lazy:
+        value = getattr(importlib.import_module(_lazy[name],__name__),name)
+    elif name in _submodules:
+        value = importlib.import_module(f'.{name}',__name__)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
 
 _DEBUG = False
 
@@ -51,55 +65,28 @@ def set_debug(value):
     _DEBUG = value
 
 def get_classes(format=False):
-    retval = get_classes_from_tool(format=format)
+    """
+    The registered python configs (from carrot/cdm/classes and $CARROT_CONFIG_FOLDER),
+    the classes in them are found from the registry so none of the modules are imported
+    """
+    from .registry import ClassRegistry, scan_folder
+    registry = ClassRegistry()
+    retval = get_classes_from_tool(registry=registry)
     config_folder = os.environ.get('CARROT_CONFIG_FOLDER')
     if config_folder is not None:
-        sys.path.append(config_folder)
-        files = [x for x in os.listdir(config_folder) if x.endswith(".py") and not x.startswith('__')]
-        for fname in files:
-            mname = fname.split(".")[0]
-            module = __import__(mname,fromlist=[fname])
-            path = os.path.join(config_folder,fname)
-            defined_classes = {
-                fname: {
-                    'module':m[1].__module__,
-                    'path': path,
-                    'last-modified': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(os.path.join(config_folder,fname))))
-                }
-                for m in inspect.getmembers(module, inspect.isclass)
-                if m[1].__module__ == module.__name__
-            }
-            retval.update(defined_classes)
+        retval.update(scan_folder(config_folder,registry=registry))
+    registry.save()
 
-    return retval
-
-def get_classes_from_tool(format=format):
-    from carrot.cdm import classes
-    _dir = os.path.dirname(classes.__file__)
-    files = [x for x in os.listdir(_dir) if x.endswith(".py") and not x.startswith('__')]
-    retval = {}
-    for fname in files:
-        path = os.path.join(_dir,fname)
-        mname = fname.split(".")[0]
-        mname = '.'.join([classes.__name__, mname])
-        if os.path.islink(path):
-            link = os.readlink(path)
-            if os.path.isfile(link) == False:
-                os.unlink(path)
-                continue
+    if format:
+        return json.dumps(retval,indent=6)
+    else:
+        return retval
 
-        module = __import__(mname,fromlist=[fname])
-        defined_classes = {
-            fname: {
-                'module':m[1].__module__,
-                'path': path  if not os.path.islink(path) else os.readlink(path),
-                'sympath': path,
-                'last-modified': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(os.path.join(_dir,fname))))
-            }
-            for m in inspect.getmembers(module, inspect.isclass)
-            if m[1].__module__ == module.__name__
-        }
-        retval.update(defined_classes)
+def get_classes_from_tool(format=False,registry=None):
+    from .registry import scan_folder
+    #locate the folder without importing carrot.cdm
+    _dir = os.path.join(os.path.dirname(os.path.abspath(carrot.__file__)),'cdm','classes')
+    retval = scan_folder(_dir,module_prefix='carrot.cdm.classes',registry=registry,remove_broken_links=True)
     if format:
         return json.dumps(retval,indent=6)
     else:
@@ -8,16 +8,32 @@ class BashHelpers(Logger):
     def __init__(self,dry_run=False):
         self.dry_run = dry_run
 
-    def run_bash_cmd(self,cmd):
+    def run_bash_cmd(self,cmd,pipe_from=None):
+        """
+        Run a command, optionally with the output of another command (pipe_from) piped to its stdin
+        """
         if isinstance(cmd,str):
             cmd = cmd.split(" ")
         elif not isinstance(cmd,list):
             raise Exception("run_bash_cmd must be passed a bash command as a str or a list")
-        self.logger.notice(" ".join(cmd))
+        if pipe_from is not None:
+            self.logger.notice(" ".join(pipe_from) + " | " + " ".join(cmd))
+        else:
+            self.logger.notice(" ".join(cmd))
         if self.dry_run:
             return None,None
-        session = subprocess.Popen(cmd, stdout=PIPE, stderr=PIPE)
+
+        source = None
+        if pipe_from is not None:
+            source = subprocess.Popen(pipe_from, stdout=PIPE)
+        session = subprocess.Popen(cmd, stdin=source.stdout if source else None, stdout=PIPE, stderr=PIPE)
+        if source:
+            #so the source gets a SIGPIPE if cmd exits early
+            source.stdout.close()
         stdout, stderr = (x.decode("utf-8") for x in session.communicate())
+        if source and source.wait() != 0:
+            self.logger.critical(f"{' '.join(pipe_from)} exited with {source.returncode}")
+            raise Exception("failled executing bash command")
 
         if 'ERROR' in stderr:
             self.logger.critical(stderr)
@@ -6,6 +6,7 @@ import os
 import carrot
 from carrot.tools.logger import Logger
 from .bash_helpers import BashHelpers
+from carrot.io.compression import get_compression, decompress_commands, extensions as compression_extensions
 from carrot.cdm.objects import get_cdm_tables
 
 
@@ -424,10 +425,18 @@ class BCLinkHelpers(BashHelpers,Logger):
             self.logger.error(f"Cannot find {f_out} to load to bclink.")
             return
                 
+        #compressed files are decompressed on the fly and streamed to the loader
+        compression = get_compression(f_out)
+        pipe_from = None
+        data_file = f_out
+        if compression:
+            pipe_from = decompress_commands[compression] + [f_out]
+            data_file = '/dev/stdin'
+
         cmd = ['dataset_tool', '--load',f'--table={tablename}',f'--user={self.gui_user}',
-               f'--data_file={f_out}','--support','--bcqueue',self.database]
+               f'--data_file={data_file}','--support','--bcqueue',self.database]
         
-        stdout,stderr = self.run_bash_cmd(cmd)
+        stdout,stderr = self.run_bash_cmd(cmd,pipe_from=pipe_from)
         if not stdout == None:
             for msg in stdout.splitlines():
                 self.logger.info(f"submitted job to bclink queue: {msg}")
@@ -449,16 +458,25 @@ class BCLinkHelpers(BashHelpers,Logger):
                 if table not in tables_to_process:
                     continue
 
-            data_file = f'{output_directory}/{table}.tsv'
-            if not os.path.exists(data_file):
+            #the table may have been saved compressed e.g. person.tsv.gz
+            data_files = [f'{output_directory}/{table}.tsv'] + \
+                         [f'{output_directory}/{table}.tsv.{ext}' for ext in compression_extensions.values()]
+            data_file = next((x for x in data_files if os.path.exists(x)),None)
+            if data_file is None:
                 #raise FileExistsError(
                 self.logger.error(f"Cannot find {table}.tsv in output directory: {output_directory}")
                 continue
 
+            compression = get_compression(data_file)
+            pipe_from = None
+            if compression:
+                pipe_from = decompress_commands[compression] + [data_file]
+                data_file = '/dev/stdin'
+
             cmd = ['dataset_tool', '--load',f'--table={tablename}',f'--user={self.gui_user}',
                    f'--data_file={data_file}','--support','--bcqueue',self.database]
             
-            stdout,stderr = self.run_bash_cmd(cmd)
+            stdout,stderr = self.run_bash_cmd(cmd,pipe_from=pipe_from)
             if not stdout == None:
                 for msg in stdout.splitlines():
                     self.logger.info(f"submitted job to bclink queue: {msg}")
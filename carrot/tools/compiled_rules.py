@@ -0,0 +1,163 @@
+import os
+import stat
+import json
+import mmap
+import pickle
+import struct
+import hashlib
+from carrot.tools.logger import _Logger as Logger
+from .file_helpers import load_json, get_mapped_fields_from_rules
+from .rules_helpers import get_person_ids, TermMapping
+
+#bump when the layout of compiled rules changes, artifacts with another version are ignored
+FORMAT_VERSION = 2
+_MAGIC = b'CARROTRULES'
+_HEADER = struct.Struct(f'{len(_MAGIC)}sI64s')
+EXTENSION = '.rules'
+
+
+class CompiledRules(dict):
+    """
+    Rules as loaded from the json, normalised for mapping (term mappings with string concept ids,
+    identical term mappings shared), along with the source fields and person ids derived from them
+    """
+    def __init__(self,rules,content_hash=None):
+        super().__init__(rules)
+        self.hash = content_hash
+        #what the source fields and person ids were derived from,
+        #these are only valid while the rules have not been changed
+        self.signature = get_signature(self)
+        self.source_fields = None
+        self.person_ids = None
+
+    def is_unchanged(self):
+        #compared by content, as the rules can be edited in place or copied and then edited (e.g. filtered)
+        return get_signature(self) == self.signature
+
+
+def get_signature(rules):
+    """
+    The objects of the rules and their source fields, which the source fields and person ids are derived from
+    """
+    cdm = rules.get('cdm')
+    if not isinstance(cdm,dict):
+        return None
+    return tuple(
+        (destination_table,name,destination_field,rule.get('source_table'),rule.get('source_field'))
+        for destination_table,rule_set in cdm.items()
+        for name,_rules in rule_set.items()
+        for destination_field,rule in _rules.items()
+    )
+
+def get_cache_dir():
+    return os.environ.get('CARROT_RULES_CACHE',
+                          os.path.join(os.path.expanduser('~'),'.cache','carrot','rules'))
+
+def is_trusted(path):
+    """
+    Compiled rules are pickles, so loading them can run code. Those found in the cache are only trusted
+    if the file and the cache folder are owned by the current user and cannot be written by anyone else
+    """
+    if not hasattr(os,'getuid'):
+        return True
+    for _path in [path,os.path.dirname(os.path.abspath(path))]:
+        st = os.stat(_path)
+        if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            return False
+    return True
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def get_artifact_path(content_hash,cache_dir=None):
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    return os.path.join(cache_dir,f'{content_hash}{EXTENSION}')
+
+
+def compile_rules(rules,content_hash=None):
+    """
+    Normalise the rules and precompute what is needed to map them
+    """
+    term_maps = {}
+    cdm = {}
+    for destination_table,rule_set in rules['cdm'].items():
+        cdm[destination_table] = {}
+        for name,_rules in rule_set.items():
+            cdm[destination_table][name] = {}
+            for destination_field,rule in _rules.items():
+                rule = dict(rule)
+                if isinstance(rule.get('term_mapping'),dict):
+                    mapping = TermMapping((k,str(v)) for k,v in rule['term_mapping'].items())
+                    key = json.dumps(mapping,sort_keys=True)
+                    rule['term_mapping'] = term_maps.setdefault(key,mapping)
+                cdm[destination_table][name][destination_field] = rule
+
+    compiled = CompiledRules({**rules,'cdm':cdm},content_hash)
+    compiled.source_fields = get_mapped_fields_from_rules(compiled)
+    compiled.person_ids = get_person_ids(compiled)
+    compiled.nterm_maps = len(term_maps)
+    return compiled
+
+
+def write_compiled_rules(compiled,fname):
+    _dir = os.path.dirname(fname)
+    if _dir and not os.path.exists(_dir):
+        os.makedirs(_dir,mode=0o700)
+    tmp = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp,'wb') as f:
+        f.write(_HEADER.pack(_MAGIC,FORMAT_VERSION,(compiled.hash or '').encode()))
+        pickle.dump(compiled,f,protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp,fname)
+    return fname
+
+
+def read_compiled_rules(fname):
+    """
+    Load compiled rules, returning None if the file is not compiled rules of the current version.
+    The file is unpickled, so must be trusted (see is_trusted)
+    """
+    with open(fname,'rb') as f:
+        with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+            if len(mm) < _HEADER.size:
+                return None
+            magic,version,_ = _HEADER.unpack_from(mm)
+            if magic != _MAGIC or version != FORMAT_VERSION:
+                return None
+            with memoryview(mm) as view:
+                with view[_HEADER.size:] as payload:
+                    return pickle.loads(payload)
+
+
+def load_rules(f_in,cache_dir=None):
+    """
+    Load rules from a json file (or string), or compiled rules.
+    For a json file, if compiled rules with the same content hash exist (see `carrot rules compile`)
+    these are loaded instead, so a change to the json automatically stops stale compiled rules being used.
+    Compiled rules in the cache (CARROT_RULES_CACHE) are ignored unless only the current user can write them,
+    compiled rules given directly are trusted as the rules json is
+    """
+    logger = Logger("load_rules")
+    if isinstance(f_in,dict):
+        return f_in
+    if not os.path.exists(f_in):
+        return load_json(f_in)
+
+    if f_in.endswith(EXTENSION):
+        compiled = read_compiled_rules(f_in)
+        if compiled is None:
+            raise ValueError(f"{f_in} is not compiled rules (of version {FORMAT_VERSION}), recompile the rules")
+        return compiled
+
+    with open(f_in,'rb') as f:
+        data = f.read()
+    fname = get_artifact_path(content_hash(data),cache_dir)
+    if os.path.exists(fname):
+        if not is_trusted(fname):
+            logger.warning(f"ignoring the compiled rules {fname}, they (or the cache folder) can be written by other users")
+            return json.loads(data)
+        compiled = read_compiled_rules(fname)
+        if compiled is not None:
+            logger.debug(f"loaded compiled rules for {f_in} from {fname}")
+            return compiled
+    return json.loads(data)
@@ -1,10 +1,12 @@
 import os
+import re
 import glob
 import copy
 import json
 import pandas as pd
 from carrot.tools.logger import _Logger as Logger
 import carrot.io as io
+from carrot.io.compression import strip_compression, get_compression, open_input
 
 class MissingInputFiles(Exception):
     pass
@@ -16,12 +18,13 @@ class DifferingRows(Exception):
                         
     
 def load_json_delta(f_in,original):
+    from .compiled_rules import load_rules
     logger = Logger("load_json_delta")
     
-    data = load_json(f_in)
+    data = load_rules(f_in)
 
     if isinstance(original,str):
-        original = load_json(original)
+        original = load_rules(original)
     
     if original == None:
         return data
@@ -86,19 +89,48 @@ def load_sql(**kwargs):
     store = create_sql_store(**kwargs)
     return store
 
+def get_compact_dtypes(fname,sep=',',usecols=None,na_values=[''],nrows=10000,
+                       max_categories=1000,max_fraction=0.5,arrow=False):
+    """
+    Scan the start of a csv file and choose a compact dtype for each column,
+    columns with few distinct values (e.g. coded fields such as sex or test results) are read as categoricals,
+    so the reader never creates a python string per cell and value level term mappings are applied per category.
+    Other columns are read as strings, arrow backed if requested.
+    """
+    if arrow:
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("arrow backed strings need the package 'pyarrow'. pip install pyarrow")
+    df = pd.read_csv(fname,sep=sep,nrows=nrows,dtype=str,keep_default_na=False,
+                     na_values=na_values,usecols=usecols)
+    dtypes = {}
+    for col in df.columns:
+        nunique = df[col].nunique()
+        if len(df) > 0 and nunique <= max_categories and nunique <= max_fraction*len(df):
+            dtypes[col] = 'category'
+        else:
+            dtypes[col] = 'string[pyarrow]' if arrow else str
+    return dtypes
+
+
 def load_csv(_map,chunksize=None,
              dtype=str,nrows=None,
              lower_col_names=False,
              load_path="",
              rules=None,
              sep=',',
-             na_values=['']):
+             na_values=[''],
+             memory_budget=None,
+             compact_strings=False):
+    """
+    Load csv files into a DataCollection, optionally only the fields used by the rules.
+    compact_strings can be True, to load low cardinality string columns as categoricals,
+    or 'arrow' to also load the other string columns as arrow backed strings (needs pyarrow)
+    """
 
     if isinstance(_map,list):
-        _map = {
-            os.path.basename(x):x
-            for x in _map
-        }
+        _map = get_file_map(_map)
     
     logger = Logger("carrot.tools.load_csv")
 
@@ -141,7 +173,9 @@ def load_csv(_map,chunksize=None,
     if not nrows is None:
         chunksize = nrows if chunksize is None else chunksize
 
-    retval = io.LocalDataCollection(chunksize=chunksize)
+    retval = io.LocalDataCollection(chunksize=chunksize,memory_budget=memory_budget)
+    #the data needs to be read in chunks for the chunksize to be adapted
+    chunksize = retval.chunksize
 
     for key,obj in _map.items():
         fields = None
@@ -151,17 +185,33 @@ def load_csv(_map,chunksize=None,
             fname = obj['file']
             fields = obj['fields']
 
-        df = pd.read_csv(load_path+fname,
+        #a source table can be split across many files (parts), which are read one after another
+        files = [load_path+x for x in fname] if isinstance(fname,list) else [load_path+fname]
+        source = files[0]
+        if len(files) > 1 or get_compression(files[0]):
+            #decompressed and read on a background thread
+            source = open_input(files)
+
+        _dtype = dtype
+        if compact_strings:
+            _dtype = get_compact_dtypes(files[0],sep=sep,usecols=fields,
+                                        na_values=na_values,arrow=compact_strings=='arrow')
+            logger.debug(f"loading {key} with {_dtype}")
+
+        df = pd.read_csv(source,
                          chunksize=chunksize,
                          #iterator=True,
                          nrows=nrows,
                          sep=sep,
                          keep_default_na=False,
                          na_values=na_values,
-                         dtype=dtype,
+                         dtype=_dtype,
                          usecols=fields)
         
-        df.attrs = {'original_file':load_path+fname}
+        if isinstance(source,str):
+            df.attrs = {'original_file':source}
+        else:
+            df.attrs = {'original_files':files}
 
         
         if isinstance(df,pd.DataFrame):
@@ -186,8 +236,38 @@ def get_subfolders(input_folder):
         if f.is_dir() and not os.path.basename(f.path).startswith('.')
     }
 
+def is_file_type(fname,ext='.csv'):
+    """
+    If a file is of a type, also if it is compressed e.g. Demographics.csv.gz is a .csv
+    """
+    return strip_compression(fname).endswith(ext)
+
+def get_input_name(fname):
+    """
+    The name of the source table in a file: Demographics.csv.gz -> Demographics.csv
+    and for a table split across files, Demographics.part-00001.csv -> Demographics.csv
+    """
+    name = strip_compression(os.path.basename(fname))
+    return re.sub(r'\.part-?\d+(?=\.[^.]+$)','',name)
+
+def _natural_key(fname):
+    #so part-2 comes before part-10
+    return [int(x) if x.isdigit() else x for x in re.split(r'(\d+)',fname)]
+
+def get_file_map(files):
+    """
+    Map the name of each source table to its file, or to its files (in order) if it is split into parts
+    """
+    _map = {}
+    for fname in sorted(files,key=_natural_key):
+        _map.setdefault(get_input_name(fname),[]).append(fname)
+    return {
+        name:files[0] if len(files) == 1 else files
+        for name,files in _map.items()
+    }
+
 def get_files(path,type='csv'):
-    return [x.path for x in os.scandir(path) if x.path.endswith(f'.{type}')]
+    return [x.path for x in os.scandir(path) if is_file_type(x.path,f'.{type}')]
 
 def get_file_map_from_dir(_dir,ext='.csv'):
     if not os.path.isdir(_dir):
@@ -196,19 +276,21 @@ def get_file_map_from_dir(_dir,ext='.csv'):
                 os.path.dirname(__file__),'..','data',_dir)
         )
 
-    _map = {}
-    for fname in glob.glob(f"{_dir}{os.path.sep}*{ext}"):
-        key = os.path.basename(fname)
-        _map[key] = fname
-    
-    return _map
+    return get_file_map(get_files(_dir,type=ext.lstrip('.')))
  
+def _copy_rules(rules):
+    #copy the structure of the rules down to the objects, so objects can be removed from the copy,
+    #the rules of each object are shared rather than deep copied as they are never modified
+    rules_copy = dict(rules)
+    rules_copy['cdm'] = {k:dict(v) for k,v in rules['cdm'].items()}
+    return rules_copy
+
 def remove_missing_sources_from_rules(rules,tables):
     logger = Logger("remove_missing_sources_from_rules")
 
     tables = [os.path.basename(x) for x in tables]
    
-    rules_copy = copy.deepcopy(rules)
+    rules_copy = _copy_rules(rules)
 
     for destination_table,cdm_table in rules['cdm'].items():
         for table_name,sub_table in cdm_table.items():
@@ -225,7 +307,7 @@ def remove_missing_sources_from_rules(rules,tables):
     return rules_copy
 
 def filter_rules_by_destination_tables(rules,tables):
-    rules_copy = copy.deepcopy(rules)
+    rules_copy = _copy_rules(rules)
 
     for destination_table,cdm_table in rules['cdm'].items():
         if not destination_table in tables:
@@ -234,7 +316,7 @@ def filter_rules_by_destination_tables(rules,tables):
     return rules_copy
 
 def filter_rules_by_object_names(rules,names):
-    rules_copy = copy.deepcopy(rules)
+    rules_copy = _copy_rules(rules)
     for destination_table,cdm_table in rules['cdm'].items():
         for object_name,rules in cdm_table.items():
             if not object_name in names:
@@ -255,6 +337,10 @@ def get_source_tables_from_rules(rules,table):
     return list(set(sources))
 
 def get_mapped_fields_from_rules(rules):
+    #compiled rules already know these
+    if getattr(rules,'source_fields',None) is not None and rules.is_unchanged():
+        return {k:list(v) for k,v in rules.source_fields.items()}
+
     #extract a tuple of source tables and source fields
     sources = [
         (x['source_table'],x['source_field'])
@@ -278,6 +364,8 @@ def get_mapped_fields_from_rules(rules):
     
 
 def get_separator_from_filename(fname):
+    #e.g. person.tsv.gz is tab separated
+    fname = strip_compression(fname)
     _, fileExtension = os.path.splitext(fname)
     if fileExtension == '.tsv':
         return '\t'
@@ -0,0 +1,159 @@
+import os
+import glob
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from carrot.tools.logger import _Logger as Logger
+from carrot.tools.file_helpers import get_separator_from_filename
+from carrot.io.compression import extensions
+
+#tables whose primary keys are referenced by other tables,
+#so cannot be renumbered without breaking these references
+_REFERENCED_TABLES = ['person','person_ids','visit_occurrence','visit_detail',
+                      'location','care_site','provider']
+
+#duplicates are not removed from these, e.g. two people can have the same demographics
+_NO_DEDUP_TABLES = ['person','person_ids']
+
+
+class HashSet():
+    """
+    Set of uint64 row hashes, stored as a few sorted numpy arrays
+    which are merged together as they grow (like a log structured merge tree).
+    Uses 8 bytes per row, rather than the ~70 bytes of a python set.
+    """
+    def __init__(self):
+        self.levels = []
+
+    def __len__(self):
+        return sum(len(x) for x in self.levels)
+
+    def contains(self,values):
+        found = np.zeros(len(values),dtype=bool)
+        for level in self.levels:
+            idx = np.searchsorted(level,values)
+            idx[idx == len(level)] = 0
+            found |= level[idx] == values
+        return found
+
+    def add(self,values):
+        self.levels.append(np.unique(values))
+        #keep the sizes of the levels decreasing, merging any that are not
+        while len(self.levels) > 1 and len(self.levels[-2]) <= 2*len(self.levels[-1]):
+            last = self.levels.pop()
+            self.levels[-1] = np.union1d(self.levels[-1],last)
+
+
+def get_table_name(fname):
+    """
+    observation.tsv or (split outputs) observation.Name.0x7f.2022-01-01T000000.tsv -> observation
+    """
+    return os.path.basename(fname).split('.')[0]
+
+
+def group_files_by_table(inputs,exts=['.tsv','.csv']):
+    """
+    Expand any folders and group the files by the table they belong to
+    """
+    files = []
+    for x in inputs:
+        if os.path.isdir(x):
+            for ext in exts:
+                files.extend(glob.glob(f'{x}{os.path.sep}*{ext}'))
+                #and compressed files e.g. person.tsv.gz
+                for compression in extensions.values():
+                    files.extend(glob.glob(f'{x}{os.path.sep}*{ext}.{compression}'))
+        else:
+            files.append(x)
+
+    tables = {}
+    for fname in files:
+        tables.setdefault(get_table_name(fname),[]).append(fname)
+    return tables
+
+
+def _first_key(fname,sep):
+    #used to order the parts so they are merged in primary key order
+    df = pd.read_csv(fname,sep=sep,nrows=1,usecols=[0],dtype=str,na_filter=False)
+    try:
+        return (0,int(df.iloc[0,0])) if len(df) > 0 else (1,0)
+    except ValueError:
+        return (0,0)
+
+
+def merge_table(table,files,output_folder,chunksize=100000,
+                drop_duplicates=True,renumber=True,sep='\t'):
+    """
+    Stream all parts of a table into one file.
+    Duplicate rows (ignoring the primary key) are removed using a persistent set of row hashes,
+    and the primary keys are renumbered 1..N (unless other tables reference them).
+    Only one chunk of one part is in memory at a time.
+    """
+    logger = Logger(f"merge::{table}")
+
+    drop_duplicates = drop_duplicates and table not in _NO_DEDUP_TABLES
+    renumber = renumber and table not in _REFERENCED_TABLES
+
+    seps = {fname:get_separator_from_filename(fname) for fname in files}
+    #when the parts come from (split) outputs of a single run, their key ranges do not overlap,
+    #so sorting the parts by their first key gives the same order as a row-by-row k-way merge
+    files = sorted(files,key=lambda x: _first_key(x,seps[x]))
+
+    os.makedirs(output_folder,exist_ok=True)
+    ext = 'tsv' if sep == '\t' else 'csv'
+    f_out = f'{output_folder}{os.path.sep}{table}.{ext}'
+    #write to a temporary file, in case the output is also one of the inputs
+    f_tmp = f'{f_out}.merging'
+
+    seen = HashSet()
+    columns = None
+    nin = 0
+    nout = 0
+    with open(f_tmp,'w') as f:
+        for fname in files:
+            chunks = pd.read_csv(fname,sep=seps[fname],dtype=str,na_filter=False,chunksize=chunksize)
+            for df in chunks:
+                if columns is None:
+                    columns = list(df.columns)
+                    f.write(sep.join(columns)+'\n')
+                elif list(df.columns) != columns:
+                    raise ValueError(f"{fname} has columns {list(df.columns)}, expected {columns}")
+
+                nin += len(df)
+                if drop_duplicates:
+                    hashes = pd.util.hash_pandas_object(df.iloc[:,1:],index=False).values
+                    keep = ~pd.Series(hashes).duplicated().values & ~seen.contains(hashes)
+                    df = df[keep]
+                    seen.add(hashes[keep])
+
+                if renumber:
+                    df = df.copy()
+                    df.iloc[:,0] = np.arange(nout+1,nout+1+len(df)).astype(str)
+
+                df.to_csv(f,sep=sep,header=False,index=False)
+                nout += len(df)
+
+    os.replace(f_tmp,f_out)
+    if nin > nout:
+        logger.warning(f"Removed {nin-nout} duplicate row(s) when merging {table}")
+    logger.info(f"merged {len(files)} file(s) with {nin} rows into {f_out} with {nout} rows")
+    return f_out
+
+
+def merge(inputs,output_folder,workers=1,**kwargs):
+    """
+    Merge (split) output files into one file per table, optionally one table per worker process
+    """
+    logger = Logger("merge")
+    tables = group_files_by_table(inputs)
+    for table in list(tables.keys()):
+        if table == 'summary':
+            logger.warning(f"not merging {tables.pop(table)}")
+
+    if workers is None or workers <= 1 or len(tables) <= 1:
+        return [merge_table(table,files,output_folder,**kwargs) for table,files in tables.items()]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(merge_table,table,files,output_folder,**kwargs)
+                   for table,files in tables.items()]
+        return [future.result() for future in futures]
@@ -1,9 +1,27 @@
+import numpy as np
+
+#the most single increments buffered before they are applied, so memory stays bounded over long runs
+_MAX_PENDING = 100000
+
+
 class Metrics():
+    """
+    Counters keyed by a tuple of dimensions, e.g. (source, field, table, concept_id, additional)
+    for mapstream or (source, table, name, column) for the CommonDataModel.
+    Keys are interned to integer ids and the counts are held in a numpy array (key id x count type),
+    single increments are buffered and applied in bulk when the counts are read (or the buffer is full).
+    """
     def __init__(self, dataset_name, log_threshold=0):
-        self.datasummary={}
-        self.allcounts={}
-        self.log_data=""
-        self.dataset_name=dataset_name
+        self.keys = {}
+        self.key_list = []
+        self.count_types = {}
+        self.counts = np.zeros((0,0),dtype=np.int64)
+        #if a count type has been set for a key (a count of 0 is different to no count)
+        self.present = np.zeros((0,0),dtype=bool)
+        self._pending = []
+        self._ncols = 0
+        self.log_data = []
+        self.dataset_name = dataset_name
         self.log_threshold = log_threshold
 
     def get_new_mapstream_counts(self):
@@ -16,113 +34,215 @@ class Metrics():
 
         return counts
 
+    def key_id(self, key):
+        """
+        Integer id of a key (a tuple of dimensions), creating it if it is new
+        """
+        _id = self.keys.get(key)
+        if _id is None:
+            _id = len(self.key_list)
+            self.keys[key] = _id
+            self.key_list.append(key)
+        return _id
+
+    def count_type_id(self, count_type):
+        col = self.count_types.get(count_type)
+        if col is None:
+            #buffered increments are flat indices, so must be applied before the layout changes
+            self.flush()
+            col = len(self.count_types)
+            self.count_types[count_type] = col
+            self.counts = np.pad(self.counts,((0,0),(0,1)))
+            self.present = np.pad(self.present,((0,0),(0,1)))
+            self._ncols = self.counts.shape[1]
+        return col
+
+    def _resize(self):
+        nrows = len(self.key_list)
+        if self.counts.shape[0] < nrows:
+            extra = ((0,nrows - self.counts.shape[0]),(0,0))
+            self.counts = np.pad(self.counts,extra)
+            self.present = np.pad(self.present,extra)
+
+    def flush(self):
+        """
+        Apply the buffered single increments
+        """
+        self._resize()
+        if not self._pending:
+            return
+        #flat indices into counts, so only the counts that were incremented are touched
+        ids,n = np.unique(np.asarray(self._pending,dtype=np.int64),return_counts=True)
+        self.counts.flat[ids] += n
+        self.present.flat[ids] = True
+        self._pending = []
+
+    def increment(self, key, count_type, n=1):
+        """
+        Increment a count for a key, given as a tuple of dimensions or as its id (see key_id)
+        """
+        #called per row by mapstream, so the common paths avoid any further function calls
+        col = self.count_types.get(count_type)
+        if col is None:
+            col = self.count_type_id(count_type)
+        if key.__class__ is not int:
+            _id = self.keys.get(key)
+            key = self.key_id(key) if _id is None else _id
+        if n == 1:
+            self._pending.append(key*self._ncols + col)
+            if len(self._pending) >= _MAX_PENDING:
+                self.flush()
+        else:
+            self._resize()
+            self.counts[key,col] += n
+            self.present[key,col] = True
+
+    def add(self, keys, count_type, counts=1):
+        """
+        Bulk increment, e.g. from vectorised code. keys are key ids (or tuples of dimensions),
+        counts is a single number or an array with a count for each key, repeated keys are summed
+        """
+        ids = np.fromiter((k if isinstance(k, (int, np.integer)) else self.key_id(k) for k in keys),dtype=np.int64)
+        col = self.count_type_id(count_type)
+        self._resize()
+        counts = np.broadcast_to(np.asarray(counts,dtype=np.int64),ids.shape)
+        np.add.at(self.counts[:,col],ids,counts)
+        self.present[ids,col] = True
+
+    def merge(self, other):
+        """
+        Add the counts of another Metrics, e.g. from a parallel worker
+        """
+        other.flush()
+        if not other.key_list:
+            return self
+        ids = np.array([self.key_id(k) for k in other.key_list],dtype=np.int64)
+        for count_type,other_col in other.count_types.items():
+            col = self.count_type_id(count_type)
+            self._resize()
+            self.counts[ids,col] += other.counts[:,other_col]
+            self.present[ids,col] |= other.present[:,other_col]
+        self.log_data.extend(other.log_data)
+        return self
+
+    def to_df(self):
+        """
+        The counts as a DataFrame, indexed by the key dimensions, with a (nullable) column for each count type
+        """
+        import pandas as pd
+        self.flush()
+        index = pd.MultiIndex.from_tuples(self.key_list) if self.key_list else None
+        return pd.DataFrame({
+            count_type:pd.arrays.IntegerArray(self.counts[:,col].copy(),~self.present[:,col])
+            for count_type,col in self.count_types.items()
+        },index=index)
+
     def add_data(self, desttablename, increment):
         """
         add_data(self, destination table, data increment)
-        Apply the contents of a data increment to the stored self.datasummary
+        Apply the contents of a data increment to the stored counts
         """
         name = increment["name"]
         for datakey, dataitem in increment.items():
             if datakey == "valid_person_id":
-                dkey = "NA" + "." + desttablename + "." + name + "." + datakey
-                self.add_counts_to_summary(dkey, dataitem)
+                self.add_counts_to_summary(("NA", desttablename, name, datakey), dataitem)
             elif datakey == "person_id":
-                dkey = "NA" + "." + desttablename + "." + name + "." + datakey
-                self.add_counts_to_summary(dkey, dataitem)
+                self.add_counts_to_summary(("NA", desttablename, name, datakey), dataitem)
             elif datakey == "required_fields":
                 for fieldname in dataitem:
                     prfx = "NA"
                     if "source_files" in increment:
                         if fieldname in increment["source_files"]:
                             prfx = self.get_prefix(increment["source_files"][fieldname]["table"])
-                            dkey = prfx + "." + desttablename + "." + name + "." + fieldname
-                            self.add_counts_to_summary(dkey, dataitem[fieldname])
+                            self.add_counts_to_summary((prfx, desttablename, name, fieldname), dataitem[fieldname])
 
     def get_prefix(self, fname):
         return fname.split(".")[0]
 
     def add_counts_to_summary(self, dkey, count_block):
-        if dkey not in self.datasummary:
-            self.datasummary[dkey] = {}
+        if isinstance(dkey, str):
+            dkey = tuple(dkey.split("."))
         for counttype in count_block:
-            if counttype not in self.datasummary[dkey]:
-                self.datasummary[dkey][counttype] = 0
-            self.datasummary[dkey][counttype] += int(count_block[counttype])
+            self.increment(dkey, counttype, int(count_block[counttype]))
 
     def increment_key_count(self, dkey, count_type):
         """
-        Intended to work with the mapstream functions
+        Intended to work with the mapstream functions, dkey is either a tuple or a '~' joined string
         """
-        if dkey not in self.datasummary:
-            self.datasummary[dkey] = {}
-        if count_type not in self.datasummary[dkey]:
-            self.datasummary[dkey][count_type] = 0
-        self.datasummary[dkey][count_type] += 1
+        if isinstance(dkey, str):
+            dkey = tuple(dkey.split("~"))
+        self.increment(dkey, count_type)
+
+    def _get_column(self, count_type):
+        #counts and presence for one count type, for every key
+        self.flush()
+        col = self.count_types.get(count_type)
+        if col is None:
+            return np.zeros(len(self.key_list),dtype=np.int64),np.zeros(len(self.key_list),dtype=bool)
+        return self.counts[:,col],self.present[:,col]
 
     def get_summary(self):
-        summary_str = "source\ttablename\tname\tcolumn name\tbefore\tafter content check\tpct reject content check\tafter date format check\tpct reject date format\n"
-
-        for dkey in self.datasummary:
-            #print(dkey)
-            source, tablename, name, colname = dkey.split('.')
-            before_count = int(self.datasummary[dkey]["before"])
-            after_count = int(self.datasummary[dkey]["after"])
+        lines = ["source\ttablename\tname\tcolumn name\tbefore\tafter content check\tpct reject content check\tafter date format check\tpct reject date format\n"]
+
+        before,_ = self._get_column("before")
+        after,_ = self._get_column("after")
+        after_format,has_after_format = self._get_column("after_formatting")
+        for i,dkey in enumerate(self.key_list):
+            source, tablename, name, colname = dkey
+            before_count = int(before[i])
+            after_count = int(after[i])
             after_pct = (float)(before_count - after_count) * 100 / before_count
-            summary_str += source + "\t" + tablename + "\t" + name + "\t" + colname + "\t" + str(before_count) + "\t" + str(after_count) + "\t" + "{0:.3f}".format(after_pct) + "\t"
-            if "after_formatting" in self.datasummary[dkey]:
-                after_format_count = int(self.datasummary[dkey]["after_formatting"])
+            line = source + "\t" + tablename + "\t" + name + "\t" + colname + "\t" + str(before_count) + "\t" + str(after_count) + "\t" + "{0:.3f}".format(after_pct) + "\t"
+            if has_after_format[i]:
+                after_format_count = int(after_format[i])
                 after_format_pct = (float)(after_count - after_format_count) * 100 / after_count
-                summary_str += str(after_format_count) + "\t" + "{0:.3f}".format(after_format_pct) + "\n"
+                line += str(after_format_count) + "\t" + "{0:.3f}".format(after_format_pct) + "\n"
             else:
-                summary_str += "NA\tNA\n"
+                line += "NA\tNA\n"
+            lines.append(line)
 
-        return summary_str
+        return "".join(lines)
 
     def get_data_summary(self):
-        return self.datasummary
+        """
+        The counts as a dict of {key: {count type: count}}, keys are tuples of dimensions
+        """
+        self.flush()
+        names = list(self.count_types.keys())
+        return {
+            dkey:{names[j]:int(self.counts[i,j]) for j in np.flatnonzero(self.present[i])}
+            for i,dkey in enumerate(self.key_list)
+        }
 
     def get_mapstream_summary(self):
-        summary_str = "dsname\tsource\tsource_field\ttarget\tconcept_id\tadditional\tincount\tinvalid_persid\tinvalid_date\tinvalid_source\toutcount\n"
-
-        for dkey in sorted(self.datasummary):
-            try:
-                source, fieldname, tablename, concept_id, additional = dkey.split('~')
-            except ValueError:
-                print("get_mapstream_summary - ValueError: {0}".format(dkey))
+        lines = ["dsname\tsource\tsource_field\ttarget\tconcept_id\tadditional\tincount\tinvalid_persid\tinvalid_date\tinvalid_source\toutcount\n"]
+
+        input_counts,_ = self._get_column("input_count")
+        invalid_person_ids,_ = self._get_column("invalid_person_ids")
+        invalid_source_fields,_ = self._get_column("invalid_source_fields")
+        invalid_date_fields,_ = self._get_column("invalid_date_fields")
+        output_counts,_ = self._get_column("output_count")
+
+        #ordered as the '~' joined keys were
+        order = sorted(range(len(self.key_list)),key=lambda i: "~".join(self.key_list[i]))
+        for i in order:
+            dkey = self.key_list[i]
+            if len(dkey) != 5:
+                print("get_mapstream_summary - ValueError: {0}".format("~".join(dkey)))
                 break
-              
+            source, fieldname, tablename, concept_id, additional = dkey
             source = self.get_prefix(source)
-            dvalue = self.datasummary[dkey]
-
-            input_count = "0"
-            if "input_count" in dvalue:
-                input_count = str(dvalue["input_count"])
-
-            invalid_person_ids = "0"
-            if "invalid_person_ids" in dvalue:
-                invalid_person_ids = str(dvalue["invalid_person_ids"])
-
-            invalid_source_fields = "0"
-            if "invalid_source_fields" in dvalue:
-                invalid_source_fields = str(dvalue["invalid_source_fields"])
-
-            invalid_date_fields = "0"
-            if "invalid_date_fields" in dvalue:
-                invalid_date_fields = str(dvalue["invalid_date_fields"])
-
-            output_count = "0"
-            if "output_count" in dvalue:
-                output_count = str(dvalue["output_count"])
 
             #if (int(output_count) >= self.log_threshold) or (tablename == "person"):
-            if (int(output_count) >= self.log_threshold):
-              summary_str += self.dataset_name + "\t" + source + "\t" + fieldname + "\t" + tablename + "\t" + concept_id + "\t" + additional +"\t" + input_count + "\t" + invalid_person_ids + "\t" + invalid_date_fields + "\t" + invalid_source_fields + "\t" + output_count + "\n"
+            if (output_counts[i] >= self.log_threshold):
+                lines.append(self.dataset_name + "\t" + source + "\t" + fieldname + "\t" + tablename + "\t" + concept_id + "\t" + additional + "\t"
+                             + str(input_counts[i]) + "\t" + str(invalid_person_ids[i]) + "\t" + str(invalid_date_fields[i]) + "\t"
+                             + str(invalid_source_fields[i]) + "\t" + str(output_counts[i]) + "\n")
 
-        return summary_str
+        return "".join(lines)
 
     def add_log_data(self, msg):
-        self.log_data += msg + "\n"
+        self.log_data.append(msg + "\n")
 
     def get_log_data(self):
-        return self.log_data
-    
+        return "".join(self.log_data)
@@ -1,15 +1,38 @@
 import carrot.tools as tools
+from collections import namedtuple
+import hashlib
 import json
+import os
 import re
 
+#bump when the layout of the compiled schema changes, cached schemas of another version are ignored
+SCHEMA_VERSION = 1
+
+def get_schema_cache_dir():
+    return os.environ.get('CARROT_SCHEMA_CACHE',
+                          os.path.join(os.path.expanduser('~'),'.cache','carrot','schema'))
+
+
+class TableSchema(namedtuple('TableSchema',[
+        'name','columns','column_map',
+        'numeric_fields','notnull_numeric_fields','datetime_fields','date_fields',
+        'datetime_linked_fields','date_field_components',
+        'person_id_field','auto_number_field',
+        'person_id_index','auto_number_index','row_template'])):
+    """
+    Read only description of one OMOP table, precomputed so the mapping loop only needs attribute lookups.
+    row_template is an empty output row, with the not-null numeric fields already set to "0"
+    """
+    __slots__ = ()
+
+
 class OmopCDM:
 
-    def __init__(self, omopddl, omopcfg):
+    def __init__(self, omopddl, omopcfg, cache_dir=None):
         self.numeric_types = ["integer", "numeric"]
         self.datetime_types = ["timestamp"]
         self.date_types = ["date"]
-        self.omop_json = self.load_ddl(omopddl)
-        self.omop_json = self.merge_json(self.omop_json, omopcfg)
+        self.omop_json = self.load_schema(omopddl, omopcfg, cache_dir)
         self.all_columns = self.get_columns("all_columns")
         self.numeric_fields = self.get_columns("numeric_fields")
         self.notnull_numeric_fields = self.get_columns("notnull_numeric_fields")
@@ -18,6 +41,80 @@ class OmopCDM:
         self.datetime_fields = self.get_columns("datetime_fields")
         self.person_id_field = self.get_columns("person_id_field")
         self.auto_number_field = self.get_columns("auto_number_field")
+        self.tables = self.compile_tables()
+
+    def load_schema(self, omopddl, omopcfg, cache_dir=None):
+        """
+        The ddl merged with the config, cached (as json) by the hash of both files
+        so the ddl is only parsed the first time a pair of files is used
+        """
+        try:
+            sha = hashlib.sha256(str(SCHEMA_VERSION).encode())
+            for fname in [omopddl, omopcfg]:
+                with open(fname, "rb") as f:
+                    sha.update(f.read())
+        except IOError:
+            #reported by load_ddl/load_json as before
+            return self.merge_json(self.load_ddl(omopddl), omopcfg)
+
+        if cache_dir is None:
+            cache_dir = get_schema_cache_dir()
+        fname = os.path.join(cache_dir, f"{sha.hexdigest()}.json")
+        if os.path.exists(fname):
+            try:
+                with open(fname) as f:
+                    return json.load(f)
+            except ValueError:
+                pass
+
+        omop_json = self.merge_json(self.load_ddl(omopddl), omopcfg)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = f"{fname}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(omop_json, f)
+            os.replace(tmp, fname)
+        except OSError:
+            #the cache is optional
+            pass
+        return omop_json
+
+    def compile_tables(self):
+        names = set()
+        for key in ["all_columns", "numeric_fields", "notnull_numeric_fields", "datetime_fields", "date_fields",
+                    "datetime_linked_fields", "date_field_components", "person_id_field", "auto_number_field"]:
+            names.update(self.omop_json.get(key) or {})
+
+        tables = {}
+        for name in sorted(names):
+            columns = tuple((self.all_columns or {}).get(name, []))
+            column_map = self.get_column_map(columns)
+            notnull = tuple(self.get_omop_notnull_numeric_fields(name))
+            person_id_field = self.get_omop_person_id_field(name)
+            auto_number_field = self.get_omop_auto_number_field(name)
+            row_template = [""]*len(columns)
+            for field in notnull:
+                row_template[column_map[field]] = "0"
+            tables[name] = TableSchema(
+                name=name,
+                columns=columns,
+                column_map=column_map,
+                numeric_fields=tuple(self.get_omop_numeric_fields(name)),
+                notnull_numeric_fields=notnull,
+                datetime_fields=tuple(self.get_omop_datetime_fields(name)),
+                date_fields=tuple((self.omop_json.get("date_fields") or {}).get(name, [])),
+                datetime_linked_fields=self.get_omop_datetime_linked_fields(name),
+                date_field_components=self.get_omop_date_field_components(name),
+                person_id_field=person_id_field,
+                auto_number_field=auto_number_field,
+                person_id_index=column_map.get(person_id_field),
+                auto_number_index=column_map.get(auto_number_field),
+                row_template=tuple(row_template)
+            )
+        return tables
+
+    def get_table(self, tablename):
+        return self.tables.get(tablename)
 
 
     def load_ddl(self, omopddl):
@@ -121,7 +218,7 @@ class OmopCDM:
 
     def get_omop_column_map(self, tablename):
         if tablename in self.all_columns:
-            return self.get_column_map(self.all_columns[tablename])
+            return self.tables[tablename].column_map
         return None
 
     def get_omop_column_list(self, tablename):
@@ -2,12 +2,79 @@ import os
 import time
 import threading
 import psutil
+import numpy as np
 import pandas as pd
 from carrot.tools.logger import Logger
-        
+from carrot.tools.tracing import get_tracer
+
+
+def parse_memory(value):
+    """
+    Convert a memory size given as bytes or a string e.g. '512M', '8G' into bytes
+    """
+    if value is None:
+        return None
+    if isinstance(value,(int,float)):
+        return int(value)
+    units = {'K':2**10,'M':2**20,'G':2**30,'T':2**40}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1])*units[value[-1]])
+    return int(value)
+
+
+class MemoryMonitor(Logger):
+    """
+    Track the peak memory (RSS) of the current process in a background thread,
+    the peak can be reset e.g. to find the peak memory used for each chunk of data
+    """
+    def __init__(self,interval=0.05):
+        self.py = psutil.Process(os.getpid())
+        self.interval = interval
+        self.peak = self.current()
+        self.th = threading.Thread(target=self.track,daemon=True)
+        self._stop = False
+        self.th.start()
+
+    def current(self):
+        return self.py.memory_info()[0]
+
+    def reset(self):
+        #return the peak since the last reset and start again from the current usage
+        peak = max(self.peak,self.current())
+        self.peak = self.current()
+        return peak
+
+    def stop(self):
+        self._stop = True
+
+    def track(self):
+        while self._stop == False:
+            self.peak = max(self.peak,self.current())
+            time.sleep(self.interval)
+
+
+_sample_dtype = np.dtype([
+    ('time[s]','f8'),
+    ('memory[GB]','f8'),
+    ('cpu[%]','f8'),
+    ('nprocs','i4'),
+    ('read[MB]','f8'),
+    ('write[MB]','f8'),
+    ('stage','i4'),
+    ('table','i4')
+])
+
 
 class Profiler(Logger):
-    def __init__(self,name=None,interval=0.1):
+    """
+    Sample the CPU, memory (RSS) and IO of this process and all of its child processes (e.g. workers)
+    in a background thread, tagging each sample with the pipeline stage and destination table
+    currently being processed (from the tracer).
+    Samples are held in a fixed size ring buffer; if fname is given they are appended to this csv
+    whenever the buffer fills, otherwise only the most recent `capacity` samples are kept.
+    """
+    def __init__(self,name=None,interval=0.1,capacity=1024,fname=None):
         
         if name == None:
             name = self.__class__.__name__
@@ -19,21 +86,36 @@ class Profiler(Logger):
         self.pid = os.getpid()
         #create a psutil instance to montior this
         self.py = psutil.Process(self.pid)
+        #child processes are cached so cpu_percent is measured since the last sample
+        self.children = {}
         #set the interval (seconds) of how often to check the cpu and memory
         self.interval = interval
-        self.logger.info(f"tracking {self.pid} every {self.interval} seconds")
+        self.logger.info(f"tracking {self.pid} (and any child processes) every {self.interval} seconds")
         #count the number of cpus the computer running this process has
         self.cpu_count = psutil.cpu_count()
         self.logger.info(f"{self.cpu_count} cpus available")
         #initiate a threaded function
         #that will run in a separate process and can monitor CPU/memory in the background
-        self.th = threading.Thread(target=self.track)
+        self.th = threading.Thread(target=self.track,daemon=True)
 
         #init some global variables
-        self.tracking = []
+        self.buffer = np.zeros(capacity,dtype=_sample_dtype)
+        #total number of samples taken, and how many of these have been written to fname
+        self.nsamples = 0
+        self.nwritten = 0
+        self.fname = fname
+        self.stages = ['']
+        self.tables = ['']
         self.init_time = time.time()
         self._stop = False
         self._df = None
+        self._lock = threading.Lock()
+        if fname is not None:
+            _dir = os.path.dirname(fname)
+            if _dir and not os.path.exists(_dir):
+                os.makedirs(_dir)
+            with open(fname,'w') as f:
+                f.write(','.join(['']+list(_sample_dtype.names))+'\n')
         
     def start(self):
         #start the thread
@@ -44,13 +126,103 @@ class Profiler(Logger):
         #stop the thread
         self._stop = True
         self.th.join()
+        self.flush()
         self.logger.info("finished profiling")
 
+    def _code(self,values,value):
+        try:
+            return values.index(value)
+        except ValueError:
+            values.append(value)
+            return len(values) - 1
+
+    def _processes(self):
+        procs = [self.py]
+        try:
+            children = self.py.children(recursive=True)
+        except psutil.Error:
+            children = []
+        current = {}
+        for child in children:
+            #reuse the psutil object so cpu_percent is relative to the last sample
+            current[child.pid] = self.children.get(child.pid,child)
+        self.children = current
+        return procs + list(current.values())
+
+    def sample(self):
+        memory = cpu = read = write = 0
+        nprocs = 0
+        for proc in self._processes():
+            try:
+                with proc.oneshot():
+                    memory += proc.memory_info()[0]
+                    cpu += proc.cpu_percent()
+                    nprocs += 1
+                    #io counters are not available on all platforms
+                    if hasattr(proc,'io_counters'):
+                        io = proc.io_counters()
+                        read += io.read_bytes
+                        write += io.write_bytes
+            except psutil.Error:
+                #the process has finished since it was listed (or its io cannot be read)
+                continue
+
+        stage,table = get_tracer().current
+        with self._lock:
+            if self.nsamples - self.nwritten == len(self.buffer):
+                if self.fname is not None:
+                    self._write()
+                else:
+                    #drop the oldest sample
+                    self.nwritten += 1
+            i = self.nsamples % len(self.buffer)
+            self.buffer[i] = (time.time() - self.init_time,
+                              memory/2.**30,
+                              cpu/self.cpu_count,
+                              nprocs,
+                              read/2.**20,
+                              write/2.**20,
+                              self._code(self.stages,stage),
+                              self._code(self.tables,table or ''))
+            self.nsamples += 1
+            self._df = None
+
+    def _samples(self):
+        #the samples in the buffer that have not been written yet, in time order
+        idx = np.arange(self.nwritten,self.nsamples) % len(self.buffer)
+        return self.buffer[idx]
+
+    def _to_df(self,samples,start):
+        df = pd.DataFrame(samples,index=pd.RangeIndex(start,start+len(samples)))
+        df['stage'] = np.array(self.stages,dtype=object)[df['stage'].values]
+        df['table'] = np.array(self.tables,dtype=object)[df['table'].values]
+        return df
+
+    def _write(self):
+        if self.nsamples == self.nwritten:
+            return
+        self._to_df(self._samples(),self.nwritten).to_csv(self.fname,mode='a',header=False)
+        self.nwritten = self.nsamples
+
+    def flush(self):
+        """
+        Append any samples not yet written to fname
+        """
+        if self.fname is None:
+            return
+        with self._lock:
+            self._write()
+
     def get_df(self):
         #build a little dataframe for cpu/memory v.s. time,
         #if it has not been built already
         if self._df is None:
-            self._df = pd.DataFrame(self.tracking)
+            if self.fname is not None:
+                self.flush()
+                self._df = pd.read_csv(self.fname,index_col=0,keep_default_na=False)
+            else:
+                with self._lock:
+                    self._df = self._to_df(self._samples(),self.nwritten)
         return self._df
         
     def summary(self):
@@ -63,15 +235,7 @@ class Profiler(Logger):
         """
         #while the program has been told to profile the usage
         while self._stop == False:
-            #from the current process, calculate the current memory usage (in GB)
-            memory = self.py.memory_info()[0]/2.**30
-            #also calculate the CPU % in use at this epoch in time
-            cpu = self.py.cpu_percent() / self.cpu_count
-            #calcuate the current time - time since the start of the process
-            current_time = time.time() - self.init_time
-            #log the data
-            info = {'time[s]':current_time,'memory[GB]':memory,'cpu[%]':cpu}
-            self.tracking.append(info)
+            self.sample()
             #sleep the number of seconds requested
             time.sleep(self.interval)
 
@@ -0,0 +1,123 @@
+import hashlib
+import hmac
+import concurrent.futures
+import pandas as pd
+from carrot.tools.logger import Logger
+
+class UnknownHashMode(Exception):
+    pass
+
+class BadHashKey(Exception):
+    pass
+
+#sha256 is the original (salted) method, kept as the default
+#so that previously pseudonymised data can still be linked
+modes = ['sha256','hmac-sha256','blake2b']
+
+def _hash_values(values,salt,mode):
+    """
+    Hash a list of (string) values with the given salt/key and mode.
+    Module level so it can be pickled and sent to a process pool.
+    """
+    if mode == 'sha256':
+        return [hashlib.sha256((x+salt).encode("UTF-8")).hexdigest() for x in values]
+
+    key = salt.encode("UTF-8")
+    if mode == 'hmac-sha256':
+        h = hmac.new(key,digestmod=hashlib.sha256)
+        retval = []
+        for x in values:
+            _h = h.copy()
+            _h.update(x.encode("UTF-8"))
+            retval.append(_h.hexdigest())
+        return retval
+    elif mode == 'blake2b':
+        h = hashlib.blake2b(key=key,digest_size=32)
+        retval = []
+        for x in values:
+            _h = h.copy()
+            _h.update(x.encode("UTF-8"))
+            retval.append(_h.hexdigest())
+        return retval
+
+    raise UnknownHashMode(f"{mode} is not a known hash mode, choose from {modes}")
+
+
+class Pseudonymiser(Logger):
+    """
+    Pseudonymise columns of dataframes.
+
+    Only the unique values found in each chunk are hashed, and the
+    id->hash lookup is cached between chunks (and files) so that the
+    same id is never hashed twice. Large batches of new ids are split
+    across a pool of worker processes.
+    """
+    def __init__(self,salt,mode='sha256',workers=1,
+                 min_batch_size=100000,max_cache_size=50000000):
+        if mode not in modes:
+            raise UnknownHashMode(f"{mode} is not a known hash mode, choose from {modes}")
+        if mode == 'blake2b' and len(salt.encode("UTF-8")) > 64:
+            raise BadHashKey("blake2b keys must be no longer than 64 bytes")
+
+        self.salt = salt
+        self.mode = mode
+        self.workers = workers if workers else 1
+        self.min_batch_size = min_batch_size
+        self.max_cache_size = max_cache_size
+        self.cache = {}
+        self.pool = None
+        if self.workers > 1:
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def hash(self,values):
+        """
+        Hash a list of values, using the process pool if there are enough of them
+        """
+        if self.pool is None or len(values) < self.min_batch_size:
+            return _hash_values(values,self.salt,self.mode)
+
+        n = -(-len(values) // self.workers)
+        batches = [values[i:i+n] for i in range(0,len(values),n)]
+        futures = [self.pool.submit(_hash_values,batch,self.salt,self.mode) for batch in batches]
+        retval = []
+        for future in futures:
+            retval.extend(future.result())
+        return retval
+
+    def pseudonymise_series(self,series):
+        """
+        Pseudonymise a series, hashing only the unique values not already cached
+        """
+        unique = pd.unique(series.dropna())
+        new = [x for x in unique if x not in self.cache]
+        if len(new) > 0:
+            #stop the cache growing without limit on very high cardinality inputs
+            if len(self.cache) + len(new) > self.max_cache_size:
+                self.logger.debug(f"clearing cache of size {len(self.cache)}")
+                self.cache = {}
+                new = list(unique)
+            self.cache.update(zip(new,self.hash(new)))
+            self.logger.debug(f"hashed {len(new)} new values out of {len(unique)} unique values")
+        #only map the values of this series, mapping with the whole cache would convert all of it per call
+        return series.map({x:self.cache[x] for x in unique})
+
+    def pseudonymise(self,df,columns):
+        """
+        Pseudonymise the given columns of a dataframe (in place)
+        """
+        if isinstance(columns,str):
+            columns = [columns]
+        for col in columns:
+            df[col] = self.pseudonymise_series(df[col])
+        return df
@@ -0,0 +1,126 @@
+import os
+import sys
+import ast
+import json
+import time
+import importlib.util
+from carrot.tools.logger import Logger
+
+
+def get_registry_file():
+    return os.environ.get('CARROT_CLASS_REGISTRY',
+                          os.path.join(os.path.expanduser('~'),'.cache','carrot','classes.json'))
+
+
+def find_classes(path):
+    """
+    Names of the classes defined (at the top level) in a python file, found by parsing the file
+    so the module does not have to be imported
+    """
+    with open(path,'rb') as f:
+        tree = ast.parse(f.read(),filename=path)
+    return sorted(node.name for node in tree.body if isinstance(node,ast.ClassDef))
+
+
+class ClassRegistry(Logger):
+    """
+    Index of the classes defined in the registered python configs, stored as json and keyed by the
+    (resolved) path of each file. A file is only parsed again if its mtime or size has changed.
+    """
+    def __init__(self,fname=None):
+        if fname is None:
+            fname = get_registry_file()
+        self.fname = fname
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(fname):
+            try:
+                with open(fname) as f:
+                    self.entries = json.load(f)
+            except (OSError,ValueError) as err:
+                self.logger.warning(f"ignoring the class registry {fname}: {err}")
+
+    def get(self,path):
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            try:
+                classes = find_classes(path)
+            except SyntaxError as err:
+                self.logger.warning(f"cannot parse {path}: {err}")
+                classes = []
+            entry = {'mtime':stat.st_mtime_ns,'size':stat.st_size,'classes':classes}
+            self.entries[path] = entry
+            self.changed = True
+        return entry['classes']
+
+    def save(self):
+        if not self.changed:
+            return
+        #drop files that no longer exist
+        self.entries = {k:v for k,v in self.entries.items() if os.path.exists(k)}
+        try:
+            _dir = os.path.dirname(self.fname)
+            if _dir and not os.path.exists(_dir):
+                os.makedirs(_dir)
+            tmp = f'{self.fname}.{os.getpid()}.tmp'
+            with open(tmp,'w') as f:
+                json.dump(self.entries,f)
+            os.replace(tmp,self.fname)
+            self.changed = False
+        except OSError as err:
+            #the registry is only a cache, so carry on without it
+            self.logger.debug(f"could not save the class registry {self.fname}: {err}")
+
+
+def scan_folder(_dir,module_prefix=None,registry=None,remove_broken_links=False):
+    """
+    Describe the python configs in a folder, keyed by file name, without importing them
+    """
+    save = registry is None
+    if registry is None:
+        registry = ClassRegistry()
+    retval = {}
+    for fname in sorted(os.listdir(_dir)):
+        if not fname.endswith(".py") or fname.startswith('__'):
+            continue
+        path = os.path.join(_dir,fname)
+        if os.path.islink(path) and not os.path.isfile(os.readlink(path)):
+            if remove_broken_links:
+                os.unlink(path)
+            continue
+        classes = registry.get(path)
+        if not classes:
+            continue
+        mname = fname.split(".")[0]
+        if module_prefix is not None:
+            mname = '.'.join([module_prefix,mname])
+        retval[fname] = {
+            'module':mname,
+            'path': path if not os.path.islink(path) else os.readlink(path),
+            'sympath': path,
+            'last-modified': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(path))),
+            'classes': classes
+        }
+    if save:
+        registry.save()
+    return retval
+
+
+def load_class(info):
+    """
+    Import the module of a registered config (an entry of get_classes) and return the class defined in it
+    """
+    if info['module'] in sys.modules:
+        module = sys.modules[info['module']]
+    elif '.' in info['module']:
+        module = importlib.import_module(info['module'])
+    else:
+        #configs from $CARROT_CONFIG_FOLDER are loaded from their path, not from sys.path
+        spec = importlib.util.spec_from_file_location(info['module'],info['sympath'])
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[info['module']] = module
+        spec.loader.exec_module(module)
+    #should only be running one class anyway
+    return getattr(module,info['classes'][0])
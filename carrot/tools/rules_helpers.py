@@ -1,10 +1,20 @@
 
+import pandas as pd
+
 class TableNotFoundError(Exception):
     pass
 class FieldNotFoundError(Exception):
     pass
 
+class TermMapping(dict):
+    """
+    Value level term mapping whose concept ids are already strings (see compile_rules)
+    """
+    pass
+
 def get_person_ids(rules):
+    if getattr(rules,'person_ids',None) is not None and rules.is_unchanged():
+        return dict(rules.person_ids)
     return {
         subtable['person_id']['source_table']:subtable['person_id']['source_field'] 
         for table in rules['cdm'].values() 
@@ -62,6 +72,12 @@ def apply_rules(this,rules,inputs=None):
         source_field = get_source_field(source_table,source_field_name)
         series = source_field.copy()
 
+        #compact (categorical or arrow string) columns are only kept for value level mappings,
+        #which are then applied once per category rather than once per row
+        if isinstance(series.dtype,(pd.CategoricalDtype,pd.StringDtype)):
+            if operations is not None or not isinstance(term_mapping,dict):
+                series = series.astype(object)
+
         if operations is not None:
             for operation in operations:
                 function = this.tools[operation]
@@ -76,8 +92,11 @@ def apply_rules(this,rules,inputs=None):
                 #need to make the value a string for mapping
                 #pandas has a weird behaviour that when the value is an Int
                 #the resulting series is a float64
-                term_mapping = {k:str(v) for k,v in term_mapping.items()}
+                if not isinstance(term_mapping,TermMapping):
+                    term_mapping = {k:str(v) for k,v in term_mapping.items()}
                 series = series.map(term_mapping)
+                if series.dtype != object:
+                    series = series.astype(object)
             else:
                 # field level mapping.
                 # - term_mapping is the concept_id
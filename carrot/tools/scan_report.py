@@ -0,0 +1,179 @@
+import os
+import concurrent.futures
+import pandas as pd
+import numpy as np
+from carrot.tools.logger import _Logger as Logger
+
+class CountMinSketch():
+    """
+    Fixed size frequency sketch, counts are only ever over-estimated
+    """
+    def __init__(self,width=2**16,depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth,width),dtype=np.int64)
+        #pandas needs a 16 character key for each hash function
+        self.keys = [f"carrotsketch{d:04d}" for d in range(depth)]
+
+    def _indices(self,values):
+        values = np.asarray(values,dtype=object)
+        return [
+            pd.util.hash_array(values,hash_key=key) % np.uint64(self.width)
+            for key in self.keys
+        ]
+
+    def add(self,values,counts):
+        counts = np.asarray(counts,dtype=np.int64)
+        for d,idx in enumerate(self._indices(values)):
+            np.add.at(self.table[d],idx.astype(np.int64),counts)
+
+    def estimate(self,values):
+        if len(values) == 0:
+            return np.array([],dtype=np.int64)
+        return np.min([
+            self.table[d][idx.astype(np.int64)]
+            for d,idx in enumerate(self._indices(values))
+        ],axis=0)
+
+    def merge(self,other):
+        self.table += other.table
+
+
+class FieldProfile():
+    """
+    Value frequencies for a single field, built up chunk by chunk.
+
+    Counts are exact until the number of distinct values passes max_exact,
+    after which the counts are held in a count-min sketch and only the
+    top `capacity` heavy hitters are tracked.
+    """
+    def __init__(self,max_exact=10000,capacity=1000,width=2**16,depth=4):
+        self.max_exact = max_exact
+        self.capacity = capacity
+        self.width = width
+        self.depth = depth
+        self.counts = pd.Series(dtype=np.int64)
+        self.sketch = None
+
+    @property
+    def approximate(self):
+        return self.sketch is not None
+
+    def _to_sketch(self):
+        self.sketch = CountMinSketch(width=self.width,depth=self.depth)
+        self.sketch.add(self.counts.index,self.counts.values)
+        self.counts = self.counts.nlargest(self.capacity)
+
+    def _update_candidates(self,values):
+        #re-estimate the current candidates along with any new values and keep the top ones
+        candidates = self.counts.index.union(pd.Index(values))
+        self.counts = pd.Series(self.sketch.estimate(candidates),index=candidates).nlargest(self.capacity)
+
+    def update(self,counts):
+        """
+        Add the value counts from a new chunk of data
+        """
+        if self.sketch is None:
+            self.counts = self.counts.add(counts,fill_value=0).astype(np.int64)
+            if self.max_exact > 0 and len(self.counts) > self.max_exact:
+                self._to_sketch()
+        else:
+            self.sketch.add(counts.index,counts.values)
+            self._update_candidates(counts.index)
+
+    def merge(self,other):
+        if self.sketch is None and other.sketch is None:
+            self.update(other.counts)
+            return
+        if self.sketch is None:
+            self._to_sketch()
+        if other.sketch is None:
+            self.sketch.add(other.counts.index,other.counts.values)
+        else:
+            self.sketch.merge(other.sketch)
+        self._update_candidates(other.counts.index)
+
+    def top(self,n=0):
+        series = self.counts.sort_values(ascending=False)
+        if n > 0:
+            series = series.iloc[:n]
+        return series
+
+
+def scan_file(fname,rows_per_table=100000,chunksize=100000,randomise=False,
+              max_distinct_values=10,max_exact=10000):
+    """
+    Stream through a file in chunks and profile the value frequencies of each field.
+    Returns the number of rows scanned and a FieldProfile for each column.
+    """
+    logger = Logger("scan_file")
+    nrows = rows_per_table if rows_per_table and rows_per_table > 0 else None
+    #if all distinct values are requested, the counts have to be exact
+    if max_distinct_values <= 0:
+        max_exact = 0
+    capacity = max(10*max_distinct_values,1000)
+
+    #load it and preserve the original data (i.e. no NaN conversions)
+    chunks = pd.read_csv(fname,
+                         dtype=str,
+                         keep_default_na=False,
+                         nrows=nrows,
+                         chunksize=chunksize)
+    nscanned = 0
+    fields = None
+    for df in chunks:
+        if randomise:
+            df = df.sample(frac=1)
+        if fields is None:
+            fields = {col:FieldProfile(max_exact=max_exact,capacity=capacity) for col in df.columns}
+        for col in df.columns:
+            fields[col].update(df[col].value_counts())
+        nscanned += len(df)
+        logger.debug(f"{fname}: scanned {nscanned} rows")
+
+    if fields is None:
+        fields = {col:FieldProfile() for col in pd.read_csv(fname,nrows=0).columns}
+
+    approximate = [col for col,field in fields.items() if field.approximate]
+    if approximate:
+        logger.warning(f"{os.path.basename(fname)}: high cardinality fields {approximate} have approximate counts")
+    return nscanned,fields
+
+
+def make_report_table(fname,name,max_distinct_values=10,min_cell_count=5,**kwargs):
+    """
+    Build the scan report json entry for a single input file
+    """
+    nscanned,profiles = scan_file(fname,max_distinct_values=max_distinct_values,**kwargs)
+
+    fields = []
+    for col,profile in profiles.items():
+        #reduce the size of the value counts depending on specifications of max distinct values
+        series = profile.top(max_distinct_values)
+        #if the min cell count is set, remove value counts that are below this threshold
+        if not min_cell_count is None:
+            series = series[series >= min_cell_count]
+        #convert into a frequency instead of value count
+        series = (series/nscanned).rename('frequency').round(4)
+        values = series.to_frame().rename_axis('value').reset_index().to_dict(orient='records')
+        fields.append({'field':col,'values':values})
+
+    meta = {
+        'dataset':name,
+        'nscanned':nscanned,
+        'max_distinct_values':max_distinct_values,
+        'min_cell_count':min_cell_count
+    }
+    return {'table':os.path.basename(fname),'fields':fields,'meta':meta}
+
+
+def make_report(inputs,name,workers=1,**kwargs):
+    """
+    Build the scan report json for a list of input files, scanning files in parallel
+    """
+    if workers is None or workers <= 1 or len(inputs) <= 1:
+        return [make_report_table(fname,name,**kwargs) for fname in inputs]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(make_report_table,fname,name,**kwargs) for fname in inputs]
+        return [future.result() for future in futures]
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import threading
+from carrot.tools.logger import Logger
+
+class Span():
+    """
+    Time a single stage of the pipeline (wall and cpu time),
+    along with the number of rows (and bytes) going in and out
+    """
+    def __init__(self,tracer,stage,**args):
+        self.tracer = tracer
+        self.stage = stage
+        self.args = args
+
+    def set(self,**kwargs):
+        self.args.update(kwargs)
+
+    def __enter__(self):
+        #the stage being run, so samples from the profiler can be tagged with it
+        self.previous = self.tracer.current
+        self.tracer.current = (self.stage,self.args.get('table',''))
+        self.start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self,*exc):
+        self.wall = time.perf_counter() - self.start
+        self.cpu = time.thread_time() - self.cpu_start
+        self.tracer.current = self.previous
+        self.tracer.record(self)
+        return False
+
+
+class _NullSpan():
+    def set(self,**kwargs):
+        pass
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc):
+        return False
+
+
+def nbytes(df):
+    #shallow size, deep=True is too slow to compute for every chunk
+    return int(df.memory_usage(index=False).sum())
+
+
+class Tracer(Logger):
+    """
+    Collect per-stage spans (read, define, finalise, format, mask, dedup, write)
+    and aggregate them per stage, destination table and object.
+    Individual events are only kept if requested, so they can be dumped
+    as a Chrome trace (chrome://tracing or https://ui.perfetto.dev)
+    """
+    def __init__(self,name=None,enabled=True,keep_events=False):
+        self.name = name
+        self.enabled = enabled
+        self.keep_events = keep_events
+        self.chunk = 0
+        self.init_time = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.stages = {}
+        self.objects = {}
+        #(stage,table) of the most recently started span that is still running
+        self.current = ('','')
+        self._lock = threading.Lock()
+
+    def span(self,stage,**args):
+        if not self.enabled:
+            return _NullSpan()
+        return Span(self,stage,chunk=self.chunk,**args)
+
+    def _add(self,summary,key,span):
+        if key not in summary:
+            summary[key] = {'calls':0,'wall[s]':0.,'cpu[s]':0.,'rows_in':0,'rows_out':0,'bytes':0}
+        summary = summary[key]
+        summary['calls'] += 1
+        summary['wall[s]'] += span.wall
+        summary['cpu[s]'] += span.cpu
+        for k in ['rows_in','rows_out','bytes']:
+            summary[k] += span.args.get(k,0)
+
+    def record(self,span):
+        table = span.args.get('table','')
+        obj = span.args.get('object')
+        with self._lock:
+            self._add(self.stages.setdefault(span.stage,{}),table,span)
+            if obj is not None:
+                self._add(self.objects.setdefault(f"{table}::{obj}",{}),span.stage,span)
+            if self.keep_events:
+                self.events.append({
+                    'name':span.stage if obj is None else f"{span.stage}:{obj}",
+                    'cat':span.stage,
+                    'ph':'X',
+                    'ts':(span.start - self.init_time)*1e6,
+                    'dur':span.wall*1e6,
+                    'pid':self.pid,
+                    'tid':threading.get_ident(),
+                    'args':{**span.args,'cpu[s]':span.cpu}
+                })
+
+    def summary(self):
+        """
+        Aggregated timing/throughput, per stage and table, and per object and stage
+        """
+        def _finish(summary):
+            for x in summary.values():
+                x['wall[s]'] = round(x['wall[s]'],6)
+                x['cpu[s]'] = round(x['cpu[s]'],6)
+                x['rows/s'] = round(x['rows_out']/x['wall[s]'],1) if x['wall[s]'] > 0 and x['rows_out'] > 0 else None
+            return summary
+
+        with self._lock:
+            return {
+                'stages':{k:_finish(dict((t,dict(v)) for t,v in x.items())) for k,x in self.stages.items()},
+                'objects':{k:_finish(dict((t,dict(v)) for t,v in x.items())) for k,x in self.objects.items()}
+            }
+
+    def to_chrome_trace(self):
+        with self._lock:
+            return {'traceEvents':list(self.events),'displayTimeUnit':'ms','otherData':{'name':self.name}}
+
+    def write_chrome_trace(self,fname):
+        _dir = os.path.dirname(fname)
+        if _dir and not os.path.exists(_dir):
+            os.makedirs(_dir)
+        with open(fname,'w') as f:
+            json.dump(self.to_chrome_trace(),f)
+        self.logger.info(f"Written the trace of {len(self.events)} events to {fname}")
+
+
+#the tracer used by the running model,
+#objects and data collections record their spans to this
+_tracer = Tracer(enabled=False)
+
+def get_tracer():
+    return _tracer
+
+def set_tracer(tracer):
+    global _tracer
+    _tracer = tracer
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Check the execution backends give the same outputs.
+
+The bundled test rules (rules_14June2021.json) are run over the bundled test inputs
+with `carrot run map --backend <backend>` for each backend, unchunked and chunked
+(the sql backend ignores chunking, so its outputs are always those of an unchunked run).
+The unchunked output tables are compared to the bundled expected outputs (data/test/expected_outputs),
+the chunked output tables to those of the first backend (pandas) with the same chunking.
+Exits with a non-zero code if any output differs.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import pandas as pd
+
+import carrot
+
+_data_dir = os.path.join(os.path.dirname(carrot.__file__),'data','test')
+_inputs_dir = os.path.join(_data_dir,'inputs')
+_expected_dir = os.path.join(_data_dir,'expected_outputs')
+_rules = os.path.join(_data_dir,'rules','rules_14June2021.json')
+
+
+def run_map(backend,output_folder,chunksize=None,sql_engine=None):
+    cmd = ['carrot','-l','0','run','map','--rules',_rules,_inputs_dir,
+           '--backend',backend,'--output-folder',output_folder]
+    if chunksize:
+        cmd += ['-nc',str(chunksize)]
+    if backend == 'sql' and sql_engine:
+        cmd += ['--sql-engine',sql_engine]
+    subprocess.run(cmd,check=True)
+
+
+def compare(output_folder,expected_folder):
+    """
+    Compare each expected output table to the same table in output_folder, returning the differences
+    """
+    differences = []
+    for fname in sorted(os.listdir(expected_folder)):
+        if not fname.endswith('.tsv') or fname == 'summary.tsv':
+            continue
+        expected = pd.read_csv(os.path.join(expected_folder,fname),sep='\t',dtype=str,keep_default_na=False)
+        output = os.path.join(output_folder,fname)
+        if not os.path.exists(output):
+            differences.append(f'{fname} is missing')
+            continue
+        df = pd.read_csv(output,sep='\t',dtype=str,keep_default_na=False)
+        if list(df.columns) != list(expected.columns):
+            differences.append(f'{fname} has columns {list(df.columns)}, expected {list(expected.columns)}')
+        elif len(df) != len(expected):
+            differences.append(f'{fname} has {len(df)} rows, expected {len(expected)}')
+        else:
+            diff = (df != expected).any(axis=1)
+            if diff.any():
+                differences.append(f'{fname} has {diff.sum()} rows that differ, the first is:\n'
+                                   f'{pd.concat([expected[diff].head(1),df[diff].head(1)]).T}')
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends',nargs='+',default=['pandas','polars','sql'])
+    parser.add_argument('--sql-engine',default=None,choices=['duckdb','sqlite'],help='engine for the sql backend')
+    parser.add_argument('--chunksize',type=int,default=100,help='also run chunked with this number of rows per chunk, 0 to turn off')
+    parser.add_argument('--keep',default=None,help='keep the outputs in this folder')
+    args = parser.parse_args()
+
+    folder = args.keep or tempfile.mkdtemp(prefix='carrot_parity_')
+    failed = False
+    try:
+        for chunksize in [None,args.chunksize] if args.chunksize else [None]:
+            #the order of the persons depends on the chunking, so chunked outputs are compared to the first backend
+            reference = _expected_dir
+            for backend in args.backends:
+                if chunksize and backend == 'sql':
+                    continue
+                label = f'{backend}' + (f' (chunksize={chunksize})' if chunksize else '')
+                output_folder = os.path.join(folder,backend + (f'_{chunksize}' if chunksize else ''))
+                run_map(backend,output_folder,chunksize,args.sql_engine)
+                if chunksize and reference == _expected_dir:
+                    reference = output_folder
+                    print(f"{label}: reference for the chunked outputs")
+                    continue
+                differences = compare(output_folder,reference)
+                print(f"{label}: {'OK' if not differences else 'FAILED'}")
+                for difference in differences:
+                    print(f'    {difference}')
+                failed |= bool(differences)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(folder)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Benchmark the carrot tools on deterministic synthetic data.
+
+Synthetic inputs are generated from the value frequencies of the bundled test data,
+so that the bundled test rules (rules_14June2021.json) can be applied to them at any scale.
+The wall time, rows/s and peak RSS of `carrot run map`, `carrot run merge` and
+(optionally) `carrot run mapstream` are recorded, along with the per-stage
+timings the CommonDataModel saves in .meta.json.
+The startup time of the cli (e.g. `carrot --version`) can also be recorded.
+
+Results can be saved as a baseline and later runs compared against it,
+exiting with a non-zero code if any benchmark has regressed.
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import psutil
+
+import carrot
+from carrot.tools.scan_report import scan_file
+
+_data_dir = os.path.join(os.path.dirname(carrot.__file__),'data','test')
+_inputs_dir = os.path.join(_data_dir,'inputs')
+_rules = os.path.join(_data_dir,'rules','rules_14June2021.json')
+_config_dir = os.path.join(os.path.dirname(carrot.__file__),'config')
+_omop_ddl_file = os.path.join(_config_dir,'OMOPCDM_postgresql_5.3_ddl.sql')
+_omop_config_file = os.path.join(_config_dir,'omop.json')
+
+
+def load_scan_report(inputs):
+    """
+    Scan the bundled test inputs, giving the values and their relative frequency for each field of each table
+    (the bundled ScanReport xlsx summarises these, but its field names have drifted from the test rules)
+    """
+    tables = {}
+    for fname in inputs:
+        _,profiles = scan_file(fname,rows_per_table=0,max_distinct_values=0)
+        fields = {}
+        for field,profile in profiles.items():
+            counts = profile.top()
+            fields[field] = (counts.index.values,counts.values/counts.sum())
+        tables[os.path.basename(fname)] = fields
+    return tables
+
+
+def generate(output_folder,nrows,seed=1234,chunksize=1000000):
+    """
+    Write synthetic input files of nrows each, the same seed always gives the same data.
+    The person table (Demographics) holds nrows unique persons,
+    the other tables sample from these persons.
+    """
+    os.makedirs(output_folder,exist_ok=True)
+    rules = carrot.tools.load_json(_rules)
+    person_ids = carrot.tools.get_person_ids(rules)
+    source_tables = carrot.tools.get_mapped_fields_from_rules(rules).keys()
+    inputs = [os.path.join(_inputs_dir,x) for x in sorted(source_tables)]
+    tables = load_scan_report(inputs)
+
+    rng = np.random.default_rng(seed)
+    for name,fields in tables.items():
+        fname = os.path.join(output_folder,name)
+        person_id = person_ids.get(name)
+        unique_persons = name == 'Demographics.csv'
+        with open(fname,'w') as f:
+            for start in range(0,nrows,chunksize):
+                n = min(chunksize,nrows-start)
+                data = {}
+                for field,(values,frequency) in fields.items():
+                    if field == person_id:
+                        if unique_persons:
+                            data[field] = np.arange(start,start+n)+1
+                        else:
+                            data[field] = rng.integers(1,nrows+1,n)
+                    else:
+                        data[field] = rng.choice(values,size=n,p=frequency)
+                pd.DataFrame(data).to_csv(f,header=(start==0),index=False)
+        print (f"created {fname} with {nrows} rows")
+    return sorted(glob.glob(os.path.join(output_folder,'*.csv')))
+
+
+def run(cmd,interval=0.05):
+    """
+    Run a command, returning the wall time and the peak RSS (MB) of it and any child processes
+    """
+    start = time.perf_counter()
+    p = psutil.Popen(cmd,stdout=open(os.devnull,'w'),stderr=open(os.devnull,'w'))
+    peak = 0
+    while p.poll() is None:
+        try:
+            procs = [p] + p.children(recursive=True)
+            rss = sum(x.memory_info().rss for x in procs)
+            peak = max(peak,rss)
+        except psutil.Error:
+            pass
+        time.sleep(interval)
+    wall = time.perf_counter() - start
+    if p.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)} failed with exit code {p.returncode}")
+    return wall,peak/2.**20
+
+
+def get_stages(output_folder):
+    """
+    Sum the per-stage timings saved by the CommonDataModel in .meta.json
+    """
+    fname = os.path.join(output_folder,'.meta.json')
+    if not os.path.exists(fname):
+        return {}
+    stages = {}
+    for meta in json.load(open(fname)).values():
+        for stage,tables in meta.get('timing',{}).get('stages',{}).items():
+            stages[stage] = round(stages.get(stage,0) + sum(x['wall[s]'] for x in tables.values()),4)
+    return stages
+
+
+def timed(results,name,cmd,nrows,output_folder=None):
+    """
+    Time a command and record its throughput, recording the error instead if it fails
+    """
+    try:
+        wall,rss = run(cmd)
+    except RuntimeError as err:
+        print (f"{name} failed: {err}")
+        results[name] = {'error':str(err)}
+        return
+    results[name] = {'wall[s]':round(wall,3),'rows/s':round(nrows/wall,1),'peak_rss[MB]':round(rss,1)}
+    if output_folder:
+        results[name]['stages'] = get_stages(output_folder)
+
+
+_startup_commands = {
+    'startup_version':['carrot','--version'],
+    'startup_info':['carrot','info','version'],
+    'startup_run_help':['carrot','run','--help'],
+}
+
+def startup(results,repeat=5):
+    """
+    Time how long the cli takes to start, taking the median of several runs.
+    cmd/s is the number of commands that can be run per second
+    """
+    for name,cmd in _startup_commands.items():
+        try:
+            runs = [run(cmd,interval=0.01) for _ in range(repeat)]
+        except RuntimeError as err:
+            print (f"{name} failed: {err}")
+            results[name] = {'error':str(err)}
+            continue
+        wall = float(np.median([x[0] for x in runs]))
+        rss = float(np.median([x[1] for x in runs]))
+        results[name] = {'wall[s]':round(wall,3),'cmd/s':round(1/wall,1),'peak_rss[MB]':round(rss,1)}
+
+
+def benchmark(inputs,nrows,work_dir,benchmarks,chunksize=None,omop_ddl_file=_omop_ddl_file,omop_config_file=_omop_config_file):
+    results = {}
+    ntotal = nrows*len(inputs)
+
+    if 'map' in benchmarks or 'merge' in benchmarks:
+        out = os.path.join(work_dir,'map')
+        shutil.rmtree(out,ignore_errors=True)
+        cmd = ['carrot','-l','0','run','map','--rules',_rules,'--output-folder',out]
+        if chunksize:
+            cmd += ['-nc',str(chunksize)]
+        timed(results,'map',cmd + inputs,ntotal,out)
+
+    if 'merge' in benchmarks:
+        out = os.path.join(work_dir,'merge')
+        shutil.rmtree(out,ignore_errors=True)
+        tables = [x for x in glob.glob(os.path.join(work_dir,'map','*.tsv'))
+                  if os.path.basename(x).split('.')[0] not in ['person_ids','summary']]
+        nmerge = sum(sum(1 for _ in open(x))-1 for x in tables)
+        timed(results,'merge',['carrot','-l','0','run','merge','-o',out] + tables,nmerge,out)
+
+    if 'mapstream' in benchmarks:
+        if not (omop_ddl_file and omop_config_file):
+            print ("skipping mapstream, --omop-ddl-file and --omop-config-file are needed")
+        else:
+            out = os.path.join(work_dir,'mapstream')
+            shutil.rmtree(out,ignore_errors=True)
+            os.makedirs(out)
+            input_dir = os.path.dirname(inputs[0])
+            person_file = os.path.join(input_dir,'Demographics.csv')
+            timed(results,'mapstream',['carrot','-l','0','run','mapstream','--rules-file',_rules,'--output-dir',out,
+                                       '--person-file',person_file,'--omop-ddl-file',omop_ddl_file,
+                                       '--omop-config-file',omop_config_file,input_dir],ntotal)
+
+    return results
+
+
+def compare(results,baseline,tolerance):
+    """
+    Compare rows/s (or cmd/s for startup) and peak memory against a baseline, returning a list of regressions
+    """
+    regressions = []
+    for nrows,benches in results.items():
+        for name,result in benches.items():
+            if nrows not in baseline or name not in baseline[nrows]:
+                continue
+            base = baseline[nrows][name]
+            if 'error' in result:
+                if 'error' not in base:
+                    regressions.append(f"{name}[{nrows}] failed")
+                continue
+            if 'error' in base:
+                continue
+            rate = 'cmd/s' if 'cmd/s' in result else 'rows/s'
+            if rate in base and result[rate] < base[rate]*(1-tolerance):
+                regressions.append(f"{name}[{nrows}] {rate} {result[rate]} < baseline {base[rate]}")
+            if result['peak_rss[MB]'] > base['peak_rss[MB]']*(1+tolerance):
+                regressions.append(f"{name}[{nrows}] peak_rss[MB] {result['peak_rss[MB]']} > baseline {base['peak_rss[MB]']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark carrot on deterministic synthetic data.')
+    parser.add_argument('--rows','-n', dest='rows', type=int, nargs='+', default=[10000,100000],
+                        help='number of rows per input table, one benchmark is run for each (up to 10^8)')
+    parser.add_argument('--work-dir','-o', dest='work_dir', default='./benchmark',
+                        help='folder to generate the data and outputs into')
+    parser.add_argument('--seed', dest='seed', type=int, default=1234,
+                        help='seed for generating the synthetic data')
+    parser.add_argument('--benchmarks','-b', dest='benchmarks', nargs='+', default=['map','merge','mapstream','startup'],
+                        choices=['map','merge','mapstream','startup'], help='which benchmarks to run')
+    parser.add_argument('-nc','--number-of-rows-per-chunk', dest='chunksize', type=int, default=None,
+                        help='chunksize to use with `carrot run map`')
+    parser.add_argument('--omop-ddl-file', dest='omop_ddl_file', default=_omop_ddl_file,
+                        help='OMOP ddl file for the mapstream benchmark, the default is the bundled OMOP 5.3 ddl')
+    parser.add_argument('--omop-config-file', dest='omop_config_file', default=_omop_config_file,
+                        help='OMOP config file for the mapstream benchmark, the default is the bundled omop.json')
+    parser.add_argument('--baseline', dest='baseline', default=None,
+                        help='json file of previous results to check for regressions against')
+    parser.add_argument('--save-baseline', dest='save_baseline', default=None,
+                        help='save the results as a baseline json file')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.2,
+                        help='fractional slow down (or memory increase) allowed before flagging a regression')
+    parser.add_argument('--keep-data', dest='keep_data', action='store_true',
+                        help='reuse previously generated synthetic data, if it exists')
+    args = parser.parse_args()
+
+    results = {}
+    #the cli startup does not depend on the data, so is only run once
+    if 'startup' in args.benchmarks:
+        results['startup'] = {}
+        startup(results['startup'])
+        print (json.dumps({'startup':results['startup']},indent=4))
+
+    benchmarks = [x for x in args.benchmarks if x != 'startup']
+    for nrows in args.rows if benchmarks else []:
+        work_dir = os.path.join(args.work_dir,str(nrows))
+        data_dir = os.path.join(work_dir,'inputs')
+        inputs = sorted(glob.glob(os.path.join(data_dir,'*.csv')))
+        if not (args.keep_data and inputs):
+            shutil.rmtree(data_dir,ignore_errors=True)
+            inputs = generate(data_dir,nrows,seed=args.seed)
+
+        results[str(nrows)] = benchmark(inputs,nrows,work_dir,benchmarks,
+                                        chunksize=args.chunksize,
+                                        omop_ddl_file=args.omop_ddl_file,
+                                        omop_config_file=args.omop_config_file)
+        print (json.dumps({nrows:results[str(nrows)]},indent=4))
+
+    os.makedirs(args.work_dir,exist_ok=True)
+    fname = os.path.join(args.work_dir,'results.json')
+    with open(fname,'w') as f:
+        json.dump(results,f,indent=4)
+    print (f"saved results to {fname}")
+
+    if args.save_baseline:
+        with open(args.save_baseline,'w') as f:
+            json.dump(results,f,indent=4)
+        print (f"saved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        regressions = compare(results,json.load(open(args.baseline)),args.tolerance)
+        for r in regressions:
+            print (f"REGRESSION: {r}")
+        if regressions:
+            sys.exit(1)
+        print ("no regressions found")
+
+
+if __name__ == '__main__':
+    main()
@@ -32,6 +32,7 @@ setuptools.setup(
     extras_require = {
         'airflow':['apache-airflow'],
         'performance':['snakeviz'],
+        'polars':['polars>=1.0','pyarrow'],
     },
     install_requires=[
         "pandas",